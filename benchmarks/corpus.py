@@ -0,0 +1,251 @@
+"""Generate a synthetic Nix store of derivations to benchmark against.
+
+Usage:
+
+    python benchmarks/corpus.py DIRECTORY [--count N] [--depth N]
+        [--fan-out N] [--env-vars N] [--env-bytes N] [--multi-output F]
+        [--present F] [--cached F] [--seed N]
+
+DIRECTORY gets:
+
+* ``store/``: the derivation files, with output and file paths computed
+  as Nix would (so ``derivtool verify`` accepts them), plus an empty
+  directory for each output which is "built";
+* ``cache/``: a ``.narinfo`` file for each output which is "in the
+  binary cache", to be served over HTTP by :py:func:`serve_cache`;
+* ``roots``: the derivations nothing else depends on, one per line;
+* ``corpus.json``: the parameters it was generated with.
+
+Derivations are arranged in ``--depth`` layers, each depending on up
+to ``--fan-out`` derivations from the layers below it (mostly the one
+just below). The bottom layer is made of fixed-output derivations, as
+source downloads are. A fraction ``--multi-output`` of derivations
+have ``dev`` (and sometimes ``lib``) outputs as well as ``out``.
+"""
+import argparse
+import http.server
+import json
+import os
+import random
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.hashing import (
+    DerivationHasher, make_fixed_output_path, make_text_path)
+from nix_derivation_tools.store import path_hash
+
+DEFAULTS = {
+    "count": 5000,
+    "depth": 20,
+    "fan_out": 6,
+    "env_vars": 12,
+    "env_bytes": 2000,
+    "multi_output": 0.3,
+    "present": 0.3,
+    "cached": 0.5,
+    "seed": 0,
+}
+
+WORDS = ("configure", "make", "install", "patch", "substitute", "export",
+         "echo", "mkdir", "cp", "ln", "rm", "find", "sed", "test", "fi",
+         "then", "if", "done", "for", "do", "--prefix", "$out", "$src")
+
+
+def _script(rand, size):
+    """A shell-script-like string of about ``size`` bytes."""
+    lines, length = [], 0
+    while length < size:
+        line = " ".join(rand.choice(WORDS)
+                        for _ in range(rand.randint(3, 10)))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def _write_builder(store):
+    """Add the builder script all derivations share to the store.
+
+    :return: Its path.
+    :rtype: ``str``
+    """
+    contents = "eval \"$buildCommand\"\n"
+    path = make_text_path("builder.sh", contents, [], store)
+    with open(path, "w") as f:
+        f.write(contents)
+    return path
+
+
+def _make_derivation(hasher, store, outputs, environment, builder,
+                     input_derivations):
+    """Create a derivation, filling in its output paths and its own
+    path as Nix would."""
+    deriv = Derivation(
+        path=os.path.join(store, "unknown.drv"), raw=None, outputs=outputs,
+        input_derivations=input_derivations, input_files={builder},
+        system="x86_64-linux", builder="/bin/sh",
+        builder_args=["-e", builder], environment=environment)
+    if any(path == "" for path in outputs.values()):
+        paths = hasher.output_paths(deriv)
+        outputs.update(paths)
+        environment.update(paths)
+    deriv = Derivation(
+        path=hasher.derivation_path(deriv), raw=None, outputs=outputs,
+        input_derivations=input_derivations, input_files={builder},
+        system="x86_64-linux", builder="/bin/sh",
+        builder_args=["-e", builder], environment=environment)
+    # Remember its hash, which derivations using it need.
+    hasher.hash_modulo(deriv)
+    return deriv
+
+
+def generate_corpus(directory, count=DEFAULTS["count"],
+                    depth=DEFAULTS["depth"], fan_out=DEFAULTS["fan_out"],
+                    env_vars=DEFAULTS["env_vars"],
+                    env_bytes=DEFAULTS["env_bytes"],
+                    multi_output=DEFAULTS["multi_output"],
+                    present=DEFAULTS["present"], cached=DEFAULTS["cached"],
+                    seed=DEFAULTS["seed"]):
+    """Generate a corpus, as described above.
+
+    :param directory: Where to put it; created if missing.
+    :type directory: ``str``
+    :param present: Fraction of derivations whose outputs are present
+        in the store. Lower layers are likelier to be present.
+    :type present: ``float``
+    :param cached: Fraction of the other derivations whose outputs are
+        in the binary cache.
+    :type cached: ``float``
+
+    :return: The parameters, as written to ``corpus.json``.
+    :rtype: ``dict``
+    """
+    parameters = {"count": count, "depth": depth, "fan_out": fan_out,
+                  "env_vars": env_vars, "env_bytes": env_bytes,
+                  "multi_output": multi_output, "present": present,
+                  "cached": cached, "seed": seed}
+    store = os.path.abspath(os.path.join(directory, "store"))
+    cache = os.path.join(directory, "cache")
+    os.makedirs(store)
+    os.makedirs(cache)
+    rand = random.Random(seed)
+    hasher = DerivationHasher()
+    layers = [[] for _ in range(depth)]
+    used = set()
+    builder = _write_builder(store)
+    for i in range(count):
+        layer = min(depth - 1, i * depth // count)
+        name = "pkg{}-{}.{}".format(i, rand.randint(0, 9),
+                                    rand.randint(0, 20))
+        environment = {"name": name, "system": "x86_64-linux",
+                       "builder": "/bin/sh", "outputs": "out"}
+        for j in range(env_vars):
+            environment["var{}".format(j)] = "value-{}-{}".format(i, j)
+        if layer == 0:
+            # A source download.
+            hash_ = "{:064x}".format(rand.getrandbits(256))
+            out = make_fixed_output_path("r:sha256", hash_, name, store)
+            outputs = {"out": (out, "r:sha256", hash_)}
+            environment.update(out=out, outputHashMode="recursive",
+                               outputHash=hash_, urls="https://example.org/"
+                               + name + ".tar.gz")
+            inputs = []
+        else:
+            names = ["out"]
+            if rand.random() < multi_output:
+                names += ["dev", "lib"][:rand.randint(1, 2)]
+            # Output paths are left blank until they've been computed.
+            outputs = {output: "" for output in names}
+            environment.update(outputs)
+            environment["outputs"] = " ".join(names)
+            # Mostly from the layer just below, some from further down.
+            candidates = layers[layer - 1]
+            inputs = rand.sample(candidates, min(len(candidates),
+                                                 rand.randint(1, fan_out)))
+            below = [d for l in layers[:layer - 1] for d in l]
+            if below and rand.random() < 0.5:
+                inputs.append(rand.choice(below))
+            environment["buildInputs"] = " ".join(
+                sorted({d.output_mapping["out"] for d in inputs}))
+            environment["buildCommand"] = _script(
+                rand, int(rand.expovariate(1.0 / env_bytes)))
+        deriv = _make_derivation(
+            hasher, store, outputs, environment, builder,
+            {d.path: sorted(d.outputs) if rand.random() < 0.2 else ["out"]
+             for d in inputs})
+        with open(deriv.path, "w") as f:
+            f.write(deriv.unparse())
+        layers[layer].append(deriv)
+        used.update(d.path for d in inputs)
+        # Lower layers are likelier to have been built already.
+        chance = present * 2 * (1 - layer / float(depth))
+        for output_path in deriv.output_mapping.values():
+            if rand.random() < chance:
+                os.mkdir(output_path)
+            elif rand.random() < cached:
+                with open(os.path.join(cache, path_hash(output_path)
+                                       + ".narinfo"), "w") as f:
+                    f.write("StorePath: {}\n".format(output_path))
+    roots = [d.path for l in layers for d in l if d.path not in used]
+    with open(os.path.join(directory, "roots"), "w") as f:
+        f.write("".join(path + "\n" for path in roots))
+    with open(os.path.join(directory, "corpus.json"), "w") as f:
+        json.dump(parameters, f, indent=2, sort_keys=True)
+    return parameters
+
+
+class _CacheHandler(http.server.SimpleHTTPRequestHandler):
+    # Keep connections open, as real binary caches do.
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+
+class _CacheServer(http.server.ThreadingHTTPServer):
+    # Clients open several connections at once; with the default backlog
+    # of 5, some get dropped and retried a second later.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve_cache(directory):
+    """Serve a corpus's binary cache over HTTP, in a background thread.
+
+    :param directory: The corpus directory.
+    :type directory: ``str``
+
+    :return: The server, and its URL. Call ``shutdown()`` on the server
+        when done.
+    :rtype: (``http.server.ThreadingHTTPServer``, ``str``)
+    """
+    cache = os.path.join(directory, "cache")
+
+    def handler(*args, **kwargs):
+        return _CacheHandler(*args, directory=cache, **kwargs)
+
+    server = _CacheServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    for name, default in sorted(DEFAULTS.items()):
+        parser.add_argument("--" + name.replace("_", "-"),
+                            type=type(default), default=default)
+    args = parser.parse_args()
+    if os.path.exists(args.directory) and os.listdir(args.directory):
+        sys.exit("{} isn't empty".format(args.directory))
+    parameters = generate_corpus(
+        args.directory, **{name: getattr(args, name) for name in DEFAULTS})
+    print("Generated {count} derivations in {depth} layers".format(
+        **parameters))
+
+
+if __name__ == "__main__":
+    main()
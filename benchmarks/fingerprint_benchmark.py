@@ -0,0 +1,95 @@
+"""Time fingerprinting against recursive diffing for equivalence checks.
+
+Usage:
+
+    python benchmarks/fingerprint_benchmark.py [--size N] [--fan-in N]
+
+Two copies of the same synthetic closure are built in memory, differing
+only in the hashes of their store paths. Each derivation of one copy is
+then checked against its counterpart in the other, first by
+fingerprint and then with ``diff_recursive``.
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from nix_derivation_tools.cache import cache_scope, get_cache
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.derivation_diff import diff_recursive
+from nix_derivation_tools.fingerprint import equivalent, fingerprint
+
+STORE = "/nonexistent/store"
+ALPHABET = "0123456789abcdfghijklmnpqrsvwxyz"
+
+
+def store_path(salt, name):
+    digest = hashlib.sha256((salt + name).encode("utf-8")).digest()
+    return "{}/{}-{}".format(STORE, "".join(ALPHABET[b % 32]
+                                            for b in digest[:32]), name)
+
+
+def build_closure(salt, size, fan_in):
+    """Create a closure of ``size`` derivations, each using up to
+    ``fan_in`` earlier ones, with store hashes depending on ``salt``.
+
+    :return: The derivations, in creation order.
+    :rtype: ``list`` of :py:class:`Derivation`
+    """
+    rand = random.Random(0)
+    derivs = []
+    for i in range(size):
+        name = "pkg-{}".format(i)
+        inputs = rand.sample(derivs, min(i, fan_in))
+        out = store_path(salt, name)
+        environment = {"name": name, "out": out,
+                       "buildInputs": " ".join(d.outputs["out"]
+                                               for d in inputs)}
+        deriv = Derivation(
+            path=store_path(salt, name + ".drv"), raw=None,
+            outputs={"out": out},
+            input_derivations={d.path: ["out"] for d in inputs},
+            input_files=set(), system="x86_64-linux", builder="/bin/sh",
+            builder_args=["-c", "echo " + name], environment=environment)
+        get_cache().put(deriv.path, deriv)
+        derivs.append(deriv)
+    return derivs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=5000)
+    parser.add_argument("--fan-in", type=int, default=5)
+    args = parser.parse_args()
+
+    with cache_scope():
+        left = build_closure("a", args.size, args.fan_in)
+        right = build_closure("b", args.size, args.fan_in)
+
+        start = time.perf_counter()
+        for deriv in left + right:
+            fingerprint(deriv)
+        elapsed = time.perf_counter() - start
+        print("fingerprint: {} derivations in {:.3f} s".format(
+            2 * args.size, elapsed))
+
+        start = time.perf_counter()
+        same = sum(equivalent(l, r) for l, r in zip(left, right))
+        elapsed = time.perf_counter() - start
+        print("compare by fingerprint: {} of {} pairs equivalent in "
+              "{:.6f} s".format(same, args.size, elapsed))
+
+        start = time.perf_counter()
+        same = sum(len(diff_recursive(l, r).causes) == 0
+                   for l, r in zip(left[-100:], right[-100:]))
+        elapsed = time.perf_counter() - start
+        print("compare by diff_recursive: {} of 100 pairs equivalent in "
+              "{:.3f} s".format(same, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Measure how long each derivtool command spends importing modules.
+
+Usage:
+
+    python benchmarks/import_benchmark.py [--repeat N] [--budget-ms MS]
+
+Each command is run on a couple of small derivation files under
+``python -X importtime``, and the total import time (the best of
+``--repeat`` runs) is reported along with the slowest top-level
+imports. The run fails if a command imports a module it shouldn't need
+(e.g. YAML for ``show --json``), or takes longer than ``--budget-ms`` to
+import everything.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from nix_derivation_tools.derivation import Derivation
+
+# Slow imports which most commands have no use for.
+HEAVY = {"yaml", "rtyaml", "asyncio", "ssl", "multiprocessing",
+         "sqlite3"}
+
+# Name, arguments (with {a} and {b} standing for derivation files), and
+# modules which mustn't be imported.
+COMMANDS = [
+    ("show -e", ["show", "-e", "name", "{a}"], HEAVY),
+    ("show -A", ["show", "-A", "outputs", "--json", "{a}"], HEAVY),
+    ("show --json", ["show", "--json", "{a}"], HEAVY),
+    ("show --ndjson", ["show", "--ndjson", "{a}", "{b}"], HEAVY),
+    ("show --yaml", ["show", "--yaml", "{a}"], HEAVY - {"yaml"}),
+    ("diff", ["diff", "{a}", "{b}"], HEAVY),
+    ("sdiff", ["sdiff", "{a}", "{b}"], HEAVY),
+    ("closure", ["closure", "{b}"], HEAVY),
+    ("fingerprint", ["fingerprint", "{b}"], HEAVY),
+    ("preview", ["preview", "--store-check", "stat", "{b}"], HEAVY),
+]
+
+
+def write_derivations(directory):
+    """Write two derivation files, the second using the first.
+
+    :return: Their paths.
+    :rtype: ``tuple`` of ``str``
+    """
+    paths = []
+    for name in ("first", "second"):
+        out = os.path.join(directory, "0" * 32 + "-" + name)
+        deriv = Derivation(
+            path=out + ".drv", raw=None, outputs={"out": out},
+            input_derivations={p: ["out"] for p in paths},
+            input_files=set(), system="x86_64-linux", builder="/bin/sh",
+            builder_args=["-c", "true"],
+            environment={"name": name, "out": out})
+        with open(deriv.path, "w") as f:
+            f.write(deriv.unparse())
+        paths.append(deriv.path)
+    return tuple(paths)
+
+
+def import_times(arguments):
+    """Run derivtool with ``-X importtime``.
+
+    :return: The cumulative import time of each top-level import, in
+        microseconds, and the names of all modules imported.
+    :rtype: (``dict`` of ``str`` to ``int``, ``set`` of ``str``)
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [SRC] + [p for p in [env.get("PYTHONPATH")] if p])
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m",
+         "nix_derivation_tools.cli"] + arguments,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env,
+        universal_newlines=True)
+    top_level, modules = {}, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.add(name.strip())
+        if not name[1:].startswith(" "):
+            top_level[name.strip()] = int(cumulative)
+    if result.returncode != 0:
+        raise RuntimeError("derivtool {} failed:\n{}".format(
+            " ".join(arguments), result.stderr[-2000:]))
+    return top_level, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=None,
+                        help="Fail if a command takes longer than this to "
+                             "import everything.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        default=False,
+                        help="Show the slowest imports of each command.")
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        a, b = write_derivations(directory)
+        for name, arguments, forbidden in COMMANDS:
+            arguments = [arg.format(a=a, b=b) for arg in arguments]
+            best = None
+            for _ in range(args.repeat):
+                top_level, modules = import_times(arguments)
+                if best is None or sum(top_level.values()) < \
+                        sum(best.values()):
+                    best = top_level
+            total = sum(best.values()) / 1000.0
+            print("{:<15} {:8.1f} ms".format(name, total))
+            if args.verbose:
+                slowest = sorted(best.items(), key=lambda i: -i[1])[:5]
+                for module, micros in slowest:
+                    print("    {:<40} {:8.1f} ms".format(module,
+                                                        micros / 1000.0))
+            unwanted = sorted(forbidden & modules)
+            if unwanted:
+                failures.append("{} imports {}".format(
+                    name, ", ".join(unwanted)))
+            if args.budget_ms is not None and total > args.budget_ms:
+                failures.append("{} takes {:.1f} ms to import".format(
+                    name, total))
+    for failure in failures:
+        print("FAIL: " + failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
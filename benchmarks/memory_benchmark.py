@@ -0,0 +1,100 @@
+"""Measure how much memory parsed derivations occupy.
+
+Usage:
+
+    python benchmarks/memory_benchmark.py [-n LIMIT] [PATH ...]
+
+Each PATH may be a ``.drv`` file or a directory to search for them. With
+no paths, ``$NIX_STORE`` (default ``/nix/store``) is used.
+
+Three layouts are compared: the original one (a ``__dict__`` per object,
+the raw text kept, no interning), the current one with ``keep_raw=True``,
+and the current default.
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from nix_derivation_tools.aterm import parse_derivation_text
+from nix_derivation_tools.cache import cache_scope
+from nix_derivation_tools.derivation import Derivation
+
+from parse_benchmark import find_derivations
+
+
+class DictDerivation(object):
+    """Stand-in for the layout used before ``Derivation`` had slots."""
+
+    def __init__(self, path, raw):
+        fields = parse_derivation_text(raw)
+        self.outputs = {name: path_ if algo == "" else (path_, algo, hash_)
+                        for name, path_, algo, hash_ in fields[0]}
+        self.input_derivations = dict(fields[1])
+        self.input_files = set(fields[2])
+        self.system = fields[3]
+        self.builder = fields[4]
+        self.builder_args = fields[5]
+        self.environment = dict(fields[6])
+        self._raw = raw
+        self._path = path
+        self._input_paths = None
+        self._input_derivation_paths = None
+        self._output_mapping = None
+        self._as_dict = None
+
+
+def load_original(paths):
+    result = []
+    for path in paths:
+        with open(path, "rb") as f:
+            result.append(DictDerivation(path, f.read().decode("utf-8")))
+    return result
+
+
+def load_current(paths, keep_raw):
+    return [Derivation.parse_derivation_file(p, keep_raw=keep_raw)
+            for p in paths]
+
+
+def measure(load):
+    """Return the bytes still allocated after ``load()`` returns."""
+    gc.collect()
+    tracemalloc.start()
+    with cache_scope():
+        result = load()
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*",
+                        default=[os.environ.get("NIX_STORE", "/nix/store")])
+    parser.add_argument("-n", "--limit", type=int, default=0,
+                        help="Maximum number of derivations to load.")
+    args = parser.parse_args()
+
+    paths = find_derivations(args.paths, args.limit)
+    if len(paths) == 0:
+        sys.exit("No derivations found")
+    print("{} derivations".format(len(paths)))
+    results = (
+        ("original", measure(lambda: load_original(paths))),
+        ("keep_raw=True", measure(lambda: load_current(paths, True))),
+        ("keep_raw=False", measure(lambda: load_current(paths, False))),
+    )
+    baseline = results[0][1]
+    for label, size in results:
+        print("{:>15}: {:10.0f} bytes/derivation ({:.0%} of original)"
+              .format(label, size / len(paths), size / baseline))
+
+
+if __name__ == "__main__":
+    main()
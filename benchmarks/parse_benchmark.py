@@ -0,0 +1,89 @@
+"""Compare the ATerm parser against the old ``ast.literal_eval`` approach.
+
+Usage:
+
+    python benchmarks/parse_benchmark.py [-n LIMIT] [-r REPEAT] [PATH ...]
+
+Each PATH may be a ``.drv`` file or a directory to search for them. With
+no paths, ``$NIX_STORE`` (default ``/nix/store``) is used.
+"""
+import argparse
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from nix_derivation_tools.aterm import parse_derivation_text
+
+
+def literal_eval_parse(text):
+    """The parsing strategy used before the dedicated ATerm parser."""
+    if text.startswith("Derive(["):
+        text = text[7:-1]
+    return ast.literal_eval(text)
+
+
+def find_derivations(paths, limit):
+    """Collect up to ``limit`` derivation file paths."""
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".drv"):
+                    result.append(os.path.join(path, name))
+        else:
+            result.append(path)
+    return result[:limit] if limit else result
+
+
+def timed(parse, texts, repeat):
+    """Return the best wall time of parsing all ``texts``, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            parse(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*",
+                        default=[os.environ.get("NIX_STORE", "/nix/store")])
+    parser.add_argument("-n", "--limit", type=int, default=0,
+                        help="Maximum number of derivations to load.")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="Number of timing repetitions.")
+    args = parser.parse_args()
+
+    texts = []
+    for path in find_derivations(args.paths, args.limit):
+        with open(path, "rb") as f:
+            texts.append(f.read().decode("utf-8"))
+    if len(texts) == 0:
+        sys.exit("No derivations found")
+    total_bytes = sum(len(t) for t in texts)
+
+    # Both parsers must agree before their speed is worth comparing.
+    for text in texts:
+        if list(literal_eval_parse(text)) != list(parse_derivation_text(text)):
+            sys.exit("Parsers disagree on a derivation")
+
+    print("{} derivations, {:.1f} MiB".format(len(texts),
+                                             total_bytes / 2.0 ** 20))
+    baseline = timed(literal_eval_parse, texts, args.repeat)
+    aterm = timed(parse_derivation_text, texts, args.repeat)
+    for label, seconds in (("ast.literal_eval", baseline),
+                           ("aterm", aterm)):
+        print("{:>18}: {:8.3f} s  {:8.1f} drv/s  {:8.1f} MiB/s".format(
+            label, seconds, len(texts) / seconds,
+            total_bytes / 2.0 ** 20 / seconds))
+    print("Speedup: {:.2f}x".format(baseline / aterm))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""Benchmark the main operations over a generated derivation corpus.
+
+Usage:
+
+    python benchmarks/suite.py [--corpus DIRECTORY] [corpus options]
+        [--scenario NAME ...] [--record FILE] [--compare FILE]
+
+A corpus is generated with ``benchmarks/corpus.py`` (whose options are
+accepted here too) in a temporary directory, or in ``--corpus`` if it
+doesn't exist yet; an existing ``--corpus`` is reused as it is. Its
+store directory is used as ``$NIX_STORE``, and its binary cache is
+served over HTTP from this process.
+
+Each scenario runs in a fresh process, so caches start cold and peak
+memory use can be measured. For each, the suite reports throughput,
+the 50th, 90th and 99th percentile latency of one operation, and the
+peak resident set size of that scenario's process (of the ``derivtool``
+processes, for ``show-cli``):
+
+* ``parse``: ``Derivation.parse_derivation_file`` on every file;
+* ``needed``: ``needed_to_build_multi`` for each root, with the store
+  checked by ``stat``;
+* ``preview``: ``preview_build`` for each root, also querying the
+  binary cache;
+* ``diff``: ``diff_derivations`` between random derivations and copies
+  of them with the last environment variable changed, as a later
+  revision might be, so that every field before it is compared;
+* ``show``: formatting every derivation in the closure of the roots as
+  ``show --ndjson`` does;
+* ``show-cli``: running ``derivtool show --ndjson --closure`` on the
+  roots, as a separate process.
+
+``--record FILE`` appends the results, with the corpus parameters and
+the current git commit, to FILE as a line of JSON. ``--compare FILE``
+shows the change from the last results in FILE for the same corpus.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(BENCHMARKS, "..", "src")
+sys.path.insert(0, SRC)
+
+from corpus import DEFAULTS, generate_corpus, serve_cache
+
+SCENARIOS = ("parse", "needed", "preview", "diff", "show", "show-cli")
+
+# Number of pairs compared by the diff scenario.
+DIFF_PAIRS = 2000
+
+
+def read_roots(directory):
+    with open(os.path.join(directory, "roots")) as f:
+        return f.read().split()
+
+
+def percentile(values, fraction):
+    """The value below which ``fraction`` of ``values`` lie."""
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(latencies, elapsed, **extra):
+    """Summarize the timings of a scenario.
+
+    :param latencies: Seconds taken by each operation.
+    :type latencies: ``list`` of ``float``
+    :param elapsed: Seconds taken by all of them.
+    :type elapsed: ``float``
+
+    :rtype: ``dict``
+    """
+    result = {
+        "operations": len(latencies),
+        "seconds": elapsed,
+        "per_second": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p90_ms": percentile(latencies, 0.9) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+    result.update(extra)
+    return result
+
+
+def timed_each(function, items):
+    """Call a function on each item, timing each call.
+
+    :return: The latency of each call, and the total time.
+    :rtype: (``list`` of ``float``, ``float``)
+    """
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        before = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - before)
+    return latencies, time.perf_counter() - start
+
+
+def run_parse(directory, cache_url):
+    from nix_derivation_tools.derivation import Derivation
+    store = os.path.join(directory, "store")
+    paths = sorted(os.path.join(store, name) for name in os.listdir(store)
+                   if name.endswith(".drv"))
+    size = sum(os.path.getsize(path) for path in paths)
+    latencies, elapsed = timed_each(Derivation.parse_derivation_file, paths)
+    return summarize(latencies, elapsed,
+                     mb_per_second=size / elapsed / 2.0 ** 20)
+
+
+def run_needed(directory, cache_url):
+    from nix_derivation_tools.preview import (
+        needed_to_build_multi, parse_deriv_paths)
+    from nix_derivation_tools.store import StatPresence
+    presence = StatPresence()
+
+    def needed(root):
+        needed_to_build_multi(parse_deriv_paths([root]), presence=presence)
+
+    return summarize(*timed_each(needed, read_roots(directory)))
+
+
+def run_preview(directory, cache_url):
+    from nix_derivation_tools.preview import preview_build
+    from nix_derivation_tools.store import StatPresence
+    from nix_derivation_tools.substituters import SubstituterClient
+    presence = StatPresence()
+    client = SubstituterClient([cache_url])
+    try:
+        return summarize(*timed_each(
+            lambda root: preview_build([root], client=client,
+                                       presence=presence),
+            read_roots(directory)))
+    finally:
+        client.close()
+
+
+def _perturbed(path):
+    """Parse a derivation file, and a copy of it with the last
+    environment variable (in the file's order) changed."""
+    from nix_derivation_tools.aterm import (
+        parse_derivation_text, unparse_derivation_fields)
+    from nix_derivation_tools.derivation import Derivation
+    with open(path) as f:
+        text = f.read()
+    fields = parse_derivation_text(text)
+    environment = list(fields[6])
+    key, value = environment[-1]
+    environment[-1] = (key, value + " changed")
+    changed = unparse_derivation_fields(fields[:6] + (environment,))
+    return (Derivation.parse_derivation(text, path),
+            Derivation.parse_derivation(changed, path))
+
+
+def run_diff(directory, cache_url):
+    from nix_derivation_tools.derivation_diff import diff_derivations
+    store = os.path.join(directory, "store")
+    paths = sorted(os.path.join(store, name) for name in os.listdir(store)
+                   if name.endswith(".drv"))
+    rand = random.Random(0)
+    pairs = [_perturbed(rand.choice(paths)) for _ in range(DIFF_PAIRS)]
+
+    def diff(pair):
+        result = diff_derivations(*pair)
+        assert result[0] == "environment", result
+
+    return summarize(*timed_each(diff, pairs))
+
+
+def run_show(directory, cache_url):
+    from nix_derivation_tools.bulk import format_derivation
+    from nix_derivation_tools.closure import load_closure
+    derivs = list(load_closure(read_roots(directory)).values())
+    return summarize(*timed_each(format_derivation, derivs))
+
+
+def run_show_cli(directory, cache_url):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [SRC] + [p for p in [os.environ.get("PYTHONPATH")] if p]))
+    latencies = []
+    for _ in range(3):
+        before = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "nix_derivation_tools.cli", "--no-server",
+             "show", "--ndjson", "--closure"] + read_roots(directory),
+            stdout=subprocess.DEVNULL, env=env, check=True)
+        latencies.append(time.perf_counter() - before)
+    return summarize(latencies, sum(latencies),
+                     child_max_rss_mb=_max_rss(resource.RUSAGE_CHILDREN))
+
+
+RUNNERS = {
+    "parse": run_parse,
+    "needed": run_needed,
+    "preview": run_preview,
+    "diff": run_diff,
+    "show": run_show,
+    "show-cli": run_show_cli,
+}
+
+
+def _max_rss(who):
+    # Linux reports kilobytes, macOS bytes.
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 2.0 ** 20 if sys.platform == "darwin" else rss / 1024.0
+
+
+def run_scenario(name, directory, cache_url):
+    """Run a scenario in a new process.
+
+    :return: Its results.
+    :rtype: ``dict``
+    """
+    env = dict(os.environ,
+               NIX_STORE=os.path.abspath(os.path.join(directory, "store")))
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-scenario", name,
+         "--corpus", directory, "--cache-url", cache_url],
+        stdout=subprocess.PIPE, env=env, check=True,
+        universal_newlines=True)
+    return json.loads(result.stdout)
+
+
+def git_commit():
+    """The current commit, and whether the tree has changes.
+
+    :rtype: (``str`` or ``NoneType``, ``bool``)
+    """
+    def git(*args):
+        return subprocess.run(["git"] + list(args), cwd=BENCHMARKS,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    try:
+        return (git("rev-parse", "HEAD") or None,
+                git("status", "--porcelain", "--untracked-files=no") != "")
+    except OSError:
+        return None, False
+
+
+def previous_record(path, corpus):
+    """The last record in a file with the same corpus parameters."""
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("corpus") == corpus:
+                previous = record
+    return previous
+
+
+def print_results(results, previous=None):
+    print("{:<10} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9}".format(
+        "scenario", "ops", "ops/s", "p50 ms", "p90 ms", "p99 ms",
+        "RSS MiB"))
+    for name, result in results.items():
+        line = "{:<10} {:>8} {:>10.1f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.1f}" \
+            .format(name, result["operations"], result["per_second"],
+                    result["p50_ms"], result["p90_ms"], result["p99_ms"],
+                    result.get("child_max_rss_mb", result["max_rss_mb"]))
+        before = (previous or {}).get("results", {}).get(name)
+        if before is not None and before["per_second"]:
+            line += "  {:+.1f}% ops/s, {:+.1f}% p50".format(
+                100.0 * (result["per_second"] / before["per_second"] - 1),
+                100.0 * (result["p50_ms"] / before["p50_ms"] - 1))
+        print(line)
+    if previous is not None:
+        print("Compared with {} ({})".format(
+            (previous.get("commit") or "unknown")[:12], previous["time"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=None,
+                        help="Corpus directory, generated if missing.")
+    for name, default in sorted(DEFAULTS.items()):
+        parser.add_argument("--" + name.replace("_", "-"),
+                            type=type(default), default=default)
+    parser.add_argument("-s", "--scenario", action="append",
+                        choices=SCENARIOS,
+                        help="Scenario to run (default: all of them).")
+    parser.add_argument("--record", default=None,
+                        help="File to append the results to.")
+    parser.add_argument("--compare", default=None,
+                        help="File of earlier results to compare with.")
+    # Used when running a scenario in a child process.
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--cache-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        result = RUNNERS[args.run_scenario](args.corpus, args.cache_url)
+        result["max_rss_mb"] = _max_rss(resource.RUSAGE_SELF)
+        json.dump(result, sys.stdout)
+        return
+
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = args.corpus or os.path.join(temporary, "corpus")
+        if os.path.exists(os.path.join(directory, "corpus.json")):
+            with open(os.path.join(directory, "corpus.json")) as f:
+                corpus = json.load(f)
+        else:
+            print("Generating corpus in {}".format(directory),
+                  file=sys.stderr)
+            corpus = generate_corpus(directory, **{
+                name: getattr(args, name) for name in DEFAULTS})
+        server, cache_url = serve_cache(directory)
+        try:
+            results = {}
+            for name in args.scenario or SCENARIOS:
+                results[name] = run_scenario(name, directory, cache_url)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    previous = None
+    if args.compare:
+        previous = previous_record(args.compare, corpus)
+    print_results(results, previous)
+    if args.record:
+        commit, dirty = git_commit()
+        record = {"commit": commit, "dirty": dirty,
+                  "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "python": sys.version.split()[0], "corpus": corpus,
+                  "results": results}
+        with open(args.record, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Time ``needed_to_build_multi`` on synthetic dependency graphs.
+
+Usage:
+
+    python benchmarks/traversal_benchmark.py [--depth N] [--width N]
+
+Two graphs are built in memory, with no output present on disk:
+
+* deep: a chain of ``--depth`` derivations, each depending on the next
+  one through two outputs;
+* wide: ``--width`` leaf derivations, all depending on each of
+  ``--layers`` layers of ``--fan-out`` shared derivations.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from nix_derivation_tools.cache import cache_scope, get_cache
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.preview import needed_to_build_multi
+
+STORE = "/nonexistent/store"
+
+
+def make_derivation(name, inputs):
+    """Create a derivation with outputs 'out' and 'dev', and put it in
+    the cache so that traversals can find it by path.
+
+    :param inputs: Derivations this one depends on.
+    :type inputs: ``list`` of :py:class:`Derivation`
+    """
+    outputs = {out: "{}/{}-{}".format(STORE, name, out)
+               for out in ("out", "dev")}
+    path = "{}/{}.drv".format(STORE, name)
+    deriv = Derivation(
+        path=path, raw=None, outputs=outputs,
+        input_derivations={i.path: ["out", "dev"] for i in inputs},
+        input_files=set(), system="x86_64-linux", builder="/bin/sh",
+        builder_args=[], environment=dict(outputs, name=name))
+    get_cache().put(path, deriv)
+    return deriv
+
+
+def deep_graph(depth):
+    deriv = make_derivation("deep-0", [])
+    for i in range(1, depth):
+        deriv = make_derivation("deep-{}".format(i), [deriv])
+    return {deriv: {"out"}}
+
+
+def wide_graph(width, layers, fan_out):
+    below = []
+    for layer in range(layers):
+        below = [make_derivation("layer-{}-{}".format(layer, i), below)
+                 for i in range(fan_out)]
+    return {make_derivation("leaf-{}".format(i), below): {"out"}
+            for i in range(width)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--depth", type=int, default=10000)
+    parser.add_argument("--width", type=int, default=10000)
+    parser.add_argument("--layers", type=int, default=5)
+    parser.add_argument("--fan-out", type=int, default=20)
+    args = parser.parse_args()
+
+    for label, build in (
+            ("deep", lambda: deep_graph(args.depth)),
+            ("wide", lambda: wide_graph(args.width, args.layers,
+                                        args.fan_out))):
+        with cache_scope():
+            roots = build()
+            start = time.perf_counter()
+            needed, _ = needed_to_build_multi(roots)
+            elapsed = time.perf_counter() - start
+        nodes = sum(len(outs) for outs in needed.values())
+        print("{}: {} outputs needed in {:.3f} s ({:.0f} outputs/s)".format(
+            label, nodes, elapsed, nodes / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""Parsing of derivations serialized in Nix's ATerm format.
+
+A derivation file looks like this (whitespace added for readability):
+
+    Derive([("out","/nix/store/...-foo","","")],
+           [("/nix/store/...-bar.drv",["out"])],
+           ["/nix/store/...-builder.sh"],
+           "x86_64-linux",
+           "/nix/store/...-bash/bin/bash",
+           ["-e","/nix/store/...-builder.sh"],
+           [("name","foo"),("out","/nix/store/...-foo")])
+
+Only strings, lists and tuples appear in it, so rather than going
+through a general-purpose parser we scan the text once, left to right,
+using ``str.find`` and a regular expression to skip over string
+contents in bulk. :py:func:`unparse_derivation_fields` writes the
+format back out.
+"""
+import re
+
+# A string that may contain escape sequences. Nix understands \n, \r and
+# \t; any other character following a backslash stands for itself.
+_ESCAPED_STRING = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"', re.DOTALL)
+_ESCAPE = re.compile(r"\\(.)", re.DOTALL)
+_ESCAPES = {"n": "\n", "r": "\r", "t": "\t"}
+
+
+class ATermParseError(ValueError):
+    """Raised when a derivation string is not valid ATerm."""
+
+    def __init__(self, message, text, position):
+        """Initializer.
+
+        :param message: Description of what went wrong.
+        :type message: ``str``
+        :param text: The text being parsed.
+        :type text: ``str``, ``bytes`` or ``mmap.mmap``
+        :param position: Offset in ``text`` at which the error occurred.
+        :type position: ``int``
+        """
+        self.message = message
+        self.position = position
+        newline = "\n"
+        if not isinstance(text, str):
+            text, newline = bytes(text[:position]), b"\n"
+        self.line = text.count(newline, 0, position) + 1
+        self.column = position - text.rfind(newline, 0, position)
+        super(ATermParseError, self).__init__(
+            "{} at line {}, column {} (offset {})"
+            .format(message, self.line, self.column, position))
+
+
+def _expect(text, pos, char):
+    """Consume ``char`` at ``pos``, returning the position after it."""
+    if text[pos] != char:
+        raise ATermParseError("Expected {} but found {}"
+                              .format(repr(char), repr(text[pos])),
+                              text, pos)
+    return pos + 1
+
+
+def _string(text, pos):
+    """Parse a double-quoted string starting at ``pos``.
+
+    :return: The decoded string and the position after the closing quote.
+    :rtype: (``str``, ``int``)
+    """
+    if text[pos] != '"':
+        raise ATermParseError("Expected a string but found {}"
+                              .format(repr(text[pos])), text, pos)
+    start = pos + 1
+    end = text.find('"', start)
+    if end == -1:
+        raise ATermParseError("Unterminated string", text, pos)
+    if text.find("\\", start, end) == -1:
+        # Fast path: no escapes, so the string is a plain slice.
+        return text[start:end], end + 1
+    match = _ESCAPED_STRING.match(text, pos)
+    if match is None:
+        raise ATermParseError("Unterminated string", text, pos)
+    return _unescape(match.group(1)), match.end()
+
+
+def _unescape(body):
+    """Decode the escape sequences in the body of a string."""
+    if "\0" in body:
+        # Can't happen for strings written by Nix, but be correct anyway.
+        return _ESCAPE.sub(lambda m: _ESCAPES.get(m.group(1), m.group(1)),
+                           body)
+    # Hide escaped backslashes first, so that every backslash left over
+    # starts one of the other escape sequences.
+    result = (body.replace("\\\\", "\0")
+              .replace("\\n", "\n").replace("\\t", "\t")
+              .replace("\\r", "\r").replace('\\"', '"'))
+    if "\\" in result:
+        result = _ESCAPE.sub(r"\1", result)
+    return result.replace("\0", "\\")
+
+
+def _list(text, pos, item):
+    """Parse a bracketed, comma-separated list of items.
+
+    :param item: Function parsing a single element, with the same
+        calling convention as this function.
+    :type item: ``function``
+
+    :return: The parsed elements and the position after the list.
+    :rtype: (``list``, ``int``)
+    """
+    pos = _expect(text, pos, "[")
+    result = []
+    if text[pos] == "]":
+        return result, pos + 1
+    while True:
+        value, pos = item(text, pos)
+        result.append(value)
+        char = text[pos]
+        if char == "]":
+            return result, pos + 1
+        if char != ",":
+            raise ATermParseError("Expected ',' or ']' but found {}"
+                                  .format(repr(char)), text, pos)
+        pos += 1
+
+
+def _string_list(text, pos):
+    """Parse a list of strings."""
+    return _list(text, pos, _string)
+
+
+def _output(text, pos):
+    """Parse an output tuple: ``(name, path, hash algorithm, hash)``."""
+    pos = _expect(text, pos, "(")
+    name, pos = _string(text, pos)
+    pos = _expect(text, pos, ",")
+    path, pos = _string(text, pos)
+    pos = _expect(text, pos, ",")
+    hash_algo, pos = _string(text, pos)
+    pos = _expect(text, pos, ",")
+    hash_, pos = _string(text, pos)
+    pos = _expect(text, pos, ")")
+    return (name, path, hash_algo, hash_), pos
+
+
+def _input_derivation(text, pos):
+    """Parse an input derivation tuple: ``(path, [output names])``."""
+    pos = _expect(text, pos, "(")
+    path, pos = _string(text, pos)
+    pos = _expect(text, pos, ",")
+    outputs, pos = _string_list(text, pos)
+    pos = _expect(text, pos, ")")
+    return (path, outputs), pos
+
+
+def _pair(text, pos):
+    """Parse a tuple of two strings (an environment variable)."""
+    pos = _expect(text, pos, "(")
+    key, pos = _string(text, pos)
+    pos = _expect(text, pos, ",")
+    value, pos = _string(text, pos)
+    pos = _expect(text, pos, ")")
+    return (key, value), pos
+
+
+# Parsers for each top-level field of a derivation, in order.
+FIELD_PARSERS = (
+    lambda text, pos: _list(text, pos, _output),
+    lambda text, pos: _list(text, pos, _input_derivation),
+    _string_list,
+    _string,
+    _string,
+    _string_list,
+    lambda text, pos: _list(text, pos, _pair),
+)
+
+
+# Matches a whole string, or a bracket or parenthesis outside of one.
+_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]()]', re.DOTALL)
+# The same over undecoded bytes. The characters that matter here are all
+# ASCII, and bytes of multi-byte UTF-8 characters never look like them.
+_BYTES_TOKEN = re.compile(_TOKEN.pattern.encode("ascii"), re.DOTALL)
+
+
+class FieldIndex(object):
+    """Locates and parses top-level fields of a derivation on demand.
+
+    Fields are found by skipping over the ones before them without
+    decoding anything, so reading e.g. only the builder is much cheaper
+    than parsing the whole derivation.
+
+    The text may also be undecoded bytes, such as a memory-mapped file,
+    in which case only the fields actually parsed are ever decoded.
+    """
+
+    def __init__(self, text):
+        """Initializer.
+
+        :param text: Contents of a derivation file.
+        :type text: ``str``, ``bytes`` or ``mmap.mmap``
+        """
+        self.text = text
+        self._binary = not isinstance(text, str)
+        prefix = b"Derive(" if self._binary else "Derive("
+        # Offsets at which each field located so far starts.
+        self._starts = [7 if text[:7] == prefix else 0]
+
+    @property
+    def source(self):
+        """The whole text, decoded if necessary.
+
+        :rtype: ``str``
+        """
+        if self._binary:
+            return bytes(self.text).decode("utf-8")
+        return self.text
+
+    def start(self, index):
+        """Return the offset at which a field starts.
+
+        :param index: Position of the field, as in
+            :py:func:`parse_derivation_text`.
+        :type index: ``int``
+
+        :rtype: ``int``
+        """
+        text, starts = self.text, self._starts
+        comma = b"," if self._binary else ","
+        while len(starts) <= index:
+            pos = self._skip(starts[-1])
+            if text[pos:pos + 1] != comma:
+                if pos >= len(text):
+                    raise ATermParseError("Unexpected end of input", text,
+                                          len(text))
+                raise ATermParseError("Expected ','", text, pos)
+            starts.append(pos + 1)
+        return starts[index]
+
+    def _skip(self, pos):
+        """Return the offset just after the value starting at ``pos``."""
+        text = self.text
+        tokens = _BYTES_TOKEN if self._binary else _TOKEN
+        if self._binary:
+            opening, closing = (b"[", b"("), (b"]", b")")
+        else:
+            opening, closing = ("[", "("), ("]", ")")
+        depth = 0
+        for match in tokens.finditer(text, pos):
+            if depth == 0 and match.start() != pos:
+                break
+            token = match.group()
+            if token in opening:
+                depth += 1
+            elif token in closing:
+                depth -= 1
+                if depth < 0:
+                    break
+            if depth == 0:
+                return match.end()
+        if pos >= len(text):
+            raise ATermParseError("Unexpected end of input", text, len(text))
+        raise ATermParseError("Expected a string or list", text, pos)
+
+    def parse(self, index):
+        """Parse a single field.
+
+        :param index: Position of the field, as in
+            :py:func:`parse_derivation_text`.
+        :type index: ``int``
+
+        :return: The field, in the form returned by
+            :py:func:`parse_derivation_text`.
+        """
+        start = self.start(index)
+        if not self._binary:
+            try:
+                return FIELD_PARSERS[index](self.text, start)[0]
+            except IndexError:
+                raise ATermParseError("Unexpected end of input", self.text,
+                                      len(self.text))
+        # Decode just this field, and parse it on its own.
+        end = self._skip(start)
+        field = bytes(self.text[start:end]).decode("utf-8")
+        try:
+            return FIELD_PARSERS[index](field, 0)[0]
+        except ATermParseError as e:
+            position = start + len(field[:e.position].encode("utf-8"))
+            message = e.message
+        except IndexError:
+            position, message = end, "Unexpected end of input"
+        raise ATermParseError(message, self.text, position)
+
+
+def parse_derivation_text(text):
+    """Parse the ATerm representation of a derivation.
+
+    The leading ``Derive(`` and trailing ``)`` are optional, so that the
+    bare field tuple is accepted as well.
+
+    :param text: Contents of a derivation file.
+    :type text: ``str``
+
+    :return: The seven fields of the derivation, in file order: outputs
+        (a list of ``(name, path, hash_algo, hash)`` tuples), input
+        derivations (a list of ``(path, [output names])`` tuples), input
+        sources, system, builder, builder arguments, and environment (a
+        list of ``(key, value)`` tuples).
+    :rtype: ``tuple``
+
+    :raises: :py:class:`ATermParseError` if the text is malformed.
+    """
+    if text.startswith("Derive("):
+        pos, closing = 7, True
+    else:
+        pos, closing = 0, False
+    fields = []
+    try:
+        for index, parser in enumerate(FIELD_PARSERS):
+            if index > 0:
+                pos = _expect(text, pos, ",")
+            value, pos = parser(text, pos)
+            fields.append(value)
+        if closing:
+            pos = _expect(text, pos, ")")
+    except IndexError:
+        raise ATermParseError("Unexpected end of input", text, len(text))
+    if text[pos:].strip() != "":
+        raise ATermParseError("Trailing characters after derivation",
+                              text, pos)
+    return tuple(fields)
+
+
+def _quote(string):
+    """Serialize a string as Nix does."""
+    if "\\" in string or '"' in string or "\n" in string or \
+            "\r" in string or "\t" in string:
+        string = (string.replace("\\", "\\\\").replace('"', '\\"')
+                  .replace("\n", "\\n").replace("\r", "\\r")
+                  .replace("\t", "\\t"))
+    return '"' + string + '"'
+
+
+def _quote_list(strings):
+    return "[" + ",".join(map(_quote, strings)) + "]"
+
+
+def unparse_derivation_fields(fields):
+    """Serialize a derivation to ATerm; the inverse of
+    :py:func:`parse_derivation_text`.
+
+    Nothing is reordered, so to get what Nix would write the outputs,
+    input derivations (and their outputs), input sources and environment
+    must be sorted.
+
+    :param fields: The seven fields, as returned by
+        :py:func:`parse_derivation_text`.
+    :type fields: ``tuple``
+
+    :return: The derivation, including ``Derive(`` and ``)``.
+    :rtype: ``str``
+    """
+    outputs, input_derivations, sources, system, builder, args, env = fields
+    return "".join([
+        "Derive([",
+        ",".join("(" + ",".join(map(_quote, output)) + ")"
+                 for output in outputs),
+        "],[",
+        ",".join("(" + _quote(path) + "," + _quote_list(outs) + ")"
+                 for path, outs in input_derivations),
+        "],",
+        _quote_list(sources), ",",
+        _quote(system), ",",
+        _quote(builder), ",",
+        _quote_list(args),
+        ",[",
+        ",".join("(" + _quote(key) + "," + _quote(value) + ")"
+                 for key, value in env),
+        "])",
+    ])
@@ -0,0 +1,169 @@
+"""Processing and showing many derivations in one go.
+
+Derivations are parsed and processed one at a time (or a chunk at a
+time, spread over worker processes) and each result is handed back as
+soon as it's ready, so output starts straight away and memory use
+doesn't grow with the number of derivations. When walking a closure,
+only the paths seen so far are remembered.
+
+In NDJSON format each derivation becomes one line holding a JSON
+object: its fields and ``path``, or, when showing a single attribute or
+environment variable, just ``path`` and ``value``.
+"""
+import json
+import os
+from collections import deque
+from functools import partial
+
+from nix_derivation_tools.cache import normalize_derivation_path
+from nix_derivation_tools.derivation import Derivation
+
+# Number of derivations handed to a worker process at a time.
+CHUNK_SIZE = 64
+
+
+def format_derivation(deriv, attribute=None, env_var=None, format="ndjson",
+                      pretty=False):
+    """Format a derivation for output.
+
+    :param format: ``ndjson``, or one of the formats accepted by
+        :py:meth:`Derivation.display`.
+    :type format: ``str``
+
+    The other parameters are as for :py:meth:`Derivation.display`.
+
+    :rtype: ``str``
+    """
+    if format != "ndjson":
+        return deriv.display(attribute=attribute, env_var=env_var,
+                             format=format, pretty=pretty)
+    if attribute is not None:
+        value = getattr(deriv, attribute)
+        if isinstance(value, set):
+            value = sorted(value)
+        record = {"path": deriv.path, "value": value}
+    elif env_var is not None:
+        record = {"path": deriv.path,
+                  "value": deriv.environment.get(env_var)}
+    else:
+        record = dict(deriv.as_dict, path=deriv.path)
+    return json.dumps(record, sort_keys=True)
+
+
+def _map_chunk(function, paths, lazy, closure):
+    """Parse some derivations and apply a function to each, possibly in
+    a worker process.
+
+    :return: The result for each derivation, and, if ``closure`` is
+        set, the paths of its input derivations.
+    :rtype: ``list`` of (``object``, ``list`` of ``str`` or ``NoneType``)
+    """
+    results = []
+    for path in paths:
+        deriv = Derivation.parse_derivation_file(path, lazy=lazy)
+        inputs = list(deriv.input_derivations) if closure else None
+        results.append((function(deriv), inputs))
+    return results
+
+
+def map_derivations(function, paths, closure=False, jobs=1, lazy=False):
+    """Apply a function to many derivations, yielding each result as
+    soon as it's ready.
+
+    :param function: Called with each :py:class:`Derivation`. With
+        more than one job, it must be picklable (e.g. a module-level
+        function or a ``functools.partial`` of one), as must its
+        results.
+    :type function: ``callable``
+    :param paths: Paths to derivation files. This can be a generator,
+        which is consumed only as fast as the output is.
+    :type paths: iterable of ``str``
+    :param closure: Also include everything the derivations depend on,
+        each once, in breadth-first order.
+    :type closure: ``bool``
+    :param jobs: Number of processes to use. Defaults to the number of
+        CPUs; with 1, everything is done in this process.
+    :type jobs: ``int`` or ``NoneType``
+    :param lazy: Parse derivations lazily, as for
+        :py:meth:`Derivation.parse_derivation_file`.
+    :type lazy: ``bool``
+
+    :return: The result for each derivation, in order.
+    :rtype: iterator
+    """
+    jobs = jobs or os.cpu_count() or 1
+    paths = iter(paths)
+    # Inputs found but not yet processed, and everything queued so far.
+    queue, seen = deque(), set()
+    chunk_size = 1 if jobs == 1 else CHUNK_SIZE
+
+    def next_chunk():
+        chunk = []
+        while len(chunk) < chunk_size:
+            if len(queue) > 0:
+                chunk.append(queue.popleft())
+                continue
+            path = next(paths, None)
+            if path is None:
+                break
+            if closure:
+                path = normalize_derivation_path(path)
+                if path in seen:
+                    continue
+                seen.add(path)
+            chunk.append(path)
+        return chunk
+
+    executor = None
+    if jobs > 1:
+        # Importing multiprocessing costs more than showing a derivation.
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(jobs)
+    pending = deque()
+    try:
+        while True:
+            # Keep a couple of chunks per process in flight, no more.
+            while len(pending) < 2 * jobs:
+                chunk = next_chunk()
+                if len(chunk) == 0:
+                    break
+                if executor is None:
+                    pending.append(_map_chunk(function, chunk, lazy,
+                                              closure))
+                else:
+                    pending.append(executor.submit(_map_chunk, function,
+                                                   chunk, lazy, closure))
+            if len(pending) == 0:
+                break
+            results = pending.popleft()
+            if executor is not None:
+                results = results.result()
+            for result, inputs in results:
+                yield result
+                for path in inputs or ():
+                    if path not in seen:
+                        seen.add(path)
+                        queue.append(path)
+    finally:
+        if executor is not None:
+            # If we're stopped early, don't finish the work queued up.
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+
+
+def show_derivations(paths, closure=False, jobs=1, **options):
+    """Format many derivations, yielding each as soon as it's done.
+
+    :param options: Passed to :py:func:`format_derivation`.
+
+    The other parameters are as for :py:func:`map_derivations`.
+
+    :return: The text for each derivation, in order.
+    :rtype: iterator of ``str``
+    """
+    # When showing a single field, don't bother decoding the rest.
+    lazy = options.get("attribute") is not None or \
+        options.get("env_var") is not None
+    return map_derivations(partial(format_derivation, **options), paths,
+                           closure=closure, jobs=jobs, lazy=lazy)
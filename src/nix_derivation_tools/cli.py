@@ -1,24 +1,108 @@
 """CLI providing some useful derivation-related utilities."""
 
 import argparse
+import json
 import os
+import signal
 import sys
 
-from nix_derivation_tools.derivation import Derivation
-from nix_derivation_tools.derivation_diff import diff_derivations
-from nix_derivation_tools.preview import print_preview
+# Only what's needed to parse the command line is imported here; each
+# command imports the rest itself, since some of it (YAML, asyncio,
+# multiprocessing, SQLite, ...) takes longer to import than small
+# commands take to run.
 
-def get_args():
+
+def parse_size(size):
+    """Parse a size such as ``500M`` into a number of bytes."""
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+    size = size.strip().upper().rstrip("B")
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def read_paths(paths):
+    """Return paths given as arguments, or else read from stdin."""
+    if len(paths) > 0:
+        return paths
+    elif not sys.stdin.isatty():
+        return [p.strip() for p in sys.stdin if p.strip()]
+    else:
+        sys.exit("No path arguments given")
+
+
+def graph_roots(paths, args):
+    """Return some derivations (and GC roots if asked)."""
+    roots = [p.split("!")[0] for p in paths]
+    if args.gc_roots:
+        from nix_derivation_tools.store import gc_root_derivations
+        try:
+            roots.extend(sorted(gc_root_derivations()))
+        except ValueError as e:
+            sys.exit(str(e))
+    elif len(roots) == 0:
+        roots = [p.split("!")[0] for p in read_paths([])]
+    return roots
+
+
+def iter_paths(paths):
+    """Like :py:func:`read_paths`, but read stdin as it's needed."""
+    if len(paths) == 0 and not sys.stdin.isatty():
+        return (p.strip() for p in sys.stdin if p.strip())
+    return read_paths(paths)
+
+
+def load_graph(paths, args):
+    """Build the graph of some derivations (and GC roots if asked)."""
+    from nix_derivation_tools.graph import DerivationGraph
+    return DerivationGraph.from_roots(graph_roots(paths, args),
+                                      jobs=args.jobs)
+
+
+def read_roots(path):
+    """Return a derivation path, or the paths listed in a file."""
+    if path.endswith(".drv"):
+        return [path]
+    with open(path) as f:
+        return [line.strip().split("!")[0] for line in f if line.strip()]
+
+
+# Commands which are sent to a server if one is running.
+SERVED_COMMANDS = ("show", "diff", "sdiff", "preview", "closure", "rdeps",
+                   "why-depends", "fingerprint")
+
+
+def get_args(argv=None):
     """Parse command-line arguments."""
     p_root = argparse.ArgumentParser(description="Derivation Utilities")
+    p_root.add_argument("--parse-cache", action="store_true",
+                        default=bool(os.environ.get("DERIVTOOL_PARSE_CACHE")),
+                        help="Keep parsed derivations in an on-disk cache.")
+    p_root.add_argument("--parse-cache-path",
+                        help="Location of the on-disk cache.")
+    p_root.add_argument("--socket",
+                        help="Socket of the server started by 'serve'.")
+    p_root.add_argument("--no-server", action="store_true",
+                        default=bool(os.environ.get("DERIVTOOL_NO_SERVER")),
+                        help="Don't send the command to a running server.")
+    p_root.add_argument("--stats", action="store_const", const="text",
+                        help="Print counts and timings of what was done "
+                             "to stderr afterwards.")
+    p_root.add_argument("--stats-json", action="store_const", const="json",
+                        dest="stats", help="The same, as JSON.")
     subparsers = p_root.add_subparsers(title="Command", dest="command")
     subparsers.required = True
 
     # 'show' command
-    p_show = subparsers.add_parser("show", help="Show a derivation.")
-    p_show.add_argument("derivation_path", help="Path to the derivation.")
+    p_show = subparsers.add_parser("show", help="Show derivations.")
+    p_show.add_argument("derivation_paths", nargs="*",
+                        help="Paths to derivations (read from stdin if "
+                             "not given).")
     p_show.add_argument("--json", action="store_const", const="json",
                         dest="format", help="JSON format.")
+    p_show.add_argument("--ndjson", action="store_const", const="ndjson",
+                        dest="format",
+                        help="One JSON object per line for each derivation.")
     p_show.add_argument("--yaml", action="store_const", const="yaml",
                         dest="format", help="YAML format.")
     p_show.add_argument("-p", "--pretty", action="store_true", default=False,
@@ -26,70 +110,428 @@ def get_args():
     p_show.add_argument("-A", "--attribute", help="Attribute to show.")
     p_show.add_argument("-e", "--env-var",
                         help="Environmant variable to show.")
+    p_show.add_argument("--closure", action="store_true", default=False,
+                        help="Also show everything they depend on.")
+    p_show.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes to use.")
     p_show.set_defaults(format="string")
 
     # 'diff' command
     p_diff = subparsers.add_parser("diff", help="Diff two derivations.")
     p_diff.add_argument("first", help="Path to the first derivation.")
     p_diff.add_argument("second", help="Path to the second derivation.")
+    p_diff.add_argument("--mask-hashes", action="store_true", default=False,
+                        help="Ignore differences in store path hashes.")
 
     # 'sdiff' command
     p_sdiff = subparsers.add_parser("sdiff", help="Diff smartly.")
     p_sdiff.add_argument("first", help="Path to the first derivation.")
     p_sdiff.add_argument("second", help="Path to the second derivation.")
+    p_sdiff.add_argument("--json", action="store_true", default=False,
+                         help="JSON format.")
+    p_sdiff.add_argument("--mask-hashes", action="store_true", default=False,
+                         help="Ignore differences in store path hashes, "
+                              "not just those of paired inputs.")
 
     # 'preview' command
     p_preview = subparsers.add_parser("preview",
                                      help="Show paths needed to build a derivation.")
     p_preview.add_argument("derivation_paths", nargs="*",
                           help="Paths to derivations.")
-    p_preview.add_argument("-c", "--binary-cache",
-                           default=os.environ.get("NIX_REPO_HTTP"),
-                           help="URL of a binary cache to query for paths.")
+    p_preview.add_argument("-c", "--binary-cache", action="append",
+                           dest="binary_caches",
+                           help="URL of a binary cache to query for paths. "
+                                "May be repeated; caches are tried in order.")
+    p_preview.add_argument("--batch-size", type=int, default=500,
+                           help="Binary cache queries to run at once.")
+    p_preview.add_argument("--max-connections", type=int, default=8,
+                           help="Connections to open to each binary cache.")
+    p_preview.add_argument("--timeout", type=float, default=10.0,
+                           help="Seconds to wait for a binary cache.")
+    p_preview.add_argument("--retries", type=int, default=3,
+                           help="Times to retry a failed query.")
+    p_preview.add_argument("--no-query-cache", action="store_false",
+                           dest="query_cache", default=True,
+                           help="Don't reuse binary cache answers from "
+                                "earlier runs.")
+    p_preview.add_argument("--negative-ttl", type=float, default=3600,
+                           help="Seconds to remember that a binary cache "
+                                "lacks a path.")
+    p_preview.add_argument("--positive-ttl", type=float,
+                           default=30 * 24 * 3600,
+                           help="Seconds to remember that a binary cache "
+                                "has a path.")
+    p_preview.add_argument("--query-stats", action="store_true",
+                           default=False,
+                           help="Report latency and hit rate per cache.")
     p_preview.add_argument("--show-existing", action="store_true",
                            default=False, help="Show paths already existing.")
-    return p_root.parse_args()
+    p_preview.add_argument("-j", "--jobs", type=int, default=1,
+                           help="Number of processes to parse with.")
+    p_preview.add_argument("--store-check", default="auto",
+                           # The keys of store.METHODS.
+                           choices=["auto", "db", "scandir", "stat"],
+                           help="How to check for outputs in the store: "
+                                "the Nix database (db), one listing of the "
+                                "store directory (scandir), or a stat per "
+                                "path (stat). 'auto' uses db if readable.")
+    p_preview.add_argument("--state", default=None,
+                           help="File to remember what was found in, so "
+                                "that the next run only checks what may "
+                                "have changed.")
+
+    # Options shared by the commands which load a whole graph.
+    p_graph = argparse.ArgumentParser(add_help=False)
+    p_graph.add_argument("--gc-roots", action="store_true", default=False,
+                         help="Also start from the derivations of all GC "
+                              "roots.")
+    p_graph.add_argument("-j", "--jobs", type=int, default=1,
+                         help="Number of processes to parse with.")
+
+    # 'closure' command
+    p_closure = subparsers.add_parser(
+        "closure", parents=[p_graph],
+        help="List derivations needed by some derivations, "
+             "dependencies first.")
+    p_closure.add_argument("derivation_paths", nargs="*",
+                           help="Paths to derivations (read from stdin if "
+                                "not given).")
+
+    # 'rdeps' command
+    p_rdeps = subparsers.add_parser(
+        "rdeps", parents=[p_graph],
+        help="List derivations depending on a derivation.")
+    p_rdeps.add_argument("target", help="Path to the derivation.")
+    p_rdeps.add_argument("roots", nargs="*",
+                         help="Derivations whose closures to search (read "
+                              "from stdin if not given).")
+    p_rdeps.add_argument("--direct", action="store_true", default=False,
+                         help="Only list derivations using it directly.")
+
+    # 'why-depends' command
+    p_why = subparsers.add_parser(
+        "why-depends",
+        help="Show a chain of dependencies from one derivation to another.")
+    p_why.add_argument("source", help="Path to the depending derivation.")
+    p_why.add_argument("target", help="Path to the derivation depended on.")
+    p_why.add_argument("-j", "--jobs", type=int, default=1,
+                       help="Number of processes to parse with.")
+
+    # 'impact' command
+    p_impact = subparsers.add_parser(
+        "impact", help="Find which changes cause which rebuilds between "
+                       "two sets of derivations.")
+    p_impact.add_argument("old_roots",
+                          help="Derivation before the change, or a file "
+                               "listing derivations.")
+    p_impact.add_argument("new_roots",
+                          help="Derivation after the change, or a file "
+                               "listing derivations.")
+    p_impact.add_argument("--list", action="store_true", default=False,
+                          help="List every derivation to be rebuilt.")
+    p_impact.add_argument("--json", action="store_true", default=False,
+                          help="JSON format.")
+    p_impact.add_argument("-j", "--jobs", type=int, default=1,
+                          help="Number of processes to parse with.")
+
+    # 'fingerprint' command
+    p_fingerprint = subparsers.add_parser(
+        "fingerprint", help="Print hashes identifying derivations modulo "
+                            "the paths of their inputs.")
+    p_fingerprint.add_argument("derivation_paths", nargs="*",
+                               help="Paths to derivations (read from stdin "
+                                    "if not given).")
+    p_fingerprint.add_argument("--closure", action="store_true",
+                               default=False,
+                               help="Also print the fingerprints of "
+                                    "everything they depend on.")
+    p_fingerprint.add_argument("-j", "--jobs", type=int, default=1,
+                               help="Number of processes to parse with.")
+
+    # 'verify' command
+    p_verify = subparsers.add_parser(
+        "verify", parents=[p_graph],
+        help="Check that the output paths and file paths of derivations "
+             "and their dependencies are what Nix would compute.")
+    p_verify.add_argument("derivation_paths", nargs="*",
+                          help="Paths to derivations (read from stdin if "
+                               "not given).")
+
+    # 'export' command
+    p_export = subparsers.add_parser(
+        "export", parents=[p_graph],
+        help="Write the closure of some derivations to tables.")
+    p_export.add_argument("derivation_paths", nargs="*",
+                          help="Paths to derivations (read from stdin if "
+                               "not given).")
+    p_export.add_argument("-o", "--output", required=True,
+                          help="SQLite database or Parquet directory to "
+                               "create.")
+    p_export.add_argument("--format", choices=("sqlite", "parquet"),
+                          default="sqlite",
+                          help="Output format (Parquet needs pyarrow).")
+
+    # 'cache' command
+    p_cache = subparsers.add_parser("cache",
+                                    help="Manage the on-disk parse cache.")
+    p_cache.add_argument("action", choices=["info", "gc", "trim", "clear"],
+                         help="info: show location and size. gc: remove "
+                              "entries for missing files. trim: shrink to "
+                              "--max-size. clear: remove everything.")
+    p_cache.add_argument("--max-size", type=parse_size, default="256M",
+                         help="Size limit for 'trim', e.g. 500M.")
+    # 'serve' command
+    p_serve = subparsers.add_parser(
+        "serve", help="Keep running, with warm caches, and answer the "
+                      "commands of other derivtool processes.")
+    p_serve.add_argument("--cache-size", type=parse_size, default="2G",
+                         help="Size limit for parsed derivations kept in "
+                              "memory, e.g. 4G.")
+    return p_root.parse_args(argv)
+
+
+def reads_stdin(args):
+    """Whether a command will read paths from stdin."""
+    paths = getattr(args, "derivation_paths", getattr(args, "roots", None))
+    return paths is not None and len(paths) == 0 and \
+        not getattr(args, "gc_roots", False)
+
+
+# On-disk caches opened by the server, by path, kept open between
+# requests.
+_parse_caches = {}
+
+
+def open_parse_cache(path):
+    """Open the on-disk parse cache at a path (or the default one)."""
+    from nix_derivation_tools.persistent_cache import (
+        PersistentCache, default_cache_path)
+    path = path or default_cache_path()
+    if path not in _parse_caches:
+        _parse_caches[path] = PersistentCache(path)
+    return _parse_caches[path]
+
+
+def serve_request(argv):
+    """Run a command sent to the server, returning its exit status."""
+    from nix_derivation_tools.persistent_cache import (
+        get_persistent_cache, set_persistent_cache)
+    # Whatever the server itself was started with.
+    previous = get_persistent_cache()
+    try:
+        args = get_args(argv)
+        if args.command not in SERVED_COMMANDS:
+            sys.exit("The server doesn't run '{}'".format(args.command))
+        if args.parse_cache:
+            set_persistent_cache(open_parse_cache(args.parse_cache_path))
+        run_with_stats(args)
+    except SystemExit as e:
+        return e.code
+    finally:
+        cache = get_persistent_cache()
+        if cache is not None:
+            cache.flush()
+        set_persistent_cache(previous)
 
 
 def main():
     """Main entry point."""
     args = get_args()
+    if args.command in SERVED_COMMANDS and not args.no_server:
+        from nix_derivation_tools.server import run_remote
+        # --parse-cache is passed along, and applied by serve_request.
+        status = run_remote(sys.argv[1:], args.socket, reads_stdin(args))
+        if status is not None:
+            sys.exit(status)
+    if args.parse_cache or args.command == "cache":
+        from nix_derivation_tools.persistent_cache import (
+            set_persistent_cache)
+        set_persistent_cache(open_parse_cache(args.parse_cache_path))
+    run_with_stats(args)
+
+
+def run_with_stats(args):
+    """Run a command, printing metrics afterwards if asked."""
+    if args.stats is None:
+        run_command(args)
+        return
+    from nix_derivation_tools.metrics import collect
+    with collect() as metrics:
+        try:
+            with metrics.timer("command." + args.command):
+                run_command(args)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.write(metrics.report(args.stats) + "\n")
+
+
+def run_command(args):
+    """Run a command, given its parsed arguments."""
     if args.command == "show":
-        path = args.derivation_path
-        if "!" in path:
-            path = path.split("!")[0]
-        deriv = Derivation.parse_derivation_file(path)
-        print(deriv.display(
-            attribute=args.attribute,
-            env_var=args.env_var,
-            format=args.format,
-            pretty=args.pretty))
+        from nix_derivation_tools.bulk import show_derivations
+        paths = (p.split("!")[0] for p in iter_paths(args.derivation_paths))
+        for text in show_derivations(paths, closure=args.closure,
+                                     jobs=args.jobs,
+                                     attribute=args.attribute,
+                                     env_var=args.env_var,
+                                     format=args.format, pretty=args.pretty):
+            print(text)
     elif args.command == "diff":
+        from nix_derivation_tools.derivation import Derivation
         first = Derivation.parse_derivation_file(args.first)
         second = Derivation.parse_derivation_file(args.second)
-        print(first.diff(second))
+        print(first.diff(second, mask_hashes=args.mask_hashes))
     elif args.command == "sdiff":
+        from nix_derivation_tools.derivation import Derivation
+        from nix_derivation_tools.derivation_diff import diff_recursive
         first = Derivation.parse_derivation_file(args.first)
         second = Derivation.parse_derivation_file(args.second)
-        diff = diff_derivations(first, second)
-        if isinstance(diff, str):
-            print(diff)
+        diff = diff_recursive(first, second, mask_hashes=args.mask_hashes)
+        if args.json:
+            print(json.dumps(diff.as_dict(), indent=2, sort_keys=True))
         else:
-            description, left, right = diff
-            print("{} differs:".format(description))
-            print("Left:")
-            print(left)
-            print("Right:")
-            print(right)
+            print(diff.format())
     elif args.command == "preview":
-        if len(args.derivation_paths) > 0:
-            paths = args.derivation_paths
-        elif not sys.stdin.isatty():
-            paths = (p.strip() for p in sys.stdin)
+        from nix_derivation_tools.persistent_cache import (
+            SubstituterResultCache)
+        from nix_derivation_tools.preview import print_preview
+        from nix_derivation_tools.store import get_store_presence
+        paths = read_paths(args.derivation_paths)
+        binary_caches = args.binary_caches
+        if binary_caches is None and os.environ.get("NIX_REPO_HTTP"):
+            binary_caches = [os.environ["NIX_REPO_HTTP"]]
+        client = None
+        if binary_caches:
+            from nix_derivation_tools.substituters import SubstituterClient
+            result_cache = None
+            if args.query_cache:
+                result_cache = SubstituterResultCache(
+                    positive_ttl=args.positive_ttl,
+                    negative_ttl=args.negative_ttl)
+            try:
+                client = SubstituterClient(
+                    binary_caches, batch_size=args.batch_size,
+                    max_connections=args.max_connections,
+                    timeout=args.timeout, retries=args.retries,
+                    result_cache=result_cache)
+            except ValueError as e:
+                sys.exit(str(e))
+        try:
+            state = None
+            if args.state is not None:
+                from nix_derivation_tools.incremental import PreviewState
+                state = PreviewState.load(args.state)
+            print_preview(paths, show_existing=args.show_existing,
+                          jobs=args.jobs, client=client,
+                          presence=get_store_presence(args.store_check),
+                          state=state)
+            if state is not None:
+                state.save(args.state)
+            if client is not None and args.query_stats:
+                sys.stderr.write(client.report() + "\n")
+        finally:
+            if client is not None:
+                client.close()
+    elif args.command == "closure":
+        graph = load_graph(args.derivation_paths, args)
+        for node in graph.sorted(graph.closure(graph.roots)):
+            print(graph.paths[node])
+    elif args.command == "rdeps":
+        graph = load_graph(args.roots, args)
+        if args.target not in graph:
+            sys.exit("{} is not in the closure".format(args.target))
+        target = graph.node(args.target)
+        if args.direct:
+            dependents = set(graph.dependents(target))
+        else:
+            dependents = graph.reverse_closure([target]) - {target}
+        for node in graph.sorted(dependents):
+            print(graph.paths[node])
+    elif args.command == "why-depends":
+        from nix_derivation_tools.graph import DerivationGraph
+        graph = DerivationGraph.from_roots([args.source], jobs=args.jobs)
+        if args.target not in graph:
+            sys.exit("{} does not depend on {}"
+                     .format(args.source, args.target))
+        chain = graph.why_depends(graph.node(args.source),
+                                  graph.node(args.target))
+        for depth, node in enumerate(chain):
+            print("{}{}".format("  " * depth, graph.paths[node]))
+    elif args.command == "impact":
+        from nix_derivation_tools.impact import analyse_impact
+        report = analyse_impact(read_roots(args.old_roots),
+                                read_roots(args.new_roots), jobs=args.jobs)
+        if args.json:
+            print(json.dumps(report.as_dict(args.list), indent=2))
+        else:
+            print(report.summary(args.list))
+    elif args.command == "fingerprint":
+        from nix_derivation_tools.derivation import Derivation
+        from nix_derivation_tools.fingerprint import (
+            fingerprint, fingerprint_closure)
+        paths = [p.split("!")[0] for p in read_paths(args.derivation_paths)]
+        if args.closure:
+            fingerprints = fingerprint_closure(paths, jobs=args.jobs)
+            for path in sorted(fingerprints):
+                print("{}  {}".format(fingerprints[path], path))
+        else:
+            for path in paths:
+                deriv = Derivation.parse_derivation_file(path)
+                print("{}  {}".format(fingerprint(deriv), path))
+    elif args.command == "verify":
+        from nix_derivation_tools.hashing import verify_closure
+        problems = verify_closure(graph_roots(args.derivation_paths, args),
+                                  jobs=args.jobs)
+        for path in sorted(problems):
+            for problem in problems[path]:
+                print("{}: {}".format(path, problem))
+        if problems:
+            sys.exit(1)
+    elif args.command == "export":
+        from nix_derivation_tools.export import export_closure
+        try:
+            count = export_closure(graph_roots(args.derivation_paths, args),
+                                   args.output, format=args.format,
+                                   jobs=args.jobs)
+        except ValueError as e:
+            sys.exit(str(e))
+        sys.stderr.write("Exported {} derivations to {}\n"
+                         .format(count, args.output))
+    elif args.command == "cache":
+        from nix_derivation_tools.persistent_cache import (
+            get_persistent_cache)
+        cache = get_persistent_cache()
+        if args.action == "info":
+            info = cache.info()
+            print("Path: {}".format(info["path"]))
+            print("Entries: {}".format(info["entries"]))
+            print("Size: {} bytes".format(info["size"]))
+        elif args.action == "gc":
+            print("Removed {} entries".format(cache.gc()))
+        elif args.action == "trim":
+            print("Removed {} entries".format(cache.trim(args.max_size)))
         else:
-            sys.exit("No path arguments given")
-        print_preview(paths, binary_cache=args.binary_cache,
-                      show_existing=args.show_existing)
+            cache.clear()
+    elif args.command == "serve":
+        from nix_derivation_tools.cache import LRUCache, set_cache
+        from nix_derivation_tools.server import (
+            DerivtoolServer, default_socket_path)
+        set_cache(LRUCache(max_size=args.cache_size))
+        try:
+            path = args.socket or default_socket_path()
+            server = DerivtoolServer(path, serve_request)
+        except ValueError as e:
+            sys.exit(str(e))
+        sys.stderr.write("Listening on {}\n".format(path))
+        # Clean up the socket when killed, too. This isn't SystemExit,
+        # which commands being run use.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
     else:
         sys.exit("Command {} not implemented".format(repr(args.command)))
 
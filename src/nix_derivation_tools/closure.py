@@ -0,0 +1,105 @@
+"""Loading whole closures of derivations in parallel.
+
+Each derivation file can be parsed independently of the others, so
+rather than discovering a closure one derivation at a time, we walk it
+breadth-first and hand each level of not-yet-parsed files to a pool of
+worker processes. The results go into the same caches used by
+:py:meth:`Derivation.parse_derivation_file`, so later traversals of the
+closure find everything already parsed.
+"""
+import os
+
+from nix_derivation_tools import metrics
+from nix_derivation_tools.aterm import parse_derivation_text
+from nix_derivation_tools.cache import (
+    estimate_size, get_cache, normalize_derivation_path)
+from nix_derivation_tools.derivation import Derivation, _read_file
+from nix_derivation_tools.persistent_cache import get_persistent_cache
+
+
+def _read_fields(path):
+    """Read and parse a derivation file in a worker process.
+
+    :return: The path, the parsed fields, the size of the file and its
+        ``os.stat`` result.
+    :rtype: ``tuple``
+    """
+    data, stat = _read_file(path)
+    source = data.decode("utf-8")
+    try:
+        fields = parse_derivation_text(source)
+    except Exception as e:
+        raise ValueError("Couldn't parse derivation at path {}: {}"
+                         .format(path, repr(e)))
+    return path, fields, stat.st_size, stat
+
+
+def _add_parsed(path, fields, size, stat, persist=True):
+    """Turn parsed fields into a cached Derivation."""
+    deriv = Derivation._from_fields(path, fields, None)
+    get_cache().put(path, deriv, size=estimate_size(size))
+    persistent = get_persistent_cache()
+    if persist and persistent is not None:
+        persistent.put(path, stat, fields)
+    return deriv
+
+
+def load_closure(paths, jobs=None):
+    """Parse some derivations and everything they depend on.
+
+    :param paths: Paths to the root derivations.
+    :type paths: ``list`` of ``str``
+    :param jobs: Number of worker processes. Defaults to the number of
+        CPUs; with 1, everything is parsed in this process.
+    :type jobs: ``int`` or ``NoneType``
+
+    :return: Mapping from (normalized) derivation paths to derivations,
+        covering the whole closure.
+    :rtype: ``dict`` of ``str`` to :py:class:`Derivation`
+    """
+    jobs = jobs or os.cpu_count() or 1
+    cache = get_cache()
+    persistent = get_persistent_cache()
+    result = {}
+    frontier = {normalize_derivation_path(p) for p in paths}
+    executor = None
+    if jobs > 1:
+        # Only imported when needed, as in bulk.py.
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(jobs)
+    try:
+        while len(frontier) > 0:
+            found, to_parse = [], []
+            for path in frontier:
+                if path in cache:
+                    found.append(Derivation.parse_derivation_file(path))
+                    continue
+                if persistent is not None:
+                    stat = os.stat(path)
+                    fields = persistent.get(path, stat)
+                    if fields is not None:
+                        metrics.count("parse.persistent_hits")
+                        found.append(_add_parsed(path, fields, stat.st_size,
+                                                 stat, persist=False))
+                        continue
+                to_parse.append(path)
+            if executor is None or len(to_parse) < 2:
+                found.extend(Derivation.parse_derivation_file(p)
+                             for p in to_parse)
+            else:
+                chunksize = max(1, len(to_parse) // (jobs * 4))
+                for parsed in executor.map(_read_fields, to_parse,
+                                           chunksize=chunksize):
+                    metrics.count("parse.parsed")
+                    metrics.count("parse.bytes_read", parsed[2])
+                    found.append(_add_parsed(*parsed))
+            frontier = set()
+            for deriv in found:
+                result[deriv.path] = deriv
+                for path in deriv.input_derivations:
+                    if path not in result:
+                        frontier.add(path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return result
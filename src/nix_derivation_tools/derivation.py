@@ -1,17 +1,101 @@
-import ast
-import os
 import json
+import mmap
+import os
 import sys
 
-import datadiff
-import yaml
-import rtyaml
+from nix_derivation_tools.aterm import (
+    FieldIndex, parse_derivation_text, unparse_derivation_fields)
+from nix_derivation_tools import metrics
+from nix_derivation_tools.cache import (
+    estimate_size, get_cache, normalize_derivation_path)
+from nix_derivation_tools.valuediff import diff_values, format_difference
+
+
+# Files at least this big are memory-mapped when parsed lazily, rather
+# than copied into memory.
+_MMAP_THRESHOLD = 2 ** 20
+
+
+def _read_file(path, allow_mmap=False):
+    """Read a derivation file with as few system calls as possible.
+
+    :param path: Path to the file.
+    :type path: ``str``
+    :param allow_mmap: Memory-map the file instead of reading it, if
+        it's large.
+    :type allow_mmap: ``bool``
+
+    :return: The undecoded contents and the result of ``os.fstat``.
+    :rtype: (``bytes`` or ``mmap.mmap``, ``os.stat_result``)
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        stat = os.fstat(fd)
+        if allow_mmap and stat.st_size >= _MMAP_THRESHOLD:
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ), stat
+        data = os.read(fd, stat.st_size)
+        if len(data) < stat.st_size:
+            # A short read; fall back to reading until end of file.
+            chunks = [data]
+            while True:
+                chunk = os.read(fd, 2 ** 16)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            data = b"".join(chunks)
+        return data, stat
+    finally:
+        os.close(fd)
+
+
+def _outputs(output_list):
+    """Convert parsed outputs into the form stored on a Derivation."""
+    intern = sys.intern
+    outputs = {}
+    for name, path, hashtype, hash_ in output_list:
+        name, path = intern(name), intern(path)
+        outputs[name] = path if hashtype == "" else (path, hashtype, hash_)
+    return outputs
+
+
+def _input_derivations(input_list):
+    intern = sys.intern
+    return {intern(path): [intern(o) for o in outs]
+            for path, outs in input_list}
+
+
+def _input_files(paths):
+    return set(map(sys.intern, paths))
+
+
+def _environment(pairs, outputs):
+    intern = sys.intern
+    environment = {}
+    for key, value in pairs:
+        if key in outputs:
+            # The variable holds an output path; share that string.
+            value = intern(value)
+        environment[intern(key)] = value
+    return environment
+
+
+# How to convert each parsed field, in file order. The environment is
+# handled separately since it depends on the outputs.
+_CONVERTERS = (_outputs, _input_derivations, _input_files, sys.intern,
+               sys.intern, list, None)
 
 
 class Derivation(object):
     """A Python representation of a derivation."""
-    # Cache of parsed derivations, to avoid duplicat parsing.
-    CACHE = {}
+    # Attributes which make up the derivation itself, in file order.
+    FIELDS = ("outputs", "input_derivations", "input_files", "system",
+              "builder", "builder_args", "environment")
+
+    # Closures can contain tens of thousands of derivations, so avoid a
+    # per-instance __dict__.
+    __slots__ = FIELDS + ("_raw", "_path", "_input_paths",
+                          "_input_derivation_paths", "_output_mapping",
+                          "_as_dict", "_lazy", "_fingerprint")
 
     def __init__(self, path, raw, outputs, input_derivations,
                  input_files, system, builder, builder_args, environment):
@@ -19,8 +103,9 @@ class Derivation(object):
 
         :param path: The path to this derivation file.
         :type path: ``str``
-        :param raw: Raw nix derivation.
-        :type raw: ``str``
+        :param raw: Raw nix derivation. If ``None``, it's read from
+            ``path`` when first needed.
+        :type raw: ``str`` or ``NoneType``
         :param outputs: The outputs this derivation will produce. Keys are
             output names, and values are EITHER nix store paths, OR
             nix store paths plus some output hash information.
@@ -59,6 +144,31 @@ class Derivation(object):
         self._input_derivation_paths = None
         self._output_mapping = None
         self._as_dict = None
+        # Set by nix_derivation_tools.fingerprint.
+        self._fingerprint = None
+        # Index into the raw text, for derivations parsed lazily.
+        self._lazy = None
+
+    def __getattr__(self, name):
+        """Decode a field of a lazily-parsed derivation on first access.
+
+        This is only called for attributes which aren't set, which for
+        a field means it hasn't been decoded yet.
+        """
+        if name == "_lazy" or name not in self.FIELDS or self._lazy is None:
+            raise AttributeError(name)
+        index = self.FIELDS.index(name)
+        try:
+            parsed = self._lazy.parse(index)
+        except ValueError as e:
+            raise ValueError("Couldn't parse derivation at path {}: {}"
+                             .format(self._path, repr(e)))
+        if name == "environment":
+            value = _environment(parsed, self.outputs)
+        else:
+            value = _CONVERTERS[index](parsed)
+        setattr(self, name, value)
+        return value
 
     @property
     def path(self):
@@ -68,6 +178,12 @@ class Derivation(object):
     @property
     def raw(self):
         """The raw derivation string."""
+        if self._raw is None and self._lazy is not None:
+            return self._lazy.source
+        if self._raw is None:
+            # Not kept in memory; derivation files are immutable, so
+            # just read it again.
+            return _read_file(self._path)[0].decode("utf-8")
         return self._raw
 
     @property
@@ -140,8 +256,7 @@ class Derivation(object):
     def as_dict(self):
         """Convert to a JSON-compatible dictionary."""
         if self._as_dict is None:
-            items = vars(self).items()
-            res = {k: v for k, v in items if not k.startswith("_")}
+            res = {k: getattr(self, k) for k in self.FIELDS}
             for key, val in res.items():
                 if isinstance(val, set):
                     res[key] = list(sorted(val))
@@ -163,16 +278,67 @@ class Derivation(object):
     def __repr__(self):
         return "Derivation({})".format(repr(self.path))
 
-    def diff(self, other):
-        """Get a naive diff between two derivations, just comparing
-        their dictionary representation."""
-        selfdict, otherdict = vars(self), vars(other)
-        # Convert outputs to a format that doesn't include the output
-        # file path, since we know this will be different if the two
-        # derivations are different.
-        selfdict["outputs"] = list(sorted(selfdict["outputs"].keys()))
-        otherdict["outputs"] = list(sorted(otherdict["outputs"].keys()))
-        return datadiff.diff(selfdict, otherdict)
+    def diff(self, other, mask_hashes=False):
+        """Get a naive diff between two derivations, comparing each of
+        their fields.
+
+        :param other: The derivation to compare with.
+        :type other: :py:class:`Derivation`
+        :param mask_hashes: Ignore differences in the hash parts of
+            store paths.
+        :type mask_hashes: ``bool``
+
+        :return: A description of the differences, or ``equal``.
+        :rtype: ``str``
+        """
+        lines = []
+        for field in self.FIELDS:
+            left, right = getattr(self, field), getattr(other, field)
+            if field == "outputs":
+                # Only compare output names, since we know the paths
+                # will be different if the two derivations are.
+                left, right = set(left), set(right)
+            difference = diff_values(left, right, mask_hashes)
+            if difference is not None:
+                lines.append("{}:".format(field))
+                lines.extend(format_difference(difference, "  "))
+        return "\n".join(lines) if lines else "equal"
+
+    def unparse(self, mask_outputs=False, input_derivations=None):
+        """Serialize to ATerm, as Nix writes derivation files.
+
+        :param mask_outputs: Leave output paths, and the environment
+            variables holding them, empty, as when Nix computes the
+            output paths.
+        :type mask_outputs: ``bool``
+        :param input_derivations: Use these in place of
+            :py:attr:`input_derivations`.
+        :type input_derivations: ``dict`` of ``str`` to ``list`` of
+            ``str`` or ``NoneType``
+
+        :rtype: ``str``
+        """
+        outputs = []
+        for name in sorted(self.outputs):
+            value = self.outputs[name]
+            path, hash_algo, hash_ = \
+                (value, "", "") if isinstance(value, str) else value
+            outputs.append((name, "" if mask_outputs else path,
+                            hash_algo, hash_))
+        if input_derivations is None:
+            input_derivations = self.input_derivations
+        environment = self.environment
+        return unparse_derivation_fields((
+            outputs,
+            [(path, sorted(input_derivations[path]))
+             for path in sorted(input_derivations)],
+            sorted(self.input_files),
+            self.system,
+            self.builder,
+            self.builder_args,
+            [(key, "" if mask_outputs and key in self.outputs
+              else environment[key])
+             for key in sorted(environment)]))
 
     def display(self, attribute=None, env_var=None,
                 format="json", pretty=False):
@@ -214,74 +380,158 @@ class Derivation(object):
             else:
                 return json.dumps(to_print, sort_keys=True)
         elif format == "yaml":
+            # These are slow to import, and only needed here.
             if pretty is True:
+                import rtyaml
                 return rtyaml.dump(to_print)
             else:
+                import yaml
                 return yaml.dump(to_print)
         else:
             raise ValueError("Invalid format: {}".format(format))
 
     @staticmethod
-    def parse_derivation(derivation_string, derivation_path):
+    def parse_derivation(derivation_string, derivation_path, keep_raw=True):
         """Parse a derivation string into a Derivation.
 
+        Store paths, output names and environment variable names are
+        interned, since the same ones turn up across a whole closure.
+
         :param derivation_string: A string representation of a
             derivation, as returned by a call to `nix-instantiate`.
         :type derivation_string: ``str``
         :param derivation_path: Path to the derivation file.
         :type derivation_path: ``str``
+        :param keep_raw: Keep ``derivation_string`` on the result. If
+            false, :py:attr:`raw` re-reads ``derivation_path`` instead.
+        :type keep_raw: ``bool``
 
         :return: The parsed Derivation object.
         :rtype: :py:class:`Derivation`
         """
-        if derivation_string.startswith("Derive(["):
-            # Then trim off the initial 'Derive(' and final ')'
-            derivation_string = derivation_string[7:-1]
-        # Parse the string as a python literal; this is a safe
-        # operation because the derivation will not contain any
-        # function calls, or anything which isn't a valid python literal.
-        derivation_list =  ast.literal_eval(derivation_string)
-        output_list= derivation_list[0]
-        outputs = {name: path if hashtype == "" else (path, hashtype, hash_)
-                   for name, path, hashtype, hash_ in output_list}
-        input_derivations = dict(derivation_list[1])
-        input_files = set(derivation_list[2])
-        system = derivation_list[3]
-        builder = derivation_list[4]
-        builder_args = derivation_list[5]
-        environment = dict(derivation_list[6])
-        return Derivation(path=derivation_path,
-                          raw=derivation_string,
-                          outputs=outputs,
-                          input_derivations=input_derivations,
-                          input_files=input_files,
-                          system=system,
-                          builder=builder,
-                          builder_args=builder_args,
-                          environment=environment)
+        return Derivation._from_fields(
+            derivation_path, parse_derivation_text(derivation_string),
+            raw=derivation_string if keep_raw else None)
+
+    @staticmethod
+    def _from_fields(derivation_path, derivation_list, raw):
+        """Build a Derivation from the result of
+        :py:func:`~nix_derivation_tools.aterm.parse_derivation_text`."""
+        outputs = _outputs(derivation_list[0])
+        return Derivation(
+            path=sys.intern(derivation_path),
+            raw=raw,
+            outputs=outputs,
+            input_derivations=_input_derivations(derivation_list[1]),
+            input_files=_input_files(derivation_list[2]),
+            system=sys.intern(derivation_list[3]),
+            builder=sys.intern(derivation_list[4]),
+            builder_args=derivation_list[5],
+            environment=_environment(derivation_list[6], outputs))
 
     @staticmethod
-    def parse_derivation_file(derivation_path):
+    def _lazy_from_text(derivation_path, derivation_string):
+        """Build a Derivation whose fields are decoded on first access.
+
+        ``derivation_string`` may also be undecoded ``bytes`` or an
+        ``mmap``, see :py:class:`~nix_derivation_tools.aterm.FieldIndex`.
+        """
+        deriv = Derivation.__new__(Derivation)
+        deriv._path = sys.intern(derivation_path)
+        deriv._raw = None
+        deriv._input_paths = None
+        deriv._input_derivation_paths = None
+        deriv._output_mapping = None
+        deriv._as_dict = None
+        deriv._fingerprint = None
+        deriv._lazy = FieldIndex(derivation_string)
+        return deriv
+
+    @staticmethod
+    def parse_derivation_file(derivation_path, keep_raw=False, lazy=False):
         """Parse a derivation from a file path.
 
         :param derivation_path: Path to a file containing a string
             representation of a derivation.
         :type derivation_path: ``str``
+        :param keep_raw: Keep the file contents in memory, rather than
+            re-reading the file if :py:attr:`Derivation.raw` is used.
+        :type keep_raw: ``bool``
+        :param lazy: Only locate the fields of the derivation for now,
+            and decode each one when it's first used. This is much
+            cheaper when only one or two fields are needed. The file
+            contents are kept undecoded in memory (large files are
+            memory-mapped instead), and syntax errors in a field aren't
+            noticed until it's used.
+        :type lazy: ``bool``
 
         :return: The parsed Derivation object.
         :rtype: :py:class:`Derivation`
         """
-        if not os.path.isabs(derivation_path) and "NIX_STORE" in os.environ:
-            derivation_path = os.path.join(os.environ["NIX_STORE"],
-                                           derivation_path)
-        if derivation_path in Derivation.CACHE:
-            return Derivation.CACHE[derivation_path]
-        with open(derivation_path, "rb") as f:
-            source = f.read().decode("utf-8")
-            try:
-                deriv = Derivation.parse_derivation(source, derivation_path)
-                Derivation.CACHE[derivation_path] = deriv
+        derivation_path = normalize_derivation_path(derivation_path)
+        cache = get_cache()
+        deriv = cache.get(derivation_path)
+        if deriv is not None:
+            metrics.count("parse.memory_hits")
+            return deriv
+        from nix_derivation_tools.persistent_cache import (
+            get_persistent_cache)
+        persistent = get_persistent_cache()
+        fields = None
+        if persistent is not None:
+            stat = os.stat(derivation_path)
+            fields = persistent.get(derivation_path, stat)
+            if fields is not None and not keep_raw:
+                metrics.count("parse.persistent_hits")
+                deriv = Derivation._from_fields(derivation_path, fields, None)
+                cache.put(derivation_path, deriv,
+                          size=estimate_size(stat.st_size))
                 return deriv
+        if fields is None and lazy:
+            data, stat = _read_file(derivation_path, allow_mmap=True)
+            metrics.count("parse.lazy")
+            metrics.count("parse.bytes_read", stat.st_size)
+            deriv = Derivation._lazy_from_text(derivation_path, data)
+            cache.put(derivation_path, deriv,
+                      size=estimate_size(stat.st_size, keep_raw=True))
+            return deriv
+        data, stat = _read_file(derivation_path)
+        metrics.count("parse.bytes_read", stat.st_size)
+        source = data.decode("utf-8")
+        del data
+        if fields is None:
+            try:
+                fields = parse_derivation_text(source)
             except Exception as e:
                 raise ValueError("Couldn't parse derivation at path {}: {}"
                                  .format(derivation_path, repr(e)))
+            metrics.count("parse.parsed")
+            if persistent is not None:
+                persistent.put(derivation_path, stat, fields)
+        deriv = Derivation._from_fields(derivation_path, fields,
+                                        source if keep_raw else None)
+        cache.put(derivation_path, deriv,
+                  size=estimate_size(stat.st_size, keep_raw))
+        return deriv
+
+    @staticmethod
+    def parse_derivation_files(derivation_paths, keep_raw=False,
+                               lazy=False):
+        """Parse many derivation files, one at a time.
+
+        This is a generator, so only as many derivations are kept in
+        memory as the cache holds.
+
+        :param derivation_paths: Paths to derivation files.
+        :type derivation_paths: iterable of ``str``
+        :param keep_raw: As for :py:meth:`parse_derivation_file`.
+        :type keep_raw: ``bool``
+        :param lazy: As for :py:meth:`parse_derivation_file`.
+        :type lazy: ``bool``
+
+        :return: The parsed Derivation objects, in the order given.
+        :rtype: iterator of :py:class:`Derivation`
+        """
+        for derivation_path in derivation_paths:
+            yield Derivation.parse_derivation_file(
+                derivation_path, keep_raw=keep_raw, lazy=lazy)
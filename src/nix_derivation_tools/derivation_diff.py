@@ -1,10 +1,25 @@
-"""(WIP) Diffing of derivations."""
-from datadiff import diff
+"""Diffing of derivations.
+
+:py:func:`diff_derivations` finds the first difference between two
+derivations. :py:func:`diff_recursive` finds all of them, and follows
+changed input derivations down to where the changes originate: inputs
+are paired up by name, and within each pair the store paths of paired
+inputs are renamed before comparing, so a derivation which only changed
+because an input did shows no differences of its own.
+"""
+import os
+from collections import deque
+
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.store import path_hash
+from nix_derivation_tools.valuediff import (
+    STORE_HASH, diff_values, format_difference)
+
 
 def diff_derivations(left, right):
-    """Return a diff of one derivation with anright.
+    """Return a diff of one derivation with another.
 
-    Returns the first difference between them in this order:
+    Finds the first difference between them in this order:
 
     * Derivation name (not the full path, just the `name` attribute).
     * Output names
@@ -14,6 +29,14 @@ def diff_derivations(left, right):
     * Builder
     * Builder args
     * System
+
+    :return: ``equal``, or a tuple of the field's label, what only
+        ``left`` has and what only ``right`` has. For sets (output
+        names, input files, ...) those are set differences; for the
+        environment, dictionaries of the variables which were removed
+        or changed and those which were added or changed; otherwise the
+        two values.
+    :rtype: ``str`` or (``str``, ``object``, ``object``)
     """
     if left.name != right.name:
         return ("name", left.name, right.name)
@@ -39,6 +62,316 @@ def diff_derivations(left, right):
                 if outs != right_outs:
                     return ("outputs of derivation {}".format(i_deriv),
                             outs - right_outs, right_outs - outs)
-    if left.environment != right.environment:
-        return diff(left.environment, right.environment)
+    env_l, env_r = left.environment, right.environment
+    if env_l != env_r:
+        return ("environment",
+                {k: v for k, v in env_l.items() if env_r.get(k) != v},
+                {k: v for k, v in env_r.items() if env_l.get(k) != v})
+    if left.builder != right.builder:
+        return ("builder", left.builder, right.builder)
+    if left.builder_args != right.builder_args:
+        return ("builder args", left.builder_args, right.builder_args)
+    if left.system != right.system:
+        return ("system", left.system, right.system)
     return "equal"
+
+
+def derivation_name(path):
+    """The name of a derivation, as found in its path.
+
+    :param path: Path to a derivation, ``<store>/<hash>-<name>.drv``.
+    :type path: ``str``
+
+    :rtype: ``str``
+    """
+    base = os.path.basename(path)
+    if base.endswith(".drv"):
+        base = base[:-4]
+    return base.split("-", 1)[-1]
+
+
+def pair_by_name(left_paths, right_paths):
+    """Pair up two collections of derivation paths.
+
+    Identical paths are paired first, then the rest by name. Where
+    several derivations share a name, they're paired in path order.
+
+    :type left_paths: iterable of ``str``
+    :type right_paths: iterable of ``str``
+
+    :return: The pairs, and the left and right paths left unpaired.
+    :rtype: (``list`` of (``str``, ``str``), ``list`` of ``str``,
+        ``list`` of ``str``)
+    """
+    left_left = set(left_paths)
+    pairs, right_left = [], []
+    for path in right_paths:
+        if path in left_left:
+            left_left.remove(path)
+            pairs.append((path, path))
+        else:
+            right_left.append(path)
+    by_name = {}
+    for path in sorted(left_left):
+        by_name.setdefault(derivation_name(path), []).append(path)
+    right_only = []
+    for path in sorted(right_left):
+        candidates = by_name.get(derivation_name(path))
+        if candidates:
+            pairs.append((candidates.pop(0), path))
+        else:
+            right_only.append(path)
+    left_only = sorted(p for paths in by_name.values() for p in paths)
+    return pairs, left_only, right_only
+
+
+def rename_hashes(value, hashes):
+    """Replace store path hashes throughout a derivation field.
+
+    :param value: The field; strings inside lists, tuples, sets and
+        dictionaries are renamed too.
+    :param hashes: Replacement for each hash to rename.
+    :type hashes: ``dict`` of ``str`` to ``str``
+    """
+    if isinstance(value, str):
+        if len(hashes) == 0:
+            return value
+        return STORE_HASH.sub(lambda m: hashes.get(m.group(), m.group()),
+                              value)
+    elif isinstance(value, dict):
+        return {rename_hashes(k, hashes): rename_hashes(v, hashes)
+                for k, v in value.items()}
+    elif isinstance(value, (set, frozenset)):
+        return {rename_hashes(v, hashes) for v in value}
+    elif isinstance(value, (list, tuple)):
+        return type(value)(rename_hashes(v, hashes) for v in value)
+    return value
+
+
+def add_hash_renames(hashes, left, right):
+    """Record that the paths of one derivation become those of another.
+
+    :param hashes: Mapping to add to, from hashes of ``left``'s paths to
+        those of ``right``'s.
+    :type hashes: ``dict`` of ``str`` to ``str``
+    :type left: :py:class:`Derivation`
+    :type right: :py:class:`Derivation`
+    """
+    hashes[path_hash(left.path)] = path_hash(right.path)
+    right_outputs = right.output_mapping
+    for name, path in left.output_mapping.items():
+        if name in right_outputs:
+            hashes[path_hash(path)] = path_hash(right_outputs[name])
+
+
+class DerivationDiff(object):
+    """The differences between two derivations, and between the inputs
+    they were built from.
+
+    Differences are stored by field in :py:attr:`differences`, as
+    JSON-compatible values; paths of paired inputs are renamed first, so
+    only changes which originate in this derivation are recorded there.
+    Paired inputs whose paths differ are diffed in turn, in
+    :py:attr:`inputs`.
+    """
+
+    def __init__(self, left, right):
+        """Initializer.
+
+        :type left: :py:class:`Derivation`
+        :type right: :py:class:`Derivation`
+        """
+        self.left = left
+        self.right = right
+        self.differences = {}
+        # Diffs of paired input derivations whose paths differ.
+        self.inputs = []
+
+    @property
+    def is_cause(self):
+        """Whether this derivation has changes of its own."""
+        return len(self.differences) > 0
+
+    def walk(self):
+        """Yield this diff and those below it, each once.
+
+        :rtype: iterator of :py:class:`DerivationDiff`
+        """
+        seen = set()
+        stack = [self]
+        while stack:
+            current = stack.pop()
+            if id(current) in seen:
+                continue
+            seen.add(id(current))
+            yield current
+            stack.extend(reversed(current.inputs))
+
+    @property
+    def causes(self):
+        """Diffs below (and including) this one with changes of their own.
+
+        :rtype: ``list`` of :py:class:`DerivationDiff`
+        """
+        return [d for d in self.walk() if d.is_cause]
+
+    def as_dict(self):
+        """Convert to a JSON-compatible dictionary.
+
+        Each pair of derivations is described once, in ``pairs``, keyed
+        by the left path; ``inputs`` lists those keys.
+        """
+        pairs = {}
+        for current in self.walk():
+            pairs[current.left.path] = {
+                "right": current.right.path,
+                "differences": current.differences,
+                "inputs": [i.left.path for i in current.inputs]}
+        return {"left": self.left.path, "right": self.right.path,
+                "causes": [[c.left.path, c.right.path] for c in self.causes],
+                "pairs": pairs}
+
+    def chains(self):
+        """Find how this diff leads to each diff with changes of its own.
+
+        :return: For each cause, a shortest list of diffs from this one
+            to it, each an input of the one before.
+        :rtype: ``dict`` of :py:class:`DerivationDiff` to ``list``
+        """
+        parents = {id(self): None}
+        by_id = {id(self): self}
+        queue = deque([self])
+        result = {}
+        while queue:
+            current = queue.popleft()
+            if current.is_cause:
+                chain, key = [], id(current)
+                while key is not None:
+                    chain.append(by_id[key])
+                    key = parents[key]
+                result[current] = chain[::-1]
+            for child in current.inputs:
+                if id(child) not in parents:
+                    parents[id(child)] = id(current)
+                    by_id[id(child)] = child
+                    queue.append(child)
+        return result
+
+    def format(self):
+        """Describe the differences in a human-readable way.
+
+        Each derivation with changes of its own is shown with those
+        changes, and the chain of inputs leading to it.
+
+        :rtype: ``str``
+        """
+        chains = self.chains()
+        if len(chains) == 0:
+            return "equal"
+        lines = ["{} derivation(s) with changes of their own:"
+                 .format(len(chains))]
+        for cause, chain in sorted(chains.items(),
+                                   key=lambda i: i[0].right.path):
+            lines.append("")
+            lines.append("{} -> {}".format(cause.left.path,
+                                           cause.right.path))
+            if len(chain) > 1:
+                lines.append("  via {}".format(" -> ".join(
+                    derivation_name(d.right.path) for d in chain)))
+            for field, difference in sorted(cause.differences.items()):
+                lines.append("  {}:".format(field))
+                lines.extend(format_difference(difference, "    "))
+        return "\n".join(lines)
+
+
+def diff_recursive(left, right, mask_hashes=False):
+    """Diff two derivations, and the changed inputs they depend on.
+
+    Each pair of derivations is only compared once, however often it
+    turns up, so this is fast even when thousands of derivations differ
+    because of a single one.
+
+    :type left: :py:class:`Derivation`
+    :type right: :py:class:`Derivation`
+    :param mask_hashes: Also ignore differences in the hashes of store
+        paths which don't belong to paired inputs.
+    :type mask_hashes: ``bool``
+
+    :rtype: :py:class:`DerivationDiff`
+    """
+    memo = {}
+    root = DerivationDiff(left, right)
+    memo[left.path, right.path] = root
+    # Comparing a pair needs the renames of its paired inputs, so pairs
+    # are finished in post-order.
+    stack = [(root, None)]
+    while stack:
+        current, pairs = stack.pop()
+        if pairs is not None:
+            _compare(current, pairs, mask_hashes)
+            continue
+        pairs, removed, added = pair_by_name(
+            current.left.input_derivations, current.right.input_derivations)
+        stack.append((current, pairs))
+        if removed or added:
+            current.differences["input derivations"] = {
+                "type": "set", "added": added, "removed": removed}
+        for left_path, right_path in pairs:
+            if left_path == right_path:
+                continue
+            key = left_path, right_path
+            child = memo.get(key)
+            if child is None:
+                child = DerivationDiff(
+                    Derivation.parse_derivation_file(left_path),
+                    Derivation.parse_derivation_file(right_path))
+                memo[key] = child
+                stack.append((child, None))
+            current.inputs.append(child)
+    return root
+
+
+def _compare(current, pairs, mask_hashes):
+    """Fill in the differences of a pair of derivations.
+
+    :param pairs: Paths of the paired inputs of the two derivations.
+    :type pairs: ``list`` of (``str``, ``str``)
+    """
+    left, right = current.left, current.right
+    hashes = {}
+    for left_path, right_path in pairs:
+        if left_path != right_path:
+            add_hash_renames(hashes,
+                             Derivation.parse_derivation_file(left_path),
+                             Derivation.parse_derivation_file(right_path))
+    add_hash_renames(hashes, left, right)
+    differences = current.differences
+    fields = [("name", left.name, right.name),
+              ("output names", left.output_names, right.output_names),
+              ("input files", rename_hashes(left.input_files, hashes),
+               right.input_files)]
+    fields.extend(("outputs of {}".format(derivation_name(right_path)),
+                   set(left.input_derivations[left_path]),
+                   set(right.input_derivations[right_path]))
+                  for left_path, right_path in pairs)
+    fields.append(("environment", rename_hashes(left.environment, hashes),
+                   right.environment))
+    fields.extend((field, rename_hashes(getattr(left, field), hashes),
+                   getattr(right, field))
+                  for field in ("builder", "builder_args", "system"))
+    for field, left_value, right_value in fields:
+        difference = diff_values(left_value, right_value, mask_hashes)
+        if difference is not None:
+            differences[field] = difference
+    environment = differences.get("environment")
+    if environment is not None:
+        # Show short values as they really are, not as renamed. Keys
+        # may themselves have been renamed or masked, so those not found
+        # as they are are left alone.
+        for key, value in environment["changed"].items():
+            if value["type"] == "value" and key in left.environment:
+                value["left"] = left.environment[key]
+        removed = environment["removed"]
+        for key in removed:
+            if key in left.environment:
+                removed[key] = left.environment[key]
@@ -0,0 +1,319 @@
+"""Exporting closures to tables for offline analysis.
+
+A closure is written as a set of normalized tables, in which every
+string (paths, names, environment variables and their values, ...) is
+stored once in ``strings`` and referred to by its ``id`` elsewhere:
+
+* ``derivations(id, path, name, system, builder)``
+* ``builder_args(derivation, position, value)``
+* ``outputs(derivation, name, path, hash_algo, hash)``, where the last
+  two are null except for fixed-output derivations
+* ``input_derivations(derivation, input, output)``, where ``input`` is
+  the ``id`` of the input derivation
+* ``input_files(derivation, path)``
+* ``environment(derivation, key, value)``
+
+For example, to count the derivations using each environment variable
+in a SQLite export::
+
+    SELECT s.value, count(*) FROM environment e
+    JOIN strings s ON s.id = e.key GROUP BY e.key ORDER BY 2 DESC;
+
+The target is either a SQLite database, or a directory with one Parquet
+file per table (which needs ``pyarrow``). Rows are written in large
+batches as derivations are parsed, so the closure is never held in
+memory, only the strings and paths seen so far. They go to a temporary
+path next to the target, which is only renamed into place once the
+export is complete, so a failed export leaves nothing behind.
+"""
+import os
+import shutil
+import sqlite3
+
+from nix_derivation_tools.bulk import map_derivations
+
+# Columns of each table, all of them integers except ``strings.value``.
+TABLES = {
+    "strings": ("id", "value"),
+    "derivations": ("id", "path", "name", "system", "builder"),
+    "builder_args": ("derivation", "position", "value"),
+    "outputs": ("derivation", "name", "path", "hash_algo", "hash"),
+    "input_derivations": ("derivation", "input", "output"),
+    "input_files": ("derivation", "path"),
+    "environment": ("derivation", "key", "value"),
+}
+
+# Indexes created once everything has been written.
+INDEXES = (
+    ("derivations", "path"),
+    ("builder_args", "derivation"),
+    ("outputs", "derivation"),
+    ("outputs", "path"),
+    ("input_derivations", "derivation"),
+    ("input_derivations", "input"),
+    ("input_files", "derivation"),
+    ("environment", "derivation"),
+    ("environment", "key"),
+)
+
+FORMATS = ("sqlite", "parquet")
+
+# Rows buffered (over all tables) before they're written out.
+_BATCH_SIZE = 50000
+
+
+def _temporary_path(path):
+    """Check that an export target doesn't exist, and return where to
+    write it until it's complete.
+
+    :rtype: ``str``
+    """
+    if os.path.exists(path):
+        raise ValueError("{} already exists".format(path))
+    # In the same directory, so that it can be renamed into place.
+    return "{}.{}.tmp".format(path.rstrip(os.sep), os.getpid())
+
+
+def _remove(path):
+    """Remove a file or directory, if it exists."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _fields(deriv):
+    """The fields of a derivation, as sent back from worker processes."""
+    return (deriv.path, deriv.outputs, deriv.input_derivations,
+            deriv.input_files, deriv.system, deriv.builder,
+            deriv.builder_args, deriv.environment)
+
+
+class TableWriter(object):
+    """Turns derivations into rows, and writes them out in batches.
+
+    Subclasses write the rows somewhere, in :py:meth:`_write`.
+    """
+
+    def __init__(self):
+        self._strings = {}
+        self._derivations = {}
+        self._rows = {table: [] for table in TABLES}
+        self._buffered = 0
+        # Derivations whose rows have been added.
+        self.count = 0
+
+    def _string(self, value):
+        """The id of a string, adding it to ``strings`` if it's new."""
+        string_id = self._strings.get(value)
+        if string_id is None:
+            string_id = self._strings[value] = len(self._strings) + 1
+            self._rows["strings"].append((string_id, value))
+        return string_id
+
+    def _derivation(self, path):
+        """The id of a derivation, which may not have been added yet."""
+        deriv_id = self._derivations.get(path)
+        if deriv_id is None:
+            deriv_id = self._derivations[path] = len(self._derivations) + 1
+        return deriv_id
+
+    def add(self, path, outputs, input_derivations, input_files, system,
+            builder, builder_args, environment):
+        """Add the rows for a derivation, given its fields."""
+        string, rows = self._string, self._rows
+        deriv_id = self._derivation(path)
+        rows["derivations"].append((
+            deriv_id, string(path), string(environment.get("name", "")),
+            string(system), string(builder)))
+        rows["builder_args"].extend(
+            (deriv_id, position, string(arg))
+            for position, arg in enumerate(builder_args))
+        for name, value in outputs.items():
+            if isinstance(value, str):
+                rows["outputs"].append(
+                    (deriv_id, string(name), string(value), None, None))
+            else:
+                rows["outputs"].append(
+                    (deriv_id, string(name), string(value[0]),
+                     string(value[1]), string(value[2])))
+        for input_path, input_outputs in input_derivations.items():
+            input_id = self._derivation(input_path)
+            rows["input_derivations"].extend(
+                (deriv_id, input_id, string(output))
+                for output in input_outputs)
+        rows["input_files"].extend(
+            (deriv_id, string(input_file)) for input_file in input_files)
+        rows["environment"].extend(
+            (deriv_id, string(key), string(value))
+            for key, value in environment.items())
+        self.count += 1
+        self._buffered += 1 + len(environment) + len(input_derivations)
+        if self._buffered >= _BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write out all buffered rows."""
+        for table, rows in self._rows.items():
+            if len(rows) > 0:
+                self._write(table, rows)
+                self._rows[table] = []
+        self._buffered = 0
+
+    def _write(self, table, rows):
+        raise NotImplementedError()
+
+    def close(self):
+        """Write out what's left and finish."""
+        self.flush()
+
+    def abort(self):
+        """Stop, discarding everything written."""
+
+
+class SQLiteWriter(TableWriter):
+    """Writes tables to a new SQLite database."""
+
+    def __init__(self, path):
+        """Initializer.
+
+        :param path: Path to the database, which mustn't exist yet.
+        :type path: ``str``
+        """
+        super(SQLiteWriter, self).__init__()
+        self._path = path
+        self._temporary = _temporary_path(path)
+        _remove(self._temporary)
+        self._conn = sqlite3.connect(self._temporary)
+        # Nothing is lost if we crash part-way through; the export is
+        # just started again.
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        with self._conn:
+            for table, columns in TABLES.items():
+                definitions = [
+                    "{} {}".format(column, "TEXT" if table == "strings"
+                                   and column == "value" else "INTEGER")
+                    for column in columns]
+                self._conn.execute("CREATE TABLE {} ({})".format(
+                    table, ", ".join(definitions)))
+
+    def flush(self):
+        # Each batch goes in as one transaction.
+        with self._conn:
+            super(SQLiteWriter, self).flush()
+
+    def _write(self, table, rows):
+        self._conn.executemany("INSERT INTO {} VALUES ({})".format(
+            table, ", ".join("?" * len(TABLES[table]))), rows)
+
+    def close(self):
+        super(SQLiteWriter, self).close()
+        with self._conn:
+            for table, column in INDEXES:
+                self._conn.execute("CREATE INDEX {0}_{1} ON {0} ({1})"
+                                   .format(table, column))
+        self._conn.close()
+        os.replace(self._temporary, self._path)
+
+    def abort(self):
+        self._conn.close()
+        _remove(self._temporary)
+
+
+class ParquetWriter(TableWriter):
+    """Writes tables to Parquet files in a new directory."""
+
+    def __init__(self, path):
+        """Initializer.
+
+        :param path: Path to the directory, which mustn't exist yet.
+        :type path: ``str``
+        """
+        super(ParquetWriter, self).__init__()
+        temporary = _temporary_path(path)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError("Exporting to Parquet needs pyarrow")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        _remove(temporary)
+        os.makedirs(temporary)
+        self._path = path
+        self._temporary = temporary
+        self._schemas = {
+            table: pyarrow.schema([
+                (column, pyarrow.string() if table == "strings"
+                 and column == "value" else pyarrow.int64())
+                for column in columns])
+            for table, columns in TABLES.items()}
+        self._writers = {}
+
+    def _write(self, table, rows):
+        writer = self._writers.get(table)
+        if writer is None:
+            writer = self._writers[table] = self._pq.ParquetWriter(
+                os.path.join(self._temporary, table + ".parquet"),
+                self._schemas[table])
+        columns = list(zip(*rows))
+        writer.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(column, type=field.type)
+             for column, field in zip(columns, self._schemas[table])],
+            schema=self._schemas[table]))
+
+    def close(self):
+        super(ParquetWriter, self).close()
+        for table in TABLES:
+            if table not in self._writers:
+                # Still write the table, even if it's empty.
+                self._pq.write_table(
+                    self._schemas[table].empty_table(),
+                    os.path.join(self._temporary, table + ".parquet"))
+        for writer in self._writers.values():
+            writer.close()
+        os.replace(self._temporary, self._path)
+
+    def abort(self):
+        for writer in self._writers.values():
+            try:
+                writer.close()
+            except Exception:
+                # It's being thrown away anyway.
+                pass
+        _remove(self._temporary)
+
+
+def export_closure(paths, target, format="sqlite", jobs=1):
+    """Write the closure of some derivations to tables.
+
+    :param paths: Paths to the root derivations.
+    :type paths: iterable of ``str``
+    :param target: Path of the SQLite database or Parquet directory to
+        create.
+    :type target: ``str``
+    :param format: ``sqlite`` or ``parquet``.
+    :type format: ``str``
+    :param jobs: Number of processes to parse with, as for
+        :py:func:`~nix_derivation_tools.bulk.map_derivations`.
+    :type jobs: ``int`` or ``NoneType``
+
+    :return: The number of derivations written.
+    :rtype: ``int``
+    """
+    if format == "sqlite":
+        writer = SQLiteWriter(target)
+    elif format == "parquet":
+        writer = ParquetWriter(target)
+    else:
+        raise ValueError("Invalid format: {}".format(format))
+    try:
+        for fields in map_derivations(_fields, paths, closure=True,
+                                      jobs=jobs):
+            writer.add(*fields)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.count
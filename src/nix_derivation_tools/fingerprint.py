@@ -0,0 +1,126 @@
+"""Fingerprints identifying derivations modulo their inputs' paths.
+
+When a low-level derivation changes, the paths of everything depending
+on it change too, even where nothing else about them did. A derivation's
+fingerprint is a hash of its contents in which store paths are renamed
+by their hash part, much as Nix's ``hashDerivationModulo`` does: an
+input derivation's hash becomes that input's fingerprint, the hash of
+one of its outputs becomes the fingerprint followed by the output's
+name, and the hashes of the derivation's own outputs become their
+names. Two
+derivations have the same fingerprint exactly when they're the same
+apart from such churn, so once a closure has been fingerprinted, which
+takes one pass over it, comparing any two derivations in it is cheap.
+
+Fixed-output derivations are fingerprinted by their name and declared
+output hash, since that's all their dependents can observe. Floating
+content-addressed derivations, whose output hash isn't known until
+they're built, are fingerprinted like any other.
+"""
+import hashlib
+import json
+
+from nix_derivation_tools.closure import load_closure
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.derivation_diff import rename_hashes
+from nix_derivation_tools.hashing import _fixed_output
+from nix_derivation_tools.store import path_hash
+
+
+def _compute(deriv, inputs):
+    """Fingerprint a derivation whose inputs are fingerprinted already.
+
+    :param inputs: The input derivations.
+    :type inputs: ``list`` of :py:class:`Derivation`
+
+    :rtype: ``str``
+    """
+    outputs = deriv.outputs
+    fixed = _fixed_output(deriv)
+    if fixed is not None:
+        _, hash_algo, hash_ = fixed
+        canonical = ["fixed", deriv.environment.get("name"), hash_algo,
+                     hash_]
+    else:
+        # Floating outputs have no path yet, so nothing to rename.
+        hashes = {path_hash(path): "output:" + name
+                  for name, path in deriv.output_mapping.items() if path}
+        input_derivations = []
+        for input_deriv in inputs:
+            fingerprint = input_deriv._fingerprint
+            hashes[path_hash(input_deriv.path)] = fingerprint
+            for name, path in input_deriv.output_mapping.items():
+                if path:
+                    hashes[path_hash(path)] = "{}:{}".format(fingerprint,
+                                                             name)
+            input_derivations.append(
+                [fingerprint,
+                 sorted(deriv.input_derivations[input_deriv.path])])
+        canonical = {
+            "outputs": sorted(outputs),
+            "input_derivations": sorted(input_derivations),
+            "input_files": sorted(rename_hashes(deriv.input_files, hashes)),
+            "system": deriv.system,
+            "builder": rename_hashes(deriv.builder, hashes),
+            "builder_args": rename_hashes(deriv.builder_args, hashes),
+            "environment": rename_hashes(deriv.environment, hashes),
+        }
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def fingerprint(deriv):
+    """Return the fingerprint of a derivation.
+
+    Fingerprints are computed bottom-up over the derivation's closure and
+    kept on each derivation, so asking again is free.
+
+    :param deriv: The derivation.
+    :type deriv: :py:class:`Derivation`
+
+    :return: A hexadecimal SHA-256 digest.
+    :rtype: ``str``
+    """
+    stack = [deriv]
+    while stack:
+        current = stack[-1]
+        if current._fingerprint is not None:
+            stack.pop()
+            continue
+        inputs = [Derivation.parse_derivation_file(path)
+                  for path in current.input_derivations]
+        missing = [i for i in inputs if i._fingerprint is None]
+        if len(missing) > 0:
+            stack.extend(missing)
+            continue
+        current._fingerprint = _compute(current, inputs)
+        stack.pop()
+    return deriv._fingerprint
+
+
+def equivalent(left, right):
+    """Check whether two derivations are the same modulo their inputs'
+    paths.
+
+    :type left: :py:class:`Derivation`
+    :type right: :py:class:`Derivation`
+
+    :rtype: ``bool``
+    """
+    return left is right or fingerprint(left) == fingerprint(right)
+
+
+def fingerprint_closure(paths, jobs=None):
+    """Fingerprint some derivations and everything they depend on.
+
+    :param paths: Paths to the root derivations.
+    :type paths: ``list`` of ``str``
+    :param jobs: Number of processes to parse with, as for
+        :py:func:`~nix_derivation_tools.closure.load_closure`.
+    :type jobs: ``int`` or ``NoneType``
+
+    :return: The fingerprint of each derivation in the closure.
+    :rtype: ``dict`` of ``str`` to ``str``
+    """
+    return {path: fingerprint(deriv)
+            for path, deriv in load_closure(paths, jobs=jobs).items()}
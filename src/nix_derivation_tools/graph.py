@@ -0,0 +1,223 @@
+"""An index of the dependency graph of a closure of derivations.
+
+Walking ``input_derivations`` only goes one way, and each step means
+looking a derivation up by path. :py:class:`DerivationGraph` numbers
+the derivations of a closure and stores their dependencies, in both
+directions, as flat arrays of those numbers, so questions like "what
+depends on this?" take time proportional to the edges visited and no
+further parsing.
+"""
+from array import array
+from collections import deque
+
+from nix_derivation_tools.cache import normalize_derivation_path
+from nix_derivation_tools.closure import load_closure
+from nix_derivation_tools.derivation import Derivation
+
+
+def _adjacency(edge_lists):
+    """Pack lists of node numbers into offsets and targets arrays.
+
+    The edges of node ``i`` are ``targets[offsets[i]:offsets[i + 1]]``.
+    """
+    offsets, targets = array("l", [0]), array("l")
+    for edges in edge_lists:
+        targets.extend(edges)
+        offsets.append(len(targets))
+    return offsets, targets
+
+
+class DerivationGraph(object):
+    """The dependency graph of a closure of derivations.
+
+    Derivations are identified by node numbers, which index
+    :py:attr:`paths`; methods accept and return these numbers. Edges go
+    from a derivation to the input derivations it uses.
+    """
+
+    def __init__(self, derivations, roots=()):
+        """Initializer.
+
+        :param derivations: Derivations making up the graph, keyed by
+            path, such as returned by
+            :py:func:`~nix_derivation_tools.closure.load_closure`. Inputs
+            which aren't included are left out of the graph.
+        :type derivations: ``dict`` of ``str`` to :py:class:`Derivation`
+        :param roots: Paths of the derivations the graph was built from.
+        :type roots: ``list`` of ``str``
+        """
+        self.paths = sorted(derivations)
+        self.index = {path: i for i, path in enumerate(self.paths)}
+        forward = []
+        for path in self.paths:
+            forward.append(sorted(
+                self.index[input_path]
+                for input_path in derivations[path].input_derivations
+                if input_path in self.index))
+        reverse = [[] for _ in self.paths]
+        for node, inputs in enumerate(forward):
+            for input_node in inputs:
+                reverse[input_node].append(node)
+        self._forward = _adjacency(forward)
+        self._reverse = _adjacency(reverse)
+        self.roots = [self.node(path) for path in roots]
+        self._order = None
+
+    @classmethod
+    def from_roots(cls, paths, jobs=None):
+        """Build the graph of everything some derivations depend on.
+
+        :param paths: Paths to the root derivations.
+        :type paths: ``list`` of ``str``
+        :param jobs: Number of processes to parse with, as for
+            :py:func:`~nix_derivation_tools.closure.load_closure`.
+        :type jobs: ``int`` or ``NoneType``
+
+        :rtype: :py:class:`DerivationGraph`
+        """
+        paths = list(paths)
+        return cls(load_closure(paths, jobs=jobs), roots=paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return normalize_derivation_path(path) in self.index
+
+    def node(self, path):
+        """Return the node number of a derivation.
+
+        :param path: Path to the derivation.
+        :type path: ``str``
+
+        :raises: ``ValueError`` if the derivation isn't in the graph.
+        :rtype: ``int``
+        """
+        try:
+            return self.index[normalize_derivation_path(path)]
+        except KeyError:
+            raise ValueError("Derivation {} is not in the graph"
+                             .format(path))
+
+    def derivation(self, node):
+        """Return the derivation of a node.
+
+        :rtype: :py:class:`Derivation`
+        """
+        return Derivation.parse_derivation_file(self.paths[node])
+
+    def inputs(self, node):
+        """Nodes of the input derivations of a node.
+
+        :rtype: ``array`` of ``int``
+        """
+        offsets, targets = self._forward
+        return targets[offsets[node]:offsets[node + 1]]
+
+    def dependents(self, node):
+        """Nodes of the derivations which use a node directly.
+
+        :rtype: ``array`` of ``int``
+        """
+        offsets, targets = self._reverse
+        return targets[offsets[node]:offsets[node + 1]]
+
+    @property
+    def edge_count(self):
+        """Number of dependencies in the graph."""
+        return len(self._forward[1])
+
+    def topological_order(self):
+        """Return all nodes, each after every node it depends on.
+
+        :rtype: ``list`` of ``int``
+        """
+        if self._order is None:
+            offsets, targets = self._forward
+            remaining = [offsets[i + 1] - offsets[i]
+                         for i in range(len(self.paths))]
+            ready = deque(i for i, count in enumerate(remaining)
+                          if count == 0)
+            order = []
+            while ready:
+                node = ready.popleft()
+                order.append(node)
+                for dependent in self.dependents(node):
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        ready.append(dependent)
+            if len(order) != len(self.paths):
+                raise ValueError("Dependency graph contains a cycle")
+            self._order = order
+        return self._order
+
+    def _reachable(self, nodes, adjacency):
+        offsets, targets = adjacency
+        seen = set(nodes)
+        stack = list(seen)
+        while stack:
+            node = stack.pop()
+            for other in targets[offsets[node]:offsets[node + 1]]:
+                if other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+        return seen
+
+    def closure(self, nodes):
+        """Find everything some nodes depend on, including themselves.
+
+        :param nodes: Nodes to start from.
+        :type nodes: ``list`` of ``int``
+
+        :rtype: ``set`` of ``int``
+        """
+        return self._reachable(nodes, self._forward)
+
+    def reverse_closure(self, nodes):
+        """Find everything which depends on some nodes, including them.
+
+        :param nodes: Nodes to start from.
+        :type nodes: ``list`` of ``int``
+
+        :rtype: ``set`` of ``int``
+        """
+        return self._reachable(nodes, self._reverse)
+
+    def sorted(self, nodes):
+        """Put some nodes in topological order.
+
+        :param nodes: The nodes.
+        :type nodes: ``set`` of ``int``
+
+        :rtype: ``list`` of ``int``
+        """
+        return [node for node in self.topological_order() if node in nodes]
+
+    def why_depends(self, source, target):
+        """Find a shortest chain of dependencies from one node to another.
+
+        :param source: The depending node.
+        :type source: ``int``
+        :param target: The node depended on.
+        :type target: ``int``
+
+        :return: Nodes from ``source`` to ``target``, each an input of
+            the one before, or ``None`` if ``source`` doesn't depend on
+            ``target``.
+        :rtype: ``list`` of ``int`` or ``NoneType``
+        """
+        parents = {source: None}
+        queue = deque([source])
+        while queue:
+            node = queue.popleft()
+            if node == target:
+                chain = []
+                while node is not None:
+                    chain.append(node)
+                    node = parents[node]
+                return chain[::-1]
+            for input_node in self.inputs(node):
+                if input_node not in parents:
+                    parents[input_node] = node
+                    queue.append(input_node)
+        return None
@@ -0,0 +1,343 @@
+"""Computing store paths of derivations as Nix does, and checking them.
+
+The output paths of a derivation are determined by a hash of the
+derivation itself (``hashDerivationModulo`` in Nix), in which each input
+derivation's path is replaced by that input's own hash, and the output
+paths being computed are left blank. Fixed-output derivations are hashed
+by their declared output hash alone. The path of the ``.drv`` file is in
+turn derived from a hash of its contents.
+
+:py:class:`DerivationHasher` computes these, remembering the hash of
+every derivation it has seen, and :py:func:`verify_closure` uses it to
+check a whole closure without calling Nix.
+"""
+import hashlib
+import os
+
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.graph import DerivationGraph
+
+# Nix's base-32 alphabet, which omits e, o, u and t.
+BASE32_CHARS = "0123456789abcdfghijklmnpqrsvwxyz"
+
+
+def nix_base32(data):
+    """Encode bytes in Nix's variant of base 32.
+
+    :type data: ``bytes``
+
+    :rtype: ``str``
+    """
+    length = (len(data) * 8 - 1) // 5 + 1
+    chars = []
+    for n in range(length - 1, -1, -1):
+        bit = n * 5
+        i, j = bit // 8, bit % 8
+        c = data[i] >> j
+        if i + 1 < len(data):
+            c |= data[i + 1] << (8 - j)
+        chars.append(BASE32_CHARS[c & 0x1f])
+    return "".join(chars)
+
+
+def compress_hash(digest, size):
+    """XOR-fold a hash down to ``size`` bytes.
+
+    :rtype: ``bytes``
+    """
+    result = bytearray(size)
+    for i, byte in enumerate(digest):
+        result[i % size] ^= byte
+    return bytes(result)
+
+
+def make_store_path(path_type, digest, name, store_dir):
+    """Compute a store path from a type, a SHA-256 digest and a name.
+
+    :param path_type: E.g. ``output:out``, ``source`` or ``text:<refs>``.
+    :type path_type: ``str``
+    :param digest: The SHA-256 digest.
+    :type digest: ``bytes``
+    :param name: The name part of the path.
+    :type name: ``str``
+    :param store_dir: The store directory, e.g. ``/nix/store``.
+    :type store_dir: ``str``
+
+    :rtype: ``str``
+    """
+    fingerprint = "{}:sha256:{}:{}:{}".format(path_type, digest.hex(),
+                                              store_dir, name)
+    hashed = hashlib.sha256(fingerprint.encode("utf-8")).digest()
+    return "{}/{}-{}".format(store_dir,
+                             nix_base32(compress_hash(hashed, 20)), name)
+
+
+def output_path_name(name, output):
+    """The name part of an output's path.
+
+    :rtype: ``str``
+    """
+    return name if output == "out" else "{}-{}".format(name, output)
+
+
+def make_fixed_output_path(hash_algo, hash_, name, store_dir):
+    """Compute the path of a fixed output.
+
+    :param hash_algo: The algorithm, prefixed with ``r:`` if the hash
+        is of the NAR serialization, as in a derivation file.
+    :type hash_algo: ``str``
+    :param hash_: The expected hash, in base 16.
+    :type hash_: ``str``
+
+    :rtype: ``str``
+    """
+    if hash_algo == "r:sha256":
+        return make_store_path("source", bytes.fromhex(hash_), name,
+                               store_dir)
+    inner = "fixed:out:{}:{}:".format(hash_algo, hash_)
+    return make_store_path("output:out",
+                           hashlib.sha256(inner.encode("utf-8")).digest(),
+                           name, store_dir)
+
+
+def make_text_path(name, contents, references, store_dir):
+    """Compute the path of a text file added to the store, such as a
+    ``.drv`` file.
+
+    :param references: Store paths the text refers to.
+    :type references: iterable of ``str``
+
+    :rtype: ``str``
+    """
+    path_type = ":".join(["text"] + sorted(references))
+    return make_store_path(path_type,
+                           hashlib.sha256(contents.encode("utf-8")).digest(),
+                           name, store_dir)
+
+
+def _fixed_output(deriv):
+    """Return the output of a fixed-output derivation, or ``None``."""
+    outputs = deriv.outputs
+    if len(outputs) != 1 or "out" not in outputs:
+        return None
+    value = outputs["out"]
+    if isinstance(value, str) or value[2] == "":
+        return None
+    return value
+
+
+class DerivationHasher(object):
+    """Computes Nix's hashes of derivations, remembering each one."""
+
+    def __init__(self, known=None):
+        """Initializer.
+
+        :param known: Hashes already computed, by derivation path, as
+            from :py:attr:`hashes`.
+        :type known: ``dict`` of ``str`` to ``bytes`` or ``NoneType``
+        """
+        # Maps derivation paths to their hash modulo fixed outputs.
+        self.hashes = dict(known or {})
+
+    def hash_modulo(self, deriv, mask_outputs=False):
+        """Nix's ``hashDerivationModulo``.
+
+        :param deriv: The derivation.
+        :type deriv: :py:class:`Derivation`
+        :param mask_outputs: Leave the derivation's own output paths
+            blank, as when computing them.
+        :type mask_outputs: ``bool``
+
+        :return: The SHA-256 digest.
+        :rtype: ``bytes``
+        """
+        if not mask_outputs and deriv.path in self.hashes:
+            return self.hashes[deriv.path]
+        fixed = _fixed_output(deriv)
+        if fixed is not None:
+            # The output paths are part of the hash here, but they're
+            # determined by the output hash, so there's nothing to mask.
+            path, hash_algo, hash_ = fixed
+            text = "fixed:out:{}:{}:{}".format(hash_algo, hash_, path)
+            digest = hashlib.sha256(text.encode("utf-8")).digest()
+            self.hashes[deriv.path] = digest
+            return digest
+        inputs = {}
+        for path, outputs in deriv.input_derivations.items():
+            digest = self.hashes.get(path)
+            if digest is None:
+                digest = self._hash_input(path)
+            inputs[digest.hex()] = outputs
+        text = deriv.unparse(mask_outputs=mask_outputs,
+                             input_derivations=inputs)
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        if not mask_outputs:
+            self.hashes[deriv.path] = digest
+        return digest
+
+    def _hash_input(self, path):
+        """Hash an input derivation and everything below it, without
+        recursing."""
+        stack = [path]
+        while stack:
+            current = stack[-1]
+            if current in self.hashes:
+                stack.pop()
+                continue
+            deriv = Derivation.parse_derivation_file(current)
+            missing = [p for p in deriv.input_derivations
+                       if p not in self.hashes]
+            if _fixed_output(deriv) is None and len(missing) > 0:
+                stack.extend(missing)
+                continue
+            self.hash_modulo(deriv)
+            stack.pop()
+        return self.hashes[path]
+
+    def output_paths(self, deriv):
+        """Compute the paths a derivation's outputs should have.
+
+        :param deriv: The derivation.
+        :type deriv: :py:class:`Derivation`
+
+        :return: The path of each output.
+        :rtype: ``dict`` of ``str`` to ``str``
+        """
+        store_dir = os.path.dirname(deriv.path)
+        name = deriv.environment["name"]
+        fixed = _fixed_output(deriv)
+        if fixed is not None:
+            return {"out": make_fixed_output_path(fixed[1], fixed[2], name,
+                                                  store_dir)}
+        digest = self.hash_modulo(deriv, mask_outputs=True)
+        return {output: make_store_path("output:" + output, digest,
+                                        output_path_name(name, output),
+                                        store_dir)
+                for output in deriv.outputs}
+
+    @staticmethod
+    def derivation_path(deriv):
+        """Compute the path a derivation's file should have.
+
+        :param deriv: The derivation.
+        :type deriv: :py:class:`Derivation`
+
+        :rtype: ``str``
+        """
+        references = set(deriv.input_derivations) | set(deriv.input_files)
+        return make_text_path(deriv.environment["name"] + ".drv",
+                              deriv.unparse(), references,
+                              os.path.dirname(deriv.path))
+
+    def verify(self, deriv):
+        """Check that a derivation is consistent.
+
+        :param deriv: The derivation.
+        :type deriv: :py:class:`Derivation`
+
+        :return: Descriptions of any problems found.
+        :rtype: ``list`` of ``str``
+        """
+        problems = []
+        expected = self.output_paths(deriv)
+        for output, path in sorted(deriv.output_mapping.items()):
+            if path == "":
+                # Content-addressed outputs aren't known in advance.
+                continue
+            if path != expected[output]:
+                problems.append("output {} is {}, expected {}".format(
+                    output, path, expected[output]))
+            if deriv.environment.get(output) != path:
+                problems.append("environment variable {} doesn't match "
+                                "the output path".format(output))
+        if deriv.unparse() != deriv.raw:
+            problems.append("file is not in canonical form")
+        expected_path = self.derivation_path(deriv)
+        if expected_path != deriv.path:
+            problems.append("derivation path should be {}"
+                            .format(expected_path))
+        return problems
+
+
+def _verify_level(paths, known):
+    """Verify some derivations in a worker process.
+
+    :param known: Hashes of (at least) their input derivations.
+
+    :return: Problems found with each derivation, and the hash of each.
+    :rtype: ``list`` of (``str``, ``list`` of ``str``, ``bytes``)
+    """
+    hasher = DerivationHasher(known)
+    results = []
+    for path in paths:
+        deriv = Derivation.parse_derivation_file(path)
+        problems = hasher.verify(deriv)
+        results.append((path, problems, hasher._hash_input(path)))
+    return results
+
+
+def verify_closure(paths, jobs=None):
+    """Check every derivation in a closure.
+
+    Derivations are hashed from the bottom of the graph up, one layer at
+    a time; the derivations in a layer are independent of each other,
+    so they're split between worker processes.
+
+    :param paths: Paths to the root derivations.
+    :type paths: ``list`` of ``str``
+    :param jobs: Number of processes to use. Defaults to the number of
+        CPUs.
+    :type jobs: ``int`` or ``NoneType``
+
+    :return: Problems found with each derivation which has any.
+    :rtype: ``dict`` of ``str`` to ``list`` of ``str``
+    """
+    jobs = jobs or os.cpu_count() or 1
+    graph = DerivationGraph.from_roots(paths, jobs=jobs)
+    # Put each node one layer above the highest of its inputs.
+    depth = [0] * len(graph)
+    layers = []
+    for node in graph.topological_order():
+        inputs = graph.inputs(node)
+        depth[node] = 1 + max((depth[i] for i in inputs), default=-1)
+        if depth[node] == len(layers):
+            layers.append([])
+        layers[depth[node]].append(node)
+    problems = {}
+    hashes = {}
+    executor = None
+    if jobs > 1:
+        # Only imported when needed, as in bulk.py.
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(jobs)
+    try:
+        for layer in layers:
+            layer_paths = [graph.paths[node] for node in layer]
+            if executor is None or len(layer) < 2 * jobs:
+                chunks = [layer_paths]
+            else:
+                size = -(-len(layer_paths) // (jobs * 4))
+                chunks = [layer_paths[i:i + size]
+                          for i in range(0, len(layer_paths), size)]
+            # Send each chunk only the hashes of its inputs.
+            arguments = []
+            for chunk in chunks:
+                known = {}
+                for path in chunk:
+                    for input_node in graph.inputs(graph.index[path]):
+                        input_path = graph.paths[input_node]
+                        known[input_path] = hashes[input_path]
+                arguments.append((chunk, known))
+            if executor is None or len(chunks) == 1:
+                results = [_verify_level(*a) for a in arguments]
+            else:
+                results = executor.map(_verify_level, *zip(*arguments))
+            for chunk_results in results:
+                for path, path_problems, digest in chunk_results:
+                    hashes[path] = digest
+                    if path_problems:
+                        problems[path] = path_problems
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return problems
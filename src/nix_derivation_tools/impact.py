@@ -0,0 +1,192 @@
+"""Working out which changes cause which rebuilds.
+
+Given the closures of a release before and after some change, we pair
+up their derivations by name, starting from the roots and following
+inputs. A derivation whose path changed has either changed itself, or
+only changed because some of its inputs did; to tell which, its old
+fields are compared with its new ones after renaming every store path
+of a paired derivation to its new equivalent. Those which still differ
+are the root causes, and everything depending on them is rebuilt.
+
+Each pair is compared at most once, however many derivations share it.
+"""
+from collections import deque
+
+from nix_derivation_tools.derivation_diff import (
+    add_hash_renames, pair_by_name, rename_hashes)
+from nix_derivation_tools.graph import DerivationGraph
+
+
+def _pair_nodes(old_graph, old_nodes, new_graph, new_nodes):
+    """Pair up two lists of nodes with
+    :py:func:`~nix_derivation_tools.derivation_diff.pair_by_name`.
+
+    :return: Pairs of new and old node.
+    :rtype: ``list`` of (``int``, ``int``)
+    """
+    pairs = pair_by_name((old_graph.paths[n] for n in old_nodes),
+                         (new_graph.paths[n] for n in new_nodes))[0]
+    return [(new_graph.index[new], old_graph.index[old])
+            for old, new in pairs]
+
+
+def match_graphs(old_graph, new_graph):
+    """Pair the derivations of two graphs.
+
+    Roots are paired by name, then the inputs of each pair, and so on,
+    so a name which occurs more than once in a closure is resolved by
+    where it's used.
+
+    :type old_graph: :py:class:`DerivationGraph`
+    :type new_graph: :py:class:`DerivationGraph`
+
+    :return: The old node paired with each new node which has one.
+    :rtype: ``dict`` of ``int`` to ``int``
+    """
+    matches, used = {}, set()
+    queue = deque(_pair_nodes(old_graph, old_graph.roots,
+                              new_graph, new_graph.roots))
+    while queue:
+        new_node, old_node = queue.popleft()
+        if new_node in matches or old_node in used:
+            continue
+        matches[new_node] = old_node
+        used.add(old_node)
+        queue.extend(_pair_nodes(old_graph, old_graph.inputs(old_node),
+                                 new_graph, new_graph.inputs(new_node)))
+    return matches
+
+
+class ImpactReport(object):
+    """What changed between two closures, and why."""
+
+    def __init__(self, old_graph, new_graph):
+        """Initializer; the comparison is done here.
+
+        :type old_graph: :py:class:`DerivationGraph`
+        :type new_graph: :py:class:`DerivationGraph`
+        """
+        self.old_graph = old_graph
+        self.new_graph = new_graph
+        self.matches = match_graphs(old_graph, new_graph)
+        self._hashes = self._hash_mapping()
+        # Maps new nodes which changed themselves to the names of the
+        # fields which differ (or "added", if they have no counterpart).
+        self.root_causes = {}
+        # New nodes which changed only because their inputs did.
+        self.propagated = set()
+        for node in new_graph.topological_order():
+            reasons = self._compare(node)
+            if reasons is None:
+                continue
+            if len(reasons) > 0:
+                self.root_causes[node] = reasons
+            else:
+                self.propagated.add(node)
+
+    def _hash_mapping(self):
+        """Map hashes of old store paths to those of their counterparts."""
+        hashes = {}
+        for new_node, old_node in self.matches.items():
+            add_hash_renames(hashes, self.old_graph.derivation(old_node),
+                             self.new_graph.derivation(new_node))
+        return hashes
+
+    def _compare(self, node):
+        """Find why a new node differs from its counterpart.
+
+        :return: ``None`` if it's unchanged, otherwise the fields which
+            differ other than through renamed paths.
+        :rtype: ``list`` of ``str`` or ``NoneType``
+        """
+        if node not in self.matches:
+            return ["added"]
+        old = self.old_graph.derivation(self.matches[node])
+        new = self.new_graph.derivation(node)
+        if old.path == new.path:
+            return None
+        return [field for field in new.FIELDS
+                if rename_hashes(getattr(old, field), self._hashes)
+                != getattr(new, field)]
+
+    @property
+    def affected(self):
+        """New nodes which are rebuilt, whether root causes or not.
+
+        :rtype: ``set`` of ``int``
+        """
+        return set(self.root_causes) | self.propagated
+
+    def downstream(self, node):
+        """Nodes rebuilt because of a root cause, other than itself.
+
+        :rtype: ``set`` of ``int``
+        """
+        return self.new_graph.reverse_closure([node]) - {node}
+
+    def as_dict(self, list_affected=False):
+        """Convert to a JSON-compatible dictionary.
+
+        :param list_affected: Include the paths of all affected
+            derivations, not just how many there are.
+        :type list_affected: ``bool``
+        """
+        paths = self.new_graph.paths
+        result = {
+            "root_causes": [
+                {"path": paths[node],
+                 "old_path": self.old_path(node),
+                 "fields": reasons,
+                 "downstream": len(self.downstream(node))}
+                for node, reasons in sorted(self.root_causes.items(),
+                                            key=lambda i: paths[i[0]])],
+            "affected": len(self.affected),
+            "total": len(self.new_graph),
+        }
+        if list_affected:
+            result["affected_paths"] = [
+                paths[node] for node in self.new_graph.sorted(self.affected)]
+        return result
+
+    def old_path(self, node):
+        """Path of the old derivation paired with a new node, if any.
+
+        :rtype: ``str`` or ``NoneType``
+        """
+        if node not in self.matches:
+            return None
+        return self.old_graph.paths[self.matches[node]]
+
+    def summary(self, list_affected=False):
+        """Describe the report in a human-readable way.
+
+        :rtype: ``str``
+        """
+        report = self.as_dict(list_affected)
+        lines = ["{} of {} derivations rebuilt, due to {} root cause(s):"
+                 .format(report["affected"], report["total"],
+                         len(report["root_causes"]))]
+        for cause in report["root_causes"]:
+            lines.append("  {} ({}; {} downstream)".format(
+                cause["path"], ", ".join(cause["fields"]),
+                cause["downstream"]))
+        if list_affected:
+            lines.append("Rebuilt:")
+            lines.extend("  " + path for path in report["affected_paths"])
+        return "\n".join(lines)
+
+
+def analyse_impact(old_roots, new_roots, jobs=None):
+    """Compare the closures of two sets of root derivations.
+
+    :param old_roots: Paths to the derivations before the change.
+    :type old_roots: ``list`` of ``str``
+    :param new_roots: Paths to the derivations after the change.
+    :type new_roots: ``list`` of ``str``
+    :param jobs: Number of processes to parse with.
+    :type jobs: ``int`` or ``NoneType``
+
+    :rtype: :py:class:`ImpactReport`
+    """
+    return ImpactReport(DerivationGraph.from_roots(old_roots, jobs=jobs),
+                        DerivationGraph.from_roots(new_roots, jobs=jobs))
@@ -0,0 +1,276 @@
+"""Previewing builds again, reusing what an earlier preview found.
+
+Successive evaluations of the same project mostly produce the same
+derivations, whose outputs mostly stay where they were. A
+:py:class:`PreviewState` saved after one preview holds the part of the
+graph it walked (the outputs and inputs of each derivation, which never
+change since derivation files are immutable) and what was found for
+each output: present in the store, in a binary cache, or neither.
+
+:py:func:`preview_incremental` then walks the graph as
+:py:func:`~nix_derivation_tools.preview.preview_build` does, but only:
+
+* parses derivations it hasn't seen before;
+* checks the store for outputs which are new, or which may have been
+  added or removed since (see
+  :py:meth:`~nix_derivation_tools.store.StatPresence.changes`);
+* asks binary caches about outputs which are new, or which they didn't
+  have last time (outputs a cache had are assumed to still be there).
+
+The state is a JSON file, replaced atomically when saved. Only what
+the last preview walked is kept, so it doesn't grow without bound.
+
+Results are keyed by :py:class:`DerivationRef`, so derivations whose
+files weren't read during the walk aren't read for the result either,
+unless something more than their path is asked for.
+"""
+import json
+import os
+import tempfile
+
+from nix_derivation_tools import metrics
+from nix_derivation_tools.cache import normalize_derivation_path
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.store import get_store_presence
+
+# Bump when the file format changes; older files are then ignored.
+STATE_VERSION = 1
+
+# What was found for an output.
+PRESENT = "present"
+FETCH = "fetch"
+ABSENT = "absent"
+
+
+class PreviewState(object):
+    """What a preview found, to be reused by the next one."""
+
+    def __init__(self, graph=None, status=None, store_snapshot=None,
+                 binary_caches=None):
+        """Initializer; the defaults describe a state with nothing in it.
+
+        :param graph: The output paths and input derivations of each
+            derivation walked, by derivation path.
+        :type graph: ``dict`` of ``str`` to (``dict``, ``dict``)
+        :param status: :py:data:`PRESENT`, :py:data:`FETCH` or
+            :py:data:`ABSENT` for each output path checked.
+        :type status: ``dict`` of ``str`` to ``str``
+        :param store_snapshot: From
+            :py:meth:`~nix_derivation_tools.store.StatPresence.snapshot`,
+            taken before the store was checked.
+        :param binary_caches: URLs of the binary caches which were
+            asked.
+        :type binary_caches: ``list`` of ``str``
+        """
+        self.graph = graph or {}
+        self.status = status or {}
+        self.store_snapshot = store_snapshot
+        self.binary_caches = binary_caches or []
+
+    @classmethod
+    def load(cls, path):
+        """Load a state saved by :py:meth:`save`.
+
+        A missing, unreadable or outdated file gives an empty state, as
+        the state is only ever an optimization.
+
+        :type path: ``str``
+
+        :rtype: :py:class:`PreviewState`
+        """
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return cls()
+        if not isinstance(data, dict) or \
+           data.get("version") != STATE_VERSION:
+            return cls()
+        return cls(graph={path: tuple(entry)
+                          for path, entry in data["graph"].items()},
+                   status=data["status"],
+                   store_snapshot=data["store_snapshot"],
+                   binary_caches=data["binary_caches"])
+
+    def save(self, path):
+        """Write the state to a file, replacing it atomically.
+
+        :type path: ``str``
+        """
+        data = {"version": STATE_VERSION, "graph": self.graph,
+                "status": self.status, "store_snapshot": self.store_snapshot,
+                "binary_caches": self.binary_caches}
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+
+class DerivationRef(object):
+    """A derivation known by its path, and parsed on first use.
+
+    It stands in for a :py:class:`Derivation`: attributes other than
+    :py:attr:`path` are those of the parsed derivation. It hashes as a
+    derivation with the same path does.
+    """
+
+    __slots__ = ("path", "_deriv")
+
+    def __init__(self, path):
+        """Initializer.
+
+        :param path: Path to the derivation file.
+        :type path: ``str``
+        """
+        self.path = path
+        self._deriv = None
+
+    def __getattr__(self, name):
+        if self._deriv is None:
+            self._deriv = Derivation.parse_derivation_file(self.path,
+                                                           lazy=True)
+        return getattr(self._deriv, name)
+
+    def __eq__(self, other):
+        if isinstance(other, DerivationRef):
+            return self.path == other.path
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return "DerivationRef({})".format(repr(self.path))
+
+
+def _root_outputs(paths):
+    """Split ``path!out1,out2`` arguments, as
+    :py:func:`~nix_derivation_tools.preview.parse_deriv_paths` does.
+
+    :return: Derivation paths, with the outputs wanted from each, or
+        ``None`` for all of them.
+    :rtype: ``list`` of (``str``, ``list`` of ``str`` or ``NoneType``)
+    """
+    result = []
+    for path in paths:
+        outputs = None
+        if "!" in path:
+            path, out = path.split("!")
+            outputs = out.split(",")
+        result.append((normalize_derivation_path(path), outputs))
+    return result
+
+
+def preview_incremental(paths, state, client=None, presence=None):
+    """Find what needs building or fetching, reusing an earlier result.
+
+    The result is the same as from
+    :py:func:`~nix_derivation_tools.preview.preview_build`, given the
+    same arguments, except that derivations are given as
+    :py:class:`DerivationRef`. The state is updated to describe this preview;
+    save it with :py:meth:`PreviewState.save` for the next one.
+
+    :param paths: Derivation paths, optionally with output names.
+    :type paths: ``list`` of ``str``
+    :param state: What the last preview found.
+    :type state: :py:class:`PreviewState`
+    :param client: Client to query binary caches with.
+    :type client: :py:class:`SubstituterClient` or ``NoneType``
+    :param presence: How to check whether outputs are in the store.
+    :type presence: :py:class:`~nix_derivation_tools.store.StatPresence`
+
+    :return: The derivation outputs which need to be built, and those
+        which will be fetched.
+    :rtype: (``dict`` of :py:class:`DerivationRef` to ``set`` of ``str``,
+        ``dict`` of :py:class:`DerivationRef` to ``set`` of ``str``)
+    """
+    if presence is None:
+        presence = get_store_presence()
+    # Taken first, so that anything changing from here on is noticed
+    # next time.
+    snapshot = presence.snapshot()
+    changed = None
+    if state.store_snapshot is not None:
+        changed = presence.changes(state.store_snapshot)
+    if changed is None:
+        metrics.count("preview.store_changes_unknown")
+    urls = [s.url for s in client.substituters] if client else []
+    # Outputs which a binary cache had last time, and still can be
+    # fetched from it.
+    fetchable = urls == state.binary_caches
+    old_graph, old_status = state.graph, state.status
+    graph, status = {}, {}
+
+    def node(path):
+        entry = graph.get(path)
+        if entry is None:
+            entry = old_graph.get(path)
+            if entry is None:
+                deriv = Derivation.parse_derivation_file(path, lazy=True)
+                entry = (dict(deriv.output_mapping),
+                         {p: list(outs) for p, outs
+                          in deriv.input_derivations.items()})
+            else:
+                metrics.count("preview.derivations_reused")
+            graph[path] = entry
+        return entry
+
+    needed, need_fetch, seen = {}, {}, set()
+    frontier = {}
+    for path, outputs in _root_outputs(paths):
+        for out in outputs or node(path)[0]:
+            frontier[(path, out)] = None
+    while len(frontier) > 0:
+        unknown = {}
+        for path, out in frontier:
+            if (path, out) not in seen:
+                seen.add((path, out))
+                unknown[node(path)[0][out]] = (path, out)
+        recheck = [p for p in unknown if p not in old_status
+                   or changed is None or p in changed]
+        metrics.count("preview.outputs_checked", len(recheck))
+        metrics.count("preview.outputs_reused", len(unknown) - len(recheck))
+        with metrics.timer("preview.store_check"):
+            present = presence.present(recheck)
+        rechecked = set(recheck)
+        missing, on_server, query = {}, set(), []
+        for output_path, (path, out) in unknown.items():
+            old = old_status.get(output_path)
+            if output_path in present or \
+               (output_path not in rechecked and old == PRESENT):
+                status[output_path] = PRESENT
+                continue
+            missing[output_path] = (path, out)
+            if fetchable and old == FETCH:
+                on_server.add(output_path)
+            else:
+                query.append(output_path)
+        if client is not None and len(query) > 0:
+            on_server.update(p for p, is_on_server
+                             in client.query_paths(query).items()
+                             if is_on_server)
+        frontier = {}
+        for output_path, (path, out) in missing.items():
+            if output_path in on_server:
+                status[output_path] = FETCH
+                need_fetch.setdefault(path, set()).add(out)
+                continue
+            status[output_path] = ABSENT
+            if path in needed:
+                # Its inputs were queued when another output was found
+                # to be needed.
+                needed[path].add(out)
+            else:
+                needed[path] = {out}
+                for input_path, outs in node(path)[1].items():
+                    for input_out in outs:
+                        frontier[(input_path, input_out)] = None
+    state.graph, state.status = graph, status
+    state.store_snapshot, state.binary_caches = snapshot, urls
+    return ({DerivationRef(path): outs for path, outs in needed.items()},
+            {DerivationRef(path): outs for path, outs in need_fetch.items()})
@@ -0,0 +1,193 @@
+"""Counting and timing what derivtool spends its time on.
+
+Instrumented code calls :py:func:`count` and :py:func:`timer` with
+dotted names such as ``parse.bytes_read`` or ``preview.store_check``.
+Nothing is recorded unless a :py:class:`Metrics` object has been
+installed, and until then both are cheap no-ops, so the calls can stay
+in hot paths. To collect metrics around some code:
+
+    with collect() as metrics:
+        preview_build(paths)
+    print(metrics.report())
+
+To send them elsewhere as they happen (e.g. to a monitoring system),
+pass :py:func:`collect` a subclass of :py:class:`Metrics` overriding
+:py:meth:`~Metrics.count` and :py:meth:`~Metrics.add_time`.
+
+Only this process is measured: work done in worker processes shows up
+as the time spent waiting for them, and in counts made here as their
+results come back.
+"""
+import contextlib
+import json
+import time
+
+# The metrics being collected, if any.
+_current = None
+
+
+class Metrics(object):
+    """Counters and timers."""
+
+    def __init__(self):
+        # Maps names to counts.
+        self.counters = {}
+        # Maps names to the number of times timed and the total seconds.
+        self.timers = {}
+
+    def count(self, name, amount=1):
+        """Add to a counter.
+
+        :type name: ``str``
+        :type amount: ``int``
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, name, seconds):
+        """Record a period of time.
+
+        :type name: ``str``
+        :type seconds: ``float``
+        """
+        timed = self.timers.get(name)
+        if timed is None:
+            self.timers[name] = [1, seconds]
+        else:
+            timed[0] += 1
+            timed[1] += seconds
+
+    def timer(self, name):
+        """Time a block of code.
+
+        :type name: ``str``
+
+        :return: A context manager.
+        """
+        return _Timer(self, name)
+
+    def as_dict(self):
+        """Convert to a JSON-compatible dictionary."""
+        return {
+            "counters": dict(sorted(self.counters.items())),
+            "timers": {name: {"calls": calls, "seconds": seconds}
+                       for name, (calls, seconds)
+                       in sorted(self.timers.items())},
+        }
+
+    def report(self, format="text"):
+        """Describe the metrics.
+
+        :param format: ``text`` or ``json``.
+        :type format: ``str``
+
+        :rtype: ``str``
+        """
+        if format == "json":
+            return json.dumps(self.as_dict(), indent=2)
+        elif format != "text":
+            raise ValueError("Invalid format: {}".format(format))
+        lines = []
+        width = max([len(name) for name in self.counters] +
+                    [len(name) for name in self.timers] + [0])
+        for name, value in sorted(self.counters.items()):
+            lines.append("{:<{}}  {}".format(name, width, value))
+        for name, (calls, seconds) in sorted(self.timers.items()):
+            lines.append("{:<{}}  {:.3f} s ({} calls)".format(
+                name, width, seconds, calls))
+        return "\n".join(lines)
+
+
+class _Timer(object):
+    """Context manager adding the time spent in it to a timer."""
+
+    __slots__ = ("_metrics", "_name", "_start")
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._metrics.add_time(self._name,
+                               time.perf_counter() - self._start)
+
+
+class _NullTimer(object):
+    """Context manager doing nothing, used when metrics are off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def count(name, amount=1):
+    """Add to a counter, if metrics are being collected.
+
+    :type name: ``str``
+    :type amount: ``int``
+    """
+    if _current is not None:
+        _current.count(name, amount)
+
+
+def timer(name):
+    """Time a block of code, if metrics are being collected::
+
+        with timer("preview.store_check"):
+            ...
+
+    :type name: ``str``
+
+    :return: A context manager.
+    """
+    if _current is None:
+        return _NULL_TIMER
+    return _current.timer(name)
+
+
+def get_metrics():
+    """Return the metrics being collected, if any.
+
+    :rtype: :py:class:`Metrics` or ``NoneType``
+    """
+    return _current
+
+
+def set_metrics(metrics):
+    """Start collecting metrics into an object, or stop with ``None``.
+
+    :type metrics: :py:class:`Metrics` or ``NoneType``
+    """
+    global _current
+    _current = metrics
+
+
+@contextlib.contextmanager
+def collect(metrics=None):
+    """Collect metrics within a block, restoring the previous collector
+    afterwards.
+
+    :param metrics: Where to collect them. Defaults to a new
+        :py:class:`Metrics`.
+    :type metrics: :py:class:`Metrics` or ``NoneType``
+
+    :return: The metrics.
+    :rtype: :py:class:`Metrics`
+    """
+    previous = _current
+    metrics = metrics if metrics is not None else Metrics()
+    set_metrics(metrics)
+    try:
+        yield metrics
+    finally:
+        set_metrics(previous)
@@ -0,0 +1,339 @@
+"""On-disk caches shared between invocations.
+
+Derivation files in the Nix store never change once written, so the
+result of parsing one can be kept across runs. Entries live in a SQLite
+database (by default under ``$XDG_CACHE_HOME``), which handles locking
+between concurrent processes. Each entry records the size and
+modification time of the file it came from, and is ignored if those no
+longer match. This cache is off unless enabled with
+:py:func:`set_persistent_cache`.
+
+Answers from binary caches are kept in a similar database by
+:py:class:`SubstituterResultCache`, but only for a limited time.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+# Bump when the stored representation changes; older databases are
+# then emptied rather than misread.
+SCHEMA_VERSION = 1
+
+# Writes are batched into transactions of this many entries.
+_BATCH_SIZE = 500
+
+
+def default_cache_path(name="derivations.sqlite"):
+    """Location of a cache database if none is given explicitly.
+
+    :param name: File name of the database.
+    :type name: ``str``
+
+    :rtype: ``str``
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "nix-derivation-tools", name)
+
+
+def _connect(path):
+    """Open a cache database, creating its directory if needed."""
+    # Imported here, since most runs never open a cache.
+    import sqlite3
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    # WAL lets readers carry on while another process writes.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class PersistentCache(object):
+    """A SQLite-backed store of parsed derivation fields."""
+
+    def __init__(self, path=None):
+        """Initializer.
+
+        :param path: Path to the database file, created if missing.
+            Defaults to :py:func:`default_cache_path`.
+        :type path: ``str`` or ``NoneType``
+        """
+        self.path = path or default_cache_path()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._conn = _connect(self.path)
+        with self._lock:
+            self._setup()
+
+    def _setup(self):
+        """Create the schema, discarding entries in an older format."""
+        conn = self._conn
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        with conn:
+            if version != SCHEMA_VERSION:
+                conn.execute("DROP TABLE IF EXISTS derivations")
+            conn.execute("CREATE TABLE IF NOT EXISTS derivations ("
+                         " path TEXT PRIMARY KEY,"
+                         " mtime_ns INTEGER NOT NULL,"
+                         " size INTEGER NOT NULL,"
+                         " fields TEXT NOT NULL,"
+                         " added REAL NOT NULL)")
+            conn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+
+    def get(self, path, stat):
+        """Look up the parsed fields of a derivation file.
+
+        :param path: Normalized path to the derivation.
+        :type path: ``str``
+        :param stat: Result of ``os.stat`` on the file, used to check
+            that the entry is still valid.
+        :type stat: ``os.stat_result``
+
+        :return: The fields as returned by
+            :py:func:`~nix_derivation_tools.aterm.parse_derivation_text`
+            (with lists in place of tuples), or ``None``.
+        :rtype: ``list`` or ``NoneType``
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mtime_ns, size, fields FROM derivations"
+                " WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != stat.st_mtime_ns or row[1] != stat.st_size:
+            return None
+        return json.loads(row[2])
+
+    def put(self, path, stat, fields):
+        """Record the parsed fields of a derivation file.
+
+        Writes are buffered; they reach the database once enough have
+        accumulated, or on :py:meth:`flush`.
+
+        :param path: Normalized path to the derivation.
+        :type path: ``str``
+        :param stat: Result of ``os.stat`` on the file.
+        :type stat: ``os.stat_result``
+        :param fields: The parsed fields.
+        :type fields: ``tuple``
+        """
+        row = (path, stat.st_mtime_ns, stat.st_size,
+               json.dumps(fields, separators=(",", ":")), time.time())
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= _BATCH_SIZE:
+                self._flush()
+
+    def flush(self):
+        """Write any buffered entries to the database."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if len(self._pending) == 0:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO derivations VALUES (?, ?, ?, ?, ?)",
+                self._pending)
+        self._pending = []
+
+    def info(self):
+        """Describe the contents of the cache.
+
+        :return: The database path, number of entries and size in bytes.
+        :rtype: ``dict``
+        """
+        self.flush()
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM derivations").fetchone()[0]
+        return {"path": self.path, "entries": entries,
+                "size": self._disk_size()}
+
+    def gc(self):
+        """Remove entries for derivation files which no longer exist.
+
+        :return: Number of entries removed.
+        :rtype: ``int``
+        """
+        self.flush()
+        with self._lock:
+            paths = [row[0] for row in self._conn.execute(
+                "SELECT path FROM derivations")]
+            missing = [(p,) for p in paths if not os.path.exists(p)]
+            with self._conn:
+                self._conn.executemany(
+                    "DELETE FROM derivations WHERE path = ?", missing)
+        self._vacuum()
+        return len(missing)
+
+    def trim(self, max_size):
+        """Remove the oldest entries until the database fits in a size.
+
+        :param max_size: Maximum size of the database, in bytes.
+        :type max_size: ``int``
+
+        :return: Number of entries removed.
+        :rtype: ``int``
+        """
+        self.flush()
+        removed = 0
+        with self._lock:
+            size = self._disk_size()
+            if size <= max_size:
+                return 0
+            total = self._conn.execute(
+                "SELECT COUNT(*) FROM derivations").fetchone()[0]
+            # Assume entries are roughly the same size, and remove a
+            # proportional number of the oldest ones.
+            removed = total - int(total * max_size / size)
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM derivations WHERE path IN"
+                    " (SELECT path FROM derivations ORDER BY added LIMIT ?)",
+                    (removed,))
+        self._vacuum()
+        return removed
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._pending = []
+            with self._conn:
+                self._conn.execute("DELETE FROM derivations")
+        self._vacuum()
+
+    def close(self):
+        """Flush pending writes and close the database."""
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+    def _vacuum(self):
+        with self._lock:
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def _disk_size(self):
+        return sum(os.path.getsize(self.path + suffix)
+                   for suffix in ("", "-wal")
+                   if os.path.exists(self.path + suffix))
+
+    def __repr__(self):
+        return "PersistentCache({})".format(repr(self.path))
+
+
+class SubstituterResultCache(object):
+    """Remembers which store paths binary caches have, for a while.
+
+    Once a binary cache has a path it normally keeps it, so positive
+    answers are trusted for much longer than negative ones, which
+    change whenever something is uploaded.
+    """
+
+    def __init__(self, path=None, positive_ttl=30 * 24 * 3600,
+                 negative_ttl=3600):
+        """Initializer.
+
+        :param path: Path to the database file, created if missing.
+        :type path: ``str`` or ``NoneType``
+        :param positive_ttl: Seconds to trust that a path is present.
+        :type positive_ttl: ``float``
+        :param negative_ttl: Seconds to trust that a path is absent.
+        :type negative_ttl: ``float``
+        """
+        self.path = path or default_cache_path("substituters.sqlite")
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._conn = _connect(self.path)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS results ("
+                               " url TEXT NOT NULL,"
+                               " path TEXT NOT NULL,"
+                               " present INTEGER NOT NULL,"
+                               " checked REAL NOT NULL,"
+                               " PRIMARY KEY (url, path))")
+
+    def lookup(self, url, paths):
+        """Find which of some paths have a still-valid answer.
+
+        :param url: URL of the binary cache.
+        :type url: ``str``
+        :param paths: Store paths to look up.
+        :type paths: ``list`` of ``str``
+
+        :return: Whether the binary cache had each path, for those paths
+            with an answer which hasn't expired.
+        :rtype: ``dict`` of ``str`` to ``bool``
+        """
+        now = time.time()
+        result = {}
+        with self._lock:
+            # Stay well below SQLite's limit on query parameters.
+            for i in range(0, len(paths), _BATCH_SIZE):
+                batch = paths[i:i + _BATCH_SIZE]
+                rows = self._conn.execute(
+                    "SELECT path, present, checked FROM results"
+                    " WHERE url = ? AND path IN ({})"
+                    .format(",".join("?" * len(batch))), [url] + batch)
+                for path, present, checked in rows:
+                    ttl = self.positive_ttl if present else self.negative_ttl
+                    if now - checked < ttl:
+                        result[path] = bool(present)
+        return result
+
+    def record(self, url, results):
+        """Remember answers from a binary cache.
+
+        :param url: URL of the binary cache.
+        :type url: ``str``
+        :param results: Whether the binary cache had each path.
+        :type results: ``dict`` of ``str`` to ``bool``
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                ((url, path, int(present), now)
+                 for path, present in results.items()))
+
+    def clear(self):
+        """Forget all answers."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM results")
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._conn.close()
+
+
+_PERSISTENT_CACHE = None
+
+
+def get_persistent_cache():
+    """Return the persistent cache in use, or ``None`` if disabled.
+
+    :rtype: :py:class:`PersistentCache` or ``NoneType``
+    """
+    return _PERSISTENT_CACHE
+
+
+def set_persistent_cache(cache):
+    """Enable (or with ``None``, disable) the persistent cache.
+
+    Pending writes are flushed when the interpreter exits.
+
+    :param cache: The cache to use.
+    :type cache: :py:class:`PersistentCache` or ``NoneType``
+    """
+    global _PERSISTENT_CACHE
+    _PERSISTENT_CACHE = cache
+    if cache is not None:
+        # Once, however often the same cache is set.
+        atexit.unregister(cache.flush)
+        atexit.register(cache.flush)
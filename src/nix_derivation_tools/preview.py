@@ -1,21 +1,26 @@
 """Preview what will be built when building a derivation."""
 import json
 import sys
-from os.path import exists
-
-import requests
-from servenix.client.sendnix import StoreObjectSender
 
+from nix_derivation_tools import metrics
+from nix_derivation_tools.closure import load_closure
 from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.store import StatPresence, get_store_presence
+
 
 def needed_to_build(deriv, outputs=None, needed=None, need_fetch=None,
-                    existing=None, on_server=None):
+                    existing=None, on_server=None, presence=None):
     """Return derivations needed to build the given output of this derivation.
 
     If the outputs exists already, returns an empty set. Otherwise,
     the derivation itself is added. In addition, we look at all of
     its input paths that come from derivations. Whichever have
-    output paths which don't exist already will be recurred on.
+    output paths which don't exist already will be checked in turn.
+
+    Each (derivation, output) pair is only ever checked once, and the
+    dependency graph is walked with an explicit stack rather than by
+    recursion, so closures of any depth can be handled. Passing the same
+    dictionaries to several calls lets them share that work.
 
     :param deriv: The derivation to check.
     :param outputs: Outputs of the derivation needed to build. If not
@@ -33,6 +38,9 @@ def needed_to_build(deriv, outputs=None, needed=None, need_fetch=None,
     :type on_server: ``dict`` of ``Derivation`` to ``set`` of ``str``
     :param existing: Derivations and outputs known to exist on disk.
     :param existing: ``dict`` of ``Derivation`` to ``set`` of ``str``
+    :param presence: How to check whether outputs are in the store.
+                     Defaults to checking the filesystem.
+    :type presence: :py:class:`~nix_derivation_tools.store.StatPresence`
 
     :return: Two sets: one giving derivations needed to be built, and
              another giving derivations and outputs on disk.
@@ -48,46 +56,37 @@ def needed_to_build(deriv, outputs=None, needed=None, need_fetch=None,
         existing = {}
     if on_server is None:
         on_server = {}
-    # First check to see if we already have the information we need.
-    if deriv in needed:
-        for output in outputs:
+    if presence is None:
+        presence = StatPresence()
+    empty = frozenset()
+    # Items are pushed in reverse so that they're visited in order.
+    stack = [(deriv, output) for output in reversed(list(outputs))]
+    while len(stack) > 0:
+        deriv, output = stack.pop()
+        # Skip outputs we've already classified.
+        if output in needed.get(deriv, empty) or \
+           output in existing.get(deriv, empty) or \
+           output in need_fetch.get(deriv, empty):
+            continue
+        if deriv.output_mapping[output] in presence:
+            existing.setdefault(deriv, set()).add(output)
+        elif output in on_server.get(deriv, empty):
+            need_fetch.setdefault(deriv, set()).add(output)
+        elif deriv in needed:
+            # Its inputs were queued when another output was found
+            # to be needed.
             needed[deriv].add(output)
-        return needed, need_fetch
-    else:
-        # For each requested output, check to see if it's either
-        # on the filesystem or on the server; if so we don't need
-        # to build it.
-        prebuilt = existing.get(deriv, set()) | need_fetch.get(deriv, set())
-        if all(output in prebuilt for output in outputs):
-            return needed, need_fetch
-    # So then, we don't know if we need to build this derivation.
-    # We can see by checking the outputs.
-    for output in outputs:
-        if exists(deriv.output_mapping[output]):
-            if deriv not in existing:
-                existing[deriv] = set()
-            existing[deriv].add(output)
-        elif deriv in on_server and output in on_server[deriv]:
-            if deriv not in need_fetch:
-                need_fetch[deriv] = set()
-            need_fetch[deriv].add(output)
         else:
-            if deriv not in needed:
-                needed[deriv] = set()
-            needed[deriv].add(output)
-            # Even though we're doing this repeatedly, it will
-            # exit early on subsequent invocations, so it should
-            # be fast.
-            for path, outs in deriv.input_derivations.items():
+            needed[deriv] = {output}
+            for path, outs in reversed(list(deriv.input_derivations.items())):
                 subderiv = Derivation.parse_derivation_file(path)
-                needed_to_build(subderiv, outputs=outs,
-                                needed=needed, need_fetch=need_fetch,
-                                on_server=on_server,
-                                existing=existing)
+                for out in reversed(outs):
+                    stack.append((subderiv, out))
     return needed, need_fetch
 
 
-def needed_to_build_multi(deriv_outputs, existing=None, on_server=None):
+def needed_to_build_multi(deriv_outputs, existing=None, on_server=None,
+                          presence=None):
     """
 
     :param deriv_outputs: A mapping from derivations to sets of outputs.
@@ -100,7 +99,8 @@ def needed_to_build_multi(deriv_outputs, existing=None, on_server=None):
     needed, need_fetch = {}, {}
     for deriv, outputs in deriv_outputs.items():
         needed_to_build(deriv, outputs, needed=needed, need_fetch=need_fetch,
-                        existing=existing, on_server=on_server)
+                        existing=existing, on_server=on_server,
+                        presence=presence)
     return needed, need_fetch
 
 
@@ -137,7 +137,8 @@ def parse_deriv_paths(paths):
     return result
 
 
-def preview_build(paths, binary_cache=None):
+def preview_build(paths, binary_cache=None, jobs=1, client=None,
+                  presence=None, state=None):
     """Given some derivation paths, generate three sets:
 
     * Set of derivations which need to be built from scratch
@@ -145,56 +146,110 @@ def preview_build(paths, binary_cache=None):
     * Set of derivations which already exist.
 
     Of course, the second set will be empty if no binary cache is given.
+
+    The closure is walked breadth-first. The outputs in each level are
+    checked for in the store together, those missing are looked up in
+    the binary cache together, and only
+    the inputs of outputs which are in neither place are visited next,
+    so nothing under a fetchable output is ever examined.
+
+    If ``jobs`` is more than 1, the whole closure of the paths is first
+    parsed using that many processes, unless a ``state`` with a graph
+    is given.
+
+    :param binary_cache: URL of a binary cache, or a list of them in
+        order of preference.
+    :type binary_cache: ``str`` or ``list`` of ``str`` or ``NoneType``
+    :param client: Client to query binary caches with, instead of
+        one created from ``binary_cache``.
+    :type client: :py:class:`SubstituterClient` or ``NoneType``
+    :param presence: How to check whether outputs are in the store.
+        Defaults to :py:func:`~nix_derivation_tools.store.get_store_presence`.
+    :type presence: :py:class:`~nix_derivation_tools.store.StatPresence`
+    :param state: What the last preview found, to only check what may
+        have changed since; see
+        :py:func:`~nix_derivation_tools.incremental.preview_incremental`.
+        It's updated to describe this preview, and the results are
+        keyed by :py:class:`~nix_derivation_tools.incremental.DerivationRef`
+        rather than :py:class:`Derivation`.
+    :type state: :py:class:`~nix_derivation_tools.incremental.PreviewState`
     """
+    if jobs > 1 and not (state is not None and state.graph):
+        paths = list(paths)
+        with metrics.timer("preview.load_closure"):
+            load_closure([p.split("!")[0] for p in paths], jobs=jobs)
+    if client is None and binary_cache:
+        # Imported here, since asyncio and ssl are slow to import and
+        # previews without a binary cache don't need them.
+        from nix_derivation_tools.substituters import SubstituterClient
+        if isinstance(binary_cache, str):
+            binary_cache = [binary_cache]
+        client = SubstituterClient(binary_cache)
+    if presence is None:
+        presence = get_store_presence()
+    if state is not None:
+        from nix_derivation_tools.incremental import preview_incremental
+        return preview_incremental(paths, state, client=client,
+                                   presence=presence)
     derivs_outs = parse_deriv_paths(paths)
-    existing = {}
-    # Run the first time with no on_server argument.
-    needed, need_fetch = needed_to_build_multi(derivs_outs, existing=existing)
-    if len(needed) > 0 and binary_cache is not None:
-        on_server = {}
-        sender = StoreObjectSender(endpoint=binary_cache)
-        # Query the server for missing paths. Start by trying a
-        # multi-query because it's faster; if the server doesn't
-        # implement that behavior then try individual queries.
-        paths_to_ask = []
-        # Make a dictionary mapping paths back to the
+    needed, need_fetch, existing = {}, {}, {}
+    empty = frozenset()
+    # A dict rather than a set, to keep the order of discovery.
+    frontier = {(deriv, out): None
+                for deriv, outs in derivs_outs.items() for out in outs}
+    while len(frontier) > 0:
+        # Make a dictionary mapping unclassified paths back to the
         # derivations/outputs they came from.
-        path_mapping = {}
-        for deriv, outs in needed.items():
-            for out in outs:
-                path = deriv.output_mapping[out]
-                paths_to_ask.append(path)
-                path_mapping[path] = (deriv, out)
-        query_result = sender.query_paths(paths_to_ask)
-        for path, is_on_server in query_result.items():
-            if is_on_server is False:
+        unknown = {}
+        for deriv, out in frontier:
+            if out in needed.get(deriv, empty) or \
+               out in existing.get(deriv, empty) or \
+               out in need_fetch.get(deriv, empty):
                 continue
-            deriv, out_name = path_mapping[path]
-            # First, remove these from the `needed` set, because
-            # we can fetch them from the server.
-            needed[deriv].remove(out_name)
-            if len(needed[deriv]) == 0:
-                del needed[deriv]
-            # Then add them to the `on_server` set.
-            if deriv not in on_server:
-                on_server[deriv] = set()
-            on_server[deriv].add(out_name)
-        if len(on_server) > 0:
-            # Run the check again, this time using the information
-            # collected from the server.
-            needed, need_fetch = needed_to_build_multi(derivs_outs,
-                                                       on_server=on_server,
-                                                       existing=existing)
+            unknown[deriv.output_mapping[out]] = (deriv, out)
+        metrics.count("preview.outputs_checked", len(unknown))
+        with metrics.timer("preview.store_check"):
+            present = presence.present(list(unknown))
+        missing = {}
+        for path, (deriv, out) in unknown.items():
+            if path in present:
+                existing.setdefault(deriv, set()).add(out)
+            else:
+                missing[path] = (deriv, out)
+        on_server = set()
+        if client is not None and len(missing) > 0:
+            query_result = client.query_paths(list(missing))
+            on_server.update(path for path, is_on_server
+                             in query_result.items() if is_on_server)
+        frontier = {}
+        with metrics.timer("preview.parse"):
+            for path, (deriv, out) in missing.items():
+                if path in on_server:
+                    need_fetch.setdefault(deriv, set()).add(out)
+                elif deriv in needed:
+                    # Its inputs were queued when another output was
+                    # found to be needed.
+                    needed[deriv].add(out)
+                else:
+                    needed[deriv] = {out}
+                    for input_path, outs in deriv.input_derivations.items():
+                        subderiv = Derivation.parse_derivation_file(
+                            input_path)
+                        for input_out in outs:
+                            frontier[(subderiv, input_out)] = None
     return needed, need_fetch
 
 
-def print_preview(paths, binary_cache=None, show_existing=False):
+def print_preview(paths, binary_cache=None, show_existing=False, jobs=1,
+                  client=None, presence=None, state=None):
     """Print the result of a `preview_build` operation."""
     def print_set(action, s):
         if len(s) > 0:
             print("These derivation outputs {}:".format(action))
             for deriv, outs in s.items():
                 print("  {} -> {}".format(deriv.path, ", ".join(outs)))
-    needed, need_fetch = preview_build(paths, binary_cache)
+    needed, need_fetch = preview_build(paths, binary_cache, jobs=jobs,
+                                       client=client, presence=presence,
+                                       state=state)
     print_set("need to be built", needed)
     print_set("will be fetched", need_fetch)
@@ -0,0 +1,397 @@
+"""A long-running derivtool process, answering commands over a socket.
+
+Every derivtool process starts with empty caches, so a series of
+commands over overlapping closures parses the same derivations again
+and again. ``derivtool serve`` keeps one process, and its caches, warm;
+while it's running, other derivtool commands are sent to it instead of
+being run in their own process.
+
+Requests and replies are JSON, one object per line, over a Unix socket
+which only its owner can use. Clients only connect to a socket owned by
+their own user, and by default look for it in a directory only that
+user can access. A request holds:
+
+* ``version``: :py:data:`PROTOCOL_VERSION`;
+* ``argv``: the command line, less the program name;
+* ``cwd``: the directory relative paths are relative to;
+* ``env``: the client's values of :py:data:`FORWARDED_ENVIRONMENT`;
+* ``stdin``: whether the client's standard input will be sent (if not,
+  the command sees a terminal).
+
+The server answers with ``{"accepted": true}``, or with ``error`` if
+the request can't be handled at all, in which case the client runs the
+command itself. Once accepted, the client sends its standard input as
+it reads it, as objects with ``stdin`` (a piece of text, or ``null`` at
+the end), while the server sends objects with ``stdout`` or ``stderr``
+(text to write to either), ending with one holding ``exit`` (the exit
+status).
+
+Commands are run one at a time, so the server never has to worry about
+two of them sharing its caches.
+"""
+import codecs
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+import traceback
+
+PROTOCOL_VERSION = 2
+
+# Environment variables which affect how commands behave, so the
+# client's values are used rather than the server's.
+FORWARDED_ENVIRONMENT = ("NIX_STORE", "NIX_STATE_DIR", "NIX_REPO_HTTP",
+                         "DERIVTOOL_PARSE_CACHE", "XDG_CACHE_HOME")
+
+# Input and output are sent in pieces of about this many characters.
+_CHUNK_SIZE = 2 ** 16
+
+
+def default_socket_path():
+    """Location of the server's socket if none is given explicitly.
+
+    Without ``$XDG_RUNTIME_DIR``, the socket goes in a directory under
+    the system's temporary directory, which is created if need be.
+
+    :raises: ``ValueError`` if that directory exists but doesn't belong
+        to this user, or others can access it.
+    :rtype: ``str``
+    """
+    if os.environ.get("DERIVTOOL_SOCKET"):
+        return os.environ["DERIVTOOL_SOCKET"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "derivtool.sock")
+    directory = os.path.join(tempfile.gettempdir(),
+                             "derivtool-{}".format(os.getuid()))
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    # Anyone can create the directory first, so check what's there.
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+       info.st_mode & 0o077:
+        raise ValueError("{} isn't a directory private to this user"
+                         .format(directory))
+    return os.path.join(directory, "derivtool.sock")
+
+
+def _is_own_socket(path):
+    """Whether a path is a socket created by this user."""
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+
+def _send(wfile, message):
+    wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+
+
+class _Output(object):
+    """A file-like object sending what's written to it to the client."""
+
+    def __init__(self, wfile, name):
+        self._wfile = wfile
+        self._name = name
+        self._buffer = []
+        self._size = 0
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= _CHUNK_SIZE:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self._size > 0:
+            _send(self._wfile, {self._name: "".join(self._buffer)})
+            self._buffer, self._size = [], 0
+        self._wfile.flush()
+
+    def isatty(self):
+        return False
+
+
+class _Input(io.TextIOBase):
+    """The client's standard input, received as the command reads it."""
+
+    def __init__(self, rfile):
+        """Initializer.
+
+        :param rfile: The connection to read from, or ``None`` for a
+            terminal, which has nothing to read.
+        """
+        self._rfile = rfile
+        self._buffer = ""
+        self._eof = rfile is None
+
+    def isatty(self):
+        return self._rfile is None
+
+    def readable(self):
+        return True
+
+    def _receive(self):
+        """Add the next piece of input to the buffer."""
+        line = self._rfile.readline()
+        chunk = json.loads(line.decode("utf-8")).get("stdin") \
+            if line else None
+        if chunk is None:
+            self._eof = True
+        else:
+            self._buffer += chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            pieces = [self._buffer]
+            self._buffer = ""
+            while not self._eof:
+                self._receive()
+                pieces.append(self._buffer)
+                self._buffer = ""
+            return "".join(pieces)
+        while len(self._buffer) < size and not self._eof:
+            self._receive()
+        result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
+
+    def readline(self, size=-1):
+        while "\n" not in self._buffer and not self._eof:
+            self._receive()
+        end = self._buffer.find("\n") + 1 or len(self._buffer)
+        if size is not None and 0 <= size < end:
+            end = size
+        result, self._buffer = self._buffer[:end], self._buffer[end:]
+        return result
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+        except ValueError:
+            return
+        if request.get("version") != PROTOCOL_VERSION:
+            _send(self.wfile, {"error": "unsupported protocol version"})
+            return
+        _send(self.wfile, {"accepted": True})
+        self.wfile.flush()
+        stdout = _Output(self.wfile, "stdout")
+        stderr = _Output(self.wfile, "stderr")
+        saved = (sys.stdin, sys.stdout, sys.stderr, os.getcwd(),
+                 {k: os.environ.get(k) for k in FORWARDED_ENVIRONMENT})
+        try:
+            sys.stdin = _Input(self.rfile if request.get("stdin") else None)
+            sys.stdout, sys.stderr = stdout, stderr
+            os.chdir(request["cwd"])
+            _set_environment(request.get("env", {}))
+            try:
+                status = self.server.run(request["argv"])
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                # As for sys.exit("message").
+                print(status, file=stderr)
+                status = 1
+            stdout.flush()
+            stderr.flush()
+            _send(self.wfile, {"exit": status})
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away.
+            pass
+        finally:
+            sys.stdin, sys.stdout, sys.stderr, cwd, environment = saved
+            os.chdir(cwd)
+            _set_environment(environment)
+
+
+def _set_environment(values):
+    """Set (or, for ``None``, unset) some of
+    :py:data:`FORWARDED_ENVIRONMENT`."""
+    for key in FORWARDED_ENVIRONMENT:
+        if values.get(key) is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = values[key]
+
+
+class DerivtoolServer(socketserver.UnixStreamServer):
+    """Runs commands sent to it over a Unix socket, one at a time."""
+
+    def __init__(self, path, run):
+        """Initializer; the socket is created here.
+
+        :param path: Path to the socket. If a server is already
+            listening there, or something other than a socket of this
+            user's is, ``ValueError`` is raised; a stale socket is
+            replaced.
+        :type path: ``str``
+        :param run: Runs a command, given its command line (less the
+            program name), and returns its exit status, as given to
+            ``sys.exit``. It should catch the ``SystemExit`` of any
+            command which exits.
+        :type run: ``callable``
+        """
+        if os.path.lexists(path):
+            if not _is_own_socket(path):
+                raise ValueError("{} exists and isn't a socket of yours"
+                                 .format(path))
+            sock = _connect(path)
+            if sock is not None:
+                sock.close()
+                raise ValueError("A server is already listening on {}"
+                                 .format(path))
+            os.unlink(path)
+        self.path = path
+        self.run = run
+        # Only the owner may connect, as commands can read any file the
+        # server can.
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def _connect(path):
+    """Connect to a server's socket, or return ``None`` if nothing is
+    listening, or if the socket or the server isn't this user's."""
+    if not _is_own_socket(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        if hasattr(socket, "SO_PEERCRED"):
+            # The socket may have been replaced since it was checked.
+            credentials = sock.getsockopt(socket.SOL_SOCKET,
+                                          socket.SO_PEERCRED, 12)
+            if int.from_bytes(credentials[4:8], sys.byteorder) != \
+               os.getuid():
+                sock.close()
+                return None
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def _read_stdin():
+    """Yield this process's standard input as soon as any of it arrives.
+
+    ``sys.stdin.read(n)`` waits for all ``n`` characters, so the
+    underlying bytes are read with ``read1`` and decoded as they come.
+    """
+    stdin = sys.stdin
+    raw = getattr(stdin, "buffer", None)
+    if raw is None or not hasattr(raw, "read1"):
+        # Not a real file (e.g. replaced in tests); go line by line.
+        for line in stdin:
+            yield line
+        return
+    decoder = codecs.getincrementaldecoder(stdin.encoding or "utf-8")(
+        stdin.errors or "strict")
+    while True:
+        data = raw.read1(_CHUNK_SIZE)
+        text = decoder.decode(data, final=not data)
+        if text:
+            yield text
+        if not data:
+            return
+
+
+def _send_stdin(sock):
+    """Send this process's standard input to a server, as it's read."""
+    try:
+        with sock.makefile("wb") as f:
+            for chunk in _read_stdin():
+                _send(f, {"stdin": chunk})
+                f.flush()
+            _send(f, {"stdin": None})
+    except OSError:
+        # The command finished without reading it all.
+        pass
+
+
+def run_remote(argv, path=None, send_stdin=False):
+    """Run a command in a server, if one is running.
+
+    Its output is written to this process's standard output and error
+    as it arrives.
+
+    :param argv: The command line, less the program name.
+    :type argv: ``list`` of ``str``
+    :param path: Path to the server's socket. Defaults to
+        :py:func:`default_socket_path`.
+    :type path: ``str`` or ``NoneType``
+    :param send_stdin: Send this process's standard input along, for
+        commands which read it. Nothing is read from it until the server
+        has accepted the command, so if it doesn't, the command can
+        still be run here.
+    :type send_stdin: ``bool``
+
+    :return: The command's exit status, or ``None`` if there's no
+        server to run it.
+    :rtype: ``int`` or ``NoneType``
+    """
+    if path is None:
+        try:
+            path = default_socket_path()
+        except ValueError:
+            return None
+    sock = _connect(path)
+    if sock is None:
+        return None
+    stdin = send_stdin and not sys.stdin.isatty()
+    request = {"version": PROTOCOL_VERSION, "argv": list(argv),
+               "cwd": os.getcwd(), "stdin": stdin,
+               "env": {k: os.environ.get(k) for k in FORWARDED_ENVIRONMENT}}
+    started = False
+    with sock, sock.makefile("rwb") as f:
+        try:
+            _send(f, request)
+            f.flush()
+            for line in f:
+                message = json.loads(line.decode("utf-8"))
+                if "accepted" in message:
+                    started = True
+                    if stdin:
+                        # Sent from another thread, so that output keeps
+                        # being read while the server waits for input.
+                        threading.Thread(target=_send_stdin, args=(sock,),
+                                         daemon=True).start()
+                    continue
+                if "stdout" in message:
+                    sys.stdout.write(message["stdout"])
+                    sys.stdout.flush()
+                elif "stderr" in message:
+                    sys.stderr.write(message["stderr"])
+                    sys.stderr.flush()
+                elif "exit" in message:
+                    return message["exit"]
+                else:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    if started:
+        # Running it again here would repeat what's been written.
+        sys.stderr.write("Lost connection to the server\n")
+        return 1
+    # The server couldn't run the command, so it'll be run here.
+    return None
@@ -0,0 +1,343 @@
+"""Checking which store paths are present, many at a time.
+
+Calling ``os.path.exists`` once per output is slow on network-backed or
+overlay stores, and only says that a directory exists, not that Nix
+considers the path valid. The classes here answer the question for a
+whole batch of paths at once:
+
+* :py:class:`NixDBPresence` looks the paths up in Nix's database, which
+  is what Nix itself goes by;
+* :py:class:`ScandirPresence` lists the store directory once and
+  answers from that snapshot;
+* :py:class:`StatPresence` checks each path on the filesystem.
+
+:py:func:`get_store_presence` picks one, falling back to the plain stat
+approach when the database can't be read.
+
+Each can also take a :py:meth:`~StatPresence.snapshot` of the store and
+later say which paths may have come or gone since, so that answers from
+an earlier run can be reused.
+
+:py:func:`gc_root_derivations` finds the derivations of whatever the
+garbage collector's roots point to.
+"""
+import os
+import time
+
+from nix_derivation_tools import metrics
+
+
+def store_dir():
+    """The Nix store directory (``$NIX_STORE``, or ``/nix/store``).
+
+    :rtype: ``str``
+    """
+    return os.environ.get("NIX_STORE", "/nix/store")
+
+
+def path_hash(store_path):
+    """Return the hash part of a store path, e.g. ``abc...`` for
+    ``/nix/store/abc...-hello-2.10``.
+
+    :rtype: ``str``
+    """
+    return os.path.basename(store_path).split("-", 1)[0]
+
+
+def nix_db_path():
+    """Path to Nix's database of valid store paths.
+
+    :rtype: ``str``
+    """
+    return os.path.join(_state_dir(), "db", "db.sqlite")
+
+
+def _state_dir():
+    return os.environ.get("NIX_STATE_DIR", "/nix/var/nix")
+
+
+# A directory modified this soon before a snapshot of it was taken may
+# be modified again without its mtime changing, on filesystems with
+# coarse timestamps.
+_RACY_NS = 2 * 10 ** 9
+
+
+class StatPresence(object):
+    """Checks each path with a filesystem call."""
+
+    def present(self, paths):
+        """Find which of some store paths are present.
+
+        :param paths: Store paths to check.
+        :type paths: ``list`` of ``str``
+
+        :return: Those paths which are present.
+        :rtype: ``set`` of ``str``
+        """
+        paths = list(paths)
+        metrics.count("store.stat_calls", len(paths))
+        return {path for path in paths if os.path.exists(path)}
+
+    def __contains__(self, path):
+        return len(self.present([path])) > 0
+
+    def snapshot(self):
+        """Record the state of the store, to compare with later.
+
+        :return: A JSON-compatible value to pass to :py:meth:`changes`.
+        """
+        directory = self._directory()
+        return {"directory": directory, "time_ns": time.time_ns(),
+                "mtime_ns": os.stat(directory).st_mtime_ns}
+
+    def changes(self, snapshot):
+        """Find the store paths which may have been added or removed
+        since a snapshot.
+
+        Adding or removing a path changes the modification time of the
+        store directory, but doesn't say which path it was, so this
+        can only tell that nothing changed.
+
+        :param snapshot: From :py:meth:`snapshot`, possibly of another
+            kind of object.
+
+        :return: Those paths, or ``None`` if it can't be told, and any
+            path may have changed.
+        :rtype: ``set`` of ``str`` or ``NoneType``
+        """
+        directory = self._directory()
+        if snapshot.get("directory") != directory or \
+           "mtime_ns" not in snapshot or \
+           snapshot["time_ns"] - snapshot["mtime_ns"] < _RACY_NS:
+            return None
+        if os.stat(directory).st_mtime_ns != snapshot["mtime_ns"]:
+            return None
+        return set()
+
+    def _directory(self):
+        """The store directory whose changes are tracked."""
+        return store_dir().rstrip("/")
+
+
+class ScandirPresence(StatPresence):
+    """Answers from a single listing of the store directory.
+
+    The listing is taken when the object is created, so paths added or
+    removed afterwards aren't noticed.
+    """
+
+    def __init__(self, directory=None):
+        """Initializer.
+
+        :param directory: The store directory. Defaults to
+            :py:func:`store_dir`.
+        :type directory: ``str`` or ``NoneType``
+        """
+        self.directory = (directory or store_dir()).rstrip("/")
+        # Taken before listing, so nothing changed since is missed.
+        self._snapshot = {"directory": self.directory,
+                          "time_ns": time.time_ns(),
+                          "mtime_ns": os.stat(self.directory).st_mtime_ns}
+        with metrics.timer("store.scandir"):
+            with os.scandir(self.directory) as entries:
+                self._names = frozenset(entry.name for entry in entries)
+
+    def present(self, paths):
+        prefix = self.directory + "/"
+        result, elsewhere = set(), []
+        for path in paths:
+            if path.startswith(prefix):
+                if path[len(prefix):].split("/", 1)[0] in self._names:
+                    result.add(path)
+            else:
+                elsewhere.append(path)
+        return result | super(ScandirPresence, self).present(elsewhere)
+
+    def snapshot(self):
+        # The listing's, since that's what answers are based on.
+        return dict(self._snapshot)
+
+    def _directory(self):
+        return self.directory
+
+
+class NixDBPresence(StatPresence):
+    """Looks paths up in the ``ValidPaths`` table of Nix's database."""
+
+    # SQLite limits the number of parameters in a single query.
+    BATCH_SIZE = 500
+
+    def __init__(self, db_path=None):
+        """Initializer.
+
+        :param db_path: Path to the database. Defaults to
+            :py:func:`nix_db_path`.
+        :type db_path: ``str`` or ``NoneType``
+
+        :raises: ``sqlite3.Error`` if the database can't be read.
+        """
+        # Imported here, since only this class needs it.
+        import sqlite3
+        self.db_path = db_path or nix_db_path()
+        self._conn = sqlite3.connect("file:{}?mode=ro".format(self.db_path),
+                                     uri=True, timeout=30)
+        # Fail now, rather than on first use, if we can't read it.
+        self._conn.execute("SELECT 1 FROM ValidPaths LIMIT 1").fetchall()
+
+    def present(self, paths):
+        paths = list(paths)
+        result = set()
+        for i in range(0, len(paths), self.BATCH_SIZE):
+            batch = paths[i:i + self.BATCH_SIZE]
+            metrics.count("store.db_queries")
+            rows = self._conn.execute(
+                "SELECT path FROM ValidPaths WHERE path IN ({})"
+                .format(",".join("?" * len(batch))), batch)
+            result.update(row[0] for row in rows)
+        return result
+
+    def snapshot(self):
+        max_id, count = self._conn.execute(
+            "SELECT max(id), count(*) FROM ValidPaths").fetchone()
+        return {"db_path": self.db_path, "max_id": max_id or 0,
+                "count": count}
+
+    def changes(self, snapshot):
+        """Find the paths registered since a snapshot.
+
+        Each new path gets a larger ``id`` than any before it, so these
+        are found directly. Removed paths can only be detected, by the
+        number of paths being lower than expected, in which case
+        ``None`` is returned.
+        """
+        if snapshot.get("db_path") != self.db_path or \
+           "max_id" not in snapshot:
+            return None
+        metrics.count("store.db_queries")
+        added = {row[0] for row in self._conn.execute(
+            "SELECT path FROM ValidPaths WHERE id > ?",
+            (snapshot["max_id"],))}
+        count = self._conn.execute(
+            "SELECT count(*) FROM ValidPaths").fetchone()[0]
+        if count != snapshot["count"] + len(added):
+            return None
+        return added
+
+    def derivers(self, paths):
+        """Look up the derivations which produced some store paths.
+
+        :param paths: Store paths.
+        :type paths: ``list`` of ``str``
+
+        :return: The deriver of each path which is valid and has one.
+        :rtype: ``dict`` of ``str`` to ``str``
+        """
+        paths = list(paths)
+        result = {}
+        for i in range(0, len(paths), self.BATCH_SIZE):
+            batch = paths[i:i + self.BATCH_SIZE]
+            rows = self._conn.execute(
+                "SELECT path, deriver FROM ValidPaths WHERE path IN ({})"
+                " AND deriver IS NOT NULL"
+                .format(",".join("?" * len(batch))), batch)
+            result.update(rows)
+        return result
+
+
+# Ways of checking presence, by the names accepted by get_store_presence.
+METHODS = {"stat": StatPresence, "scandir": ScandirPresence,
+           "db": NixDBPresence}
+
+
+def get_store_presence(method="auto"):
+    """Create an object for checking which store paths are present.
+
+    :param method: One of the keys of :py:data:`METHODS`, or ``auto``
+        to use the Nix database if it's readable and stat otherwise.
+    :type method: ``str``
+
+    :rtype: :py:class:`StatPresence`
+    """
+    if method != "auto":
+        return METHODS[method]()
+    if store_dir().rstrip("/") != "/nix/store":
+        # The database describes the real store, not this one.
+        return StatPresence()
+    import sqlite3
+    try:
+        return NixDBPresence()
+    except sqlite3.Error:
+        return StatPresence()
+
+
+def find_gc_roots(directories=None):
+    """Find the store paths which garbage collector roots point to.
+
+    Symbolic links under the given directories are resolved; those
+    leading into the store are roots, and those leading to directories
+    elsewhere (such as ``profiles``) are searched in turn.
+
+    :param directories: Where to look. Defaults to the ``gcroots`` and
+        ``profiles`` directories under ``$NIX_STATE_DIR``.
+    :type directories: ``list`` of ``str`` or ``NoneType``
+
+    :return: Top-level store paths, such as ``/nix/store/<hash>-<name>``.
+    :rtype: ``set`` of ``str``
+    """
+    if directories is None:
+        directories = [os.path.join(_state_dir(), "gcroots"),
+                       os.path.join(_state_dir(), "profiles")]
+    prefix = store_dir().rstrip("/") + "/"
+    roots = set()
+    pending = [d for d in directories if os.path.isdir(d)]
+    searched = set()
+    while pending:
+        directory = os.path.realpath(pending.pop())
+        if directory in searched:
+            continue
+        searched.add(directory)
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+                continue
+            if not entry.is_symlink():
+                continue
+            target = os.path.realpath(entry.path)
+            if target.startswith(prefix):
+                roots.add(prefix + target[len(prefix):].split("/", 1)[0])
+            elif os.path.isdir(target):
+                pending.append(target)
+    return roots
+
+
+def gc_root_derivations(directories=None):
+    """Find the derivations of the store paths which are GC roots.
+
+    Roots which are themselves derivations are used as they are; for
+    others, the deriver recorded in Nix's database is used if its file
+    still exists.
+
+    :param directories: As for :py:func:`find_gc_roots`.
+    :type directories: ``list`` of ``str`` or ``NoneType``
+
+    :raises: ``ValueError`` if derivers are needed but the database
+        can't be read.
+    :rtype: ``set`` of ``str``
+    """
+    roots = find_gc_roots(directories)
+    result = {path for path in roots if path.endswith(".drv")}
+    others = roots - result
+    if len(others) > 0:
+        import sqlite3
+        try:
+            derivers = NixDBPresence().derivers(others)
+        except sqlite3.Error as e:
+            raise ValueError("Can't read derivers of GC roots from {}: {}"
+                             .format(nix_db_path(), e))
+        result.update(path for path in derivers.values()
+                      if os.path.exists(path))
+    return result
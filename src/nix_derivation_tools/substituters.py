@@ -0,0 +1,326 @@
+"""Asking binary caches (substituters) which store paths they have.
+
+A binary cache has a path if ``<cache URL>/<hash>.narinfo`` exists,
+where ``<hash>`` is the hash part of the store path's name. We check
+that with ``HEAD`` requests, made concurrently from an asyncio event
+loop over a small pool of keep-alive connections per cache.
+
+When several caches are given they are tried in order: a path is only
+looked up in a cache if none of the earlier ones have it. Answers can
+be remembered across runs with a
+:py:class:`~nix_derivation_tools.persistent_cache.SubstituterResultCache`.
+"""
+import asyncio
+import ssl
+import time
+from urllib.parse import urlsplit
+
+from nix_derivation_tools import metrics
+from nix_derivation_tools.store import path_hash
+
+
+class SubstituterError(Exception):
+    """Raised when a binary cache gives an unusable response."""
+
+
+class SubstituterStats(object):
+    """Counters for the queries made to one binary cache."""
+
+    def __init__(self):
+        self.queries = 0
+        self.hits = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        # Queries answered from a result cache instead of the network.
+        self.avoided = 0
+
+    @property
+    def hit_rate(self):
+        """Fraction of queries which found the path."""
+        return self.hits / self.queries if self.queries else 0.0
+
+    @property
+    def mean_latency(self):
+        """Average time per query, in seconds."""
+        return self.total_latency / self.queries if self.queries else 0.0
+
+    @property
+    def as_dict(self):
+        """Convert to a JSON-compatible dictionary."""
+        return {"queries": self.queries, "hits": self.hits,
+                "errors": self.errors, "retries": self.retries,
+                "avoided": self.avoided,
+                "hit_rate": self.hit_rate,
+                "mean_latency": self.mean_latency}
+
+
+class Substituter(object):
+    """A single binary cache, with a pool of open connections to it."""
+
+    def __init__(self, url, max_connections, timeout):
+        """Initializer.
+
+        :param url: Base URL of the binary cache.
+        :type url: ``str``
+        :param max_connections: Maximum number of simultaneous
+            connections to open.
+        :type max_connections: ``int``
+        :param timeout: Seconds to wait for any one request.
+        :type timeout: ``float``
+
+        :raises: ``ValueError`` if the URL isn't an HTTP(S) URL.
+        """
+        try:
+            parts = urlsplit(url)
+            port = parts.port
+        except ValueError:
+            # A malformed IPv6 address, or a port which isn't a number.
+            parts = None
+        if parts is None or parts.scheme not in ("http", "https") or \
+           not parts.hostname:
+            raise ValueError("Unsupported binary cache URL: {}".format(url))
+        self.url = url
+        self.host = parts.hostname
+        default_port = 443 if parts.scheme == "https" else 80
+        self.port = port or default_port
+        # What to send as the Host header: the port is included unless
+        # it's the scheme's default, as browsers and curl do.
+        self.host_header = "[{}]".format(self.host) if ":" in self.host \
+            else self.host
+        if self.port != default_port:
+            self.host_header += ":{}".format(self.port)
+        self.ssl = ssl.create_default_context() \
+            if parts.scheme == "https" else None
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.stats = SubstituterStats()
+        self._idle = []
+        # Created on first use, inside the event loop.
+        self._slots = None
+
+    async def has_path(self, store_path):
+        """Check whether the cache has a store path.
+
+        The time taken once a connection slot is free is added to
+        :py:attr:`stats` if the question is answered.
+
+        :raises: :py:class:`SubstituterError`, ``OSError`` or
+            ``asyncio.TimeoutError`` if the question can't be answered.
+        :rtype: ``bool``
+        """
+        request = ("HEAD {}/{}.narinfo HTTP/1.1\r\n"
+                   "Host: {}\r\n"
+                   "Connection: keep-alive\r\n\r\n"
+                   .format(self.base_path, path_hash(store_path),
+                           self.host_header)
+                   ).encode("ascii")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        async with self._slots:
+            # Timed from here, so waiting for a slot doesn't count.
+            start = time.monotonic()
+            # A pooled connection may have been closed by the server
+            # since we last used it; if so, try once more on a new one.
+            for attempt in (0, 1):
+                reused = len(self._idle) > 0
+                if reused:
+                    reader, writer = self._idle.pop()
+                else:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port,
+                                                ssl=self.ssl),
+                        self.timeout)
+                try:
+                    writer.write(request)
+                    status, keep_alive = await asyncio.wait_for(
+                        self._read_response(reader), self.timeout)
+                except (OSError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                break
+            elapsed = time.monotonic() - start
+        if status == 200:
+            self.stats.total_latency += elapsed
+            return True
+        # S3-backed caches answer 403 for missing objects.
+        if status in (403, 404):
+            self.stats.total_latency += elapsed
+            return False
+        raise SubstituterError("{} answered HTTP {}".format(self.url, status))
+
+    async def _read_response(self, reader):
+        """Read the response to a ``HEAD`` request.
+
+        :return: The status code and whether the connection can be reused.
+        :rtype: (``int``, ``bool``)
+        """
+        status_line = await reader.readuntil(b"\r\n")
+        version, status = status_line.decode("latin-1").split(" ", 2)[:2]
+        keep_alive = version == "HTTP/1.1"
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "connection":
+                keep_alive = value.strip().lower() == "keep-alive"
+        return int(status), keep_alive
+
+    def close(self):
+        """Close all pooled connections."""
+        for _, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+
+class SubstituterClient(object):
+    """Queries one or more binary caches for store paths.
+
+    The client owns an event loop, which :py:meth:`query_paths` runs, so
+    it can be used from synchronous code. Connections are kept open
+    between calls until :py:meth:`close`.
+    """
+
+    def __init__(self, urls, batch_size=500, max_connections=8,
+                 timeout=10.0, retries=3, backoff=0.5, result_cache=None):
+        """Initializer.
+
+        :param urls: Binary cache URLs, in order of preference.
+        :type urls: ``list`` of ``str``
+        :param batch_size: Number of queries to have outstanding at
+            once, across all connections.
+        :type batch_size: ``int``
+        :param max_connections: Connections to open to each cache.
+        :type max_connections: ``int``
+        :param timeout: Seconds to wait for any one request.
+        :type timeout: ``float``
+        :param retries: How many times to retry a failed query before
+            treating the path as missing from that cache.
+        :type retries: ``int``
+        :param backoff: Seconds to wait before the first retry; doubled
+            for each subsequent one.
+        :type backoff: ``float``
+        :param result_cache: Where to look up answers before asking the
+            network, and to record new ones.
+        :type result_cache: :py:class:`SubstituterResultCache` or
+            ``NoneType``
+
+        :raises: ``ValueError`` if a URL isn't an HTTP(S) URL.
+        """
+        self.batch_size = batch_size
+        self.result_cache = result_cache
+        self.retries = retries
+        self.backoff = backoff
+        self.substituters = [Substituter(url, max_connections, timeout)
+                             for url in urls]
+        # Created once the URLs are known to be usable, so that there's
+        # nothing to close otherwise.
+        self._loop = asyncio.new_event_loop()
+        # Maps paths which were found to the URL of the cache having them.
+        self.found_in = {}
+
+    def query_paths(self, paths):
+        """Check which of some store paths are in any of the caches.
+
+        :param paths: Store paths to look for.
+        :type paths: ``list`` of ``str``
+
+        :return: Whether each path is available.
+        :rtype: ``dict`` of ``str`` to ``bool``
+        """
+        metrics.count("substituter.paths_queried", len(paths))
+        with metrics.timer("substituter.query"):
+            return self._loop.run_until_complete(
+                self.query_paths_async(paths))
+
+    async def query_paths_async(self, paths):
+        """Coroutine version of :py:meth:`query_paths`."""
+        result = {path: False for path in paths}
+        remaining = list(result)
+        for substituter in self.substituters:
+            if len(remaining) == 0:
+                break
+            answers = {}
+            if self.result_cache is not None:
+                answers = self.result_cache.lookup(substituter.url,
+                                                   remaining)
+                substituter.stats.avoided += len(answers)
+                metrics.count("substituter.result_cache_hits", len(answers))
+            to_ask = [path for path in remaining if path not in answers]
+            for i in range(0, len(to_ask), self.batch_size):
+                batch = to_ask[i:i + self.batch_size]
+                found = await asyncio.gather(
+                    *(self._query(substituter, path) for path in batch))
+                fresh = {path: is_found for path, is_found
+                         in zip(batch, found) if is_found is not None}
+                if self.result_cache is not None:
+                    self.result_cache.record(substituter.url, fresh)
+                answers.update(fresh)
+            for path, is_found in answers.items():
+                if is_found:
+                    result[path] = True
+                    self.found_in[path] = substituter.url
+            remaining = [path for path in remaining if not result[path]]
+        return result
+
+    async def _query(self, substituter, path):
+        """Ask one cache about one path, retrying on failure.
+
+        :return: Whether the cache has the path, or ``None`` if it
+            couldn't be found out.
+        :rtype: ``bool`` or ``NoneType``
+        """
+        stats = substituter.stats
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            metrics.count("substituter.requests")
+            try:
+                found = await substituter.has_path(path)
+            except (SubstituterError, OSError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError, ValueError):
+                if attempt == self.retries:
+                    stats.errors += 1
+                    return None
+                stats.retries += 1
+                await asyncio.sleep(delay)
+                delay *= 2
+                continue
+            stats.queries += 1
+            if found:
+                stats.hits += 1
+            return found
+
+    def report(self):
+        """Describe the queries made to each cache.
+
+        :rtype: ``str``
+        """
+        lines = []
+        for substituter in self.substituters:
+            stats = substituter.stats
+            lines.append(
+                "{}: {} queries, {:.0%} hits, {:.1f} ms mean latency, "
+                "{} retries, {} errors, {} queries avoided".format(
+                    substituter.url, stats.queries, stats.hit_rate,
+                    stats.mean_latency * 1000, stats.retries, stats.errors,
+                    stats.avoided))
+        return "\n".join(lines)
+
+    def close(self):
+        """Close all connections and the event loop."""
+        for substituter in self.substituters:
+            substituter.close()
+        # Let the transports finish closing.
+        self._loop.run_until_complete(asyncio.sleep(0))
+        self._loop.close()
@@ -0,0 +1,187 @@
+"""Diffing of derivation fields.
+
+Environments can hold multi-megabyte values (``buildCommand``, inline
+scripts, ...), so rather than describing a changed value by printing
+both versions, long or multi-line strings are described by a unified
+diff of their lines. Dictionaries are compared by key, and sets by
+membership.
+
+Store paths whose hashes differ but are otherwise equal can be made to
+compare equal by passing ``mask_hashes``.
+"""
+import difflib
+import re
+
+# The hash part of a store path: 32 base-32 characters making up a
+# whole word, so that parts of longer words (hexadecimal digests, say)
+# aren't taken for one.
+STORE_HASH = re.compile(
+    r"(?<![0-9A-Za-z])[0-9a-df-np-sv-z]{32}(?![0-9A-Za-z])")
+
+# Placeholder for store path hashes when they're masked.
+HASH_MASK = "<hash>"
+
+# Strings longer than this, or with several lines, are shown as a
+# unified diff rather than in full.
+LONG_STRING = 120
+
+# Lines of context around each change in a unified diff.
+CONTEXT_LINES = 3
+
+
+def mask_store_hashes(value):
+    """Replace the hashes of store paths in a string.
+
+    :type value: ``str``
+
+    :rtype: ``str``
+    """
+    return STORE_HASH.sub(HASH_MASK, value)
+
+
+def _is_long(value):
+    return len(value) > LONG_STRING or "\n" in value
+
+
+def _text_difference(left, right):
+    """A unified diff of two strings' lines."""
+    lines = list(difflib.unified_diff(
+        left.splitlines(), right.splitlines(), "left", "right",
+        n=CONTEXT_LINES, lineterm=""))
+    return {"type": "text", "diff": lines}
+
+
+def diff_values(left, right, mask_hashes=False):
+    """Describe the differences between two values.
+
+    :param left: The first value: a string, or a list, tuple, set or
+        dictionary of such values.
+    :param right: The second value.
+    :param mask_hashes: Ignore differences in the hash parts of store
+        paths.
+    :type mask_hashes: ``bool``
+
+    :return: ``None`` if the values are equal, otherwise a
+        JSON-compatible dictionary whose ``type`` is one of
+
+        * ``dict``: with ``added`` and ``removed`` mapping keys to
+          values, and ``changed`` mapping keys to differences;
+        * ``set``: with ``added`` and ``removed`` lists of members;
+        * ``text``: with ``diff``, the lines of a unified diff;
+        * ``value``: with the ``left`` and ``right`` values.
+    :rtype: ``dict`` or ``NoneType``
+    """
+    if isinstance(left, str) and isinstance(right, str):
+        # ``==`` already returns early for the same object or a
+        # different length.
+        if left == right:
+            return None
+        if mask_hashes and mask_store_hashes(left) == \
+                mask_store_hashes(right):
+            return None
+        if _is_long(left) or _is_long(right):
+            return _text_difference(left, right)
+        return {"type": "value", "left": left, "right": right}
+    if isinstance(left, dict) and isinstance(right, dict):
+        return _dict_difference(left, right, mask_hashes)
+    if isinstance(left, (set, frozenset)) and \
+            isinstance(right, (set, frozenset)):
+        return _set_difference(left, right, mask_hashes)
+    if isinstance(left, (list, tuple)) and isinstance(right, (list, tuple)):
+        if len(left) == len(right) and all(
+                diff_values(l, r, mask_hashes) is None
+                for l, r in zip(left, right)):
+            return None
+        if all(isinstance(v, str) for v in list(left) + list(right)):
+            return _text_difference("\n".join(left), "\n".join(right))
+        return {"type": "value", "left": list(left), "right": list(right)}
+    if left == right:
+        return None
+    return {"type": "value", "left": left, "right": right}
+
+
+def _mask_keys(dictionary):
+    """Mask the hashes in a dictionary's keys, unless that would make
+    some of them the same."""
+    masked = {mask_store_hashes(k) if isinstance(k, str) else k: v
+              for k, v in dictionary.items()}
+    return masked if len(masked) == len(dictionary) else dictionary
+
+
+def _dict_difference(left, right, mask_hashes):
+    if left is right:
+        return None
+    if mask_hashes:
+        left, right = _mask_keys(left), _mask_keys(right)
+    left_keys, right_keys = left.keys(), right.keys()
+    changed = {}
+    for key in sorted(left_keys & right_keys):
+        difference = diff_values(left[key], right[key], mask_hashes)
+        if difference is not None:
+            changed[key] = difference
+    added = {k: right[k] for k in sorted(right_keys - left_keys)}
+    removed = {k: left[k] for k in sorted(left_keys - right_keys)}
+    if not (changed or added or removed):
+        return None
+    return {"type": "dict", "added": added, "removed": removed,
+            "changed": changed}
+
+
+def _set_difference(left, right, mask_hashes):
+    if mask_hashes:
+        left = {mask_store_hashes(v) if isinstance(v, str) else v
+                for v in left}
+        right = {mask_store_hashes(v) if isinstance(v, str) else v
+                 for v in right}
+    if left == right:
+        return None
+    return {"type": "set", "added": sorted(right - left),
+            "removed": sorted(left - right)}
+
+
+def _short(value):
+    """Represent a value on one line, abbreviating long strings."""
+    if isinstance(value, str) and _is_long(value):
+        first = value.splitlines()[0] if value else ""
+        return "{}... ({} characters)".format(repr(first[:LONG_STRING]),
+                                             len(value))
+    return repr(value)
+
+
+def format_difference(difference, indent=""):
+    """Describe a difference found by :py:func:`diff_values`.
+
+    :param difference: The difference.
+    :type difference: ``dict``
+    :param indent: Prefix for each line.
+    :type indent: ``str``
+
+    :return: Lines of text.
+    :rtype: ``list`` of ``str``
+    """
+    kind = difference["type"]
+    lines = []
+    if kind == "dict":
+        for key, value in difference["removed"].items():
+            lines.append("{}- {}: {}".format(indent, key, _short(value)))
+        for key, value in difference["added"].items():
+            lines.append("{}+ {}: {}".format(indent, key, _short(value)))
+        for key, value in difference["changed"].items():
+            if value["type"] == "value":
+                lines.append("{}~ {}: {} -> {}".format(
+                    indent, key, _short(value["left"]),
+                    _short(value["right"])))
+            else:
+                lines.append("{}~ {}:".format(indent, key))
+                lines.extend(format_difference(value, indent + "    "))
+    elif kind == "set":
+        lines.extend("{}- {}".format(indent, value)
+                     for value in difference["removed"])
+        lines.extend("{}+ {}".format(indent, value)
+                     for value in difference["added"])
+    elif kind == "text":
+        lines.extend(indent + line for line in difference["diff"])
+    else:
+        lines.append("{}- {}".format(indent, _short(difference["left"])))
+        lines.append("{}+ {}".format(indent, _short(difference["right"])))
+    return lines
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+from conftest import DATA
+from nix_derivation_tools.aterm import (
+    ATermParseError, FieldIndex, parse_derivation_text,
+    unparse_derivation_fields)
+
+EMPTY = 'Derive([],[],[],"","",[],[])'
+
+
+def derivation_text(env_value):
+    return ('Derive([("out","/nix/store/x-foo","","")],[],[],"sys",'
+            '"/bin/sh",[],[("name","foo"),("v",' + env_value + ')])')
+
+
+@pytest.mark.parametrize("quoted,expected", [
+    (r'"a\nb"', "a\nb"),
+    (r'"a\tb"', "a\tb"),
+    (r'"a\rb"', "a\rb"),
+    (r'"say \"hi\""', 'say "hi"'),
+    (r'"back\\slash"', "back\\slash"),
+    (r'"\\n"', "\\n"),
+    (r'"\\\""', '\\"'),
+    (r'"\q"', "q"),
+])
+def test_escapes(quoted, expected):
+    text = derivation_text(quoted)
+    fields = parse_derivation_text(text)
+    assert fields[6][1] == ("v", expected)
+    assert FieldIndex(text).parse(6)[1] == ("v", expected)
+    assert FieldIndex(text.encode("utf-8")).parse(6)[1] == ("v", expected)
+
+
+@pytest.mark.parametrize("value", [
+    "a\nb", "a\tb", "a\rb", 'say "hi"', "back\\slash", "\\n", "",
+])
+def test_escapes_round_trip(value):
+    fields = parse_derivation_text(derivation_text('""'))
+    fields = fields[:6] + ([("name", "foo"), ("v", value)],)
+    text = unparse_derivation_fields(fields)
+    assert parse_derivation_text(text)[6][1] == ("v", value)
+
+
+def test_empty_lists():
+    fields = parse_derivation_text(EMPTY)
+    assert fields == ([], [], [], "", "", [], [])
+    assert unparse_derivation_fields(fields) == EMPTY
+
+
+def test_empty_tuple_lists():
+    text = ('Derive([("out","/nix/store/x-foo","","")],'
+            '[("/nix/store/y-bar.drv",[])],[],"","",[],[])')
+    fields = parse_derivation_text(text)
+    assert fields[1] == [("/nix/store/y-bar.drv", [])]
+    assert unparse_derivation_fields(fields) == text
+
+
+def test_bare_fields():
+    assert parse_derivation_text(EMPTY[len("Derive("):-1]) == \
+        parse_derivation_text(EMPTY)
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "Derive(",
+    'Derive([],[],[],"","",[],[]',
+    'Derive([],[],[],"',
+    'Derive([],[],[],"unterminated',
+    'Derive([],[],[],"","",[],[',
+    'Derive([],[],[],"","",[])',
+    'Derive([],[],[],"","",[],[])junk',
+    'Derive([],[],[],"","",[],[("k")])',
+    'Derive([],[],[],"","",["a" "b"],[])',
+    'Derive([],[],[],x,"",[],[])',
+    'Derive((),[],[],"","",[],[])',
+])
+def test_malformed(text):
+    with pytest.raises(ATermParseError) as info:
+        parse_derivation_text(text)
+    assert 0 <= info.value.position <= len(text)
+    assert isinstance(info.value, ValueError)
+
+
+@pytest.mark.parametrize("text", [
+    'Derive([],[],[],"',
+    'Derive([],[],[],"","",[],[',
+    'Derive([],[],[],x,"",[],[])',
+])
+def test_malformed_field_index(text):
+    for source in (text, text.encode("utf-8")):
+        with pytest.raises(ATermParseError):
+            FieldIndex(source).parse(6)
+
+
+def test_error_position():
+    with pytest.raises(ATermParseError) as info:
+        parse_derivation_text('Derive([],[],["a\nb"],x,"",[],[])')
+    assert (info.value.line, info.value.column) == (2, 5)
+
+
+def test_unparse_real_derivations():
+    for name in sorted(os.listdir(DATA)):
+        with open(os.path.join(DATA, name)) as f:
+            text = f.read()
+        assert unparse_derivation_fields(parse_derivation_text(text)) == text
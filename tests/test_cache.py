@@ -0,0 +1,83 @@
+import os
+import threading
+
+from conftest import DATA
+from nix_derivation_tools.cache import (
+    DerivationCache, LRUCache, cache_scope, estimate_size, get_cache,
+    normalize_derivation_path)
+from nix_derivation_tools.derivation import Derivation
+
+MULTI = "h32dahq0bx5rp1krcdx3a53asj21jvhk-has-multi-out.drv"
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.evictions) \
+        == (3, 0, 1)
+    assert cache.get("b") is None
+    assert cache.stats.misses == 1
+
+
+def test_evicts_by_size():
+    cache = LRUCache(max_size=100)
+    cache.put("a", 1, size=40)
+    cache.put("b", 2, size=40)
+    cache.put("a", 3, size=50)
+    assert cache.size == 90
+    cache.put("c", 4, size=30)
+    assert "b" not in cache and cache.size == 80
+    # The newest entry is kept even if it's too big on its own.
+    cache.put("d", 5, size=500)
+    assert list(cache._entries) == ["d"]
+    assert cache.size == 500
+
+
+def test_unbounded_cache():
+    cache = DerivationCache()
+    for i in range(1000):
+        cache.put(str(i), i, size=2 ** 20)
+    assert len(cache) == 1000
+    cache.clear()
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_cache_scope():
+    outer = get_cache()
+    with cache_scope() as scoped:
+        assert get_cache() is scoped
+        assert isinstance(scoped, DerivationCache)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(get_cache()))
+        thread.start()
+        thread.join()
+        assert other == [outer]
+        with cache_scope(LRUCache(max_entries=1)) as inner:
+            assert get_cache() is inner
+        assert get_cache() is scoped
+    assert get_cache() is outer
+
+
+def test_normalize_derivation_path(monkeypatch):
+    monkeypatch.setenv("NIX_STORE", "/nix/store")
+    assert normalize_derivation_path("x.drv") == "/nix/store/x.drv"
+    assert normalize_derivation_path("/a//b/../c.drv") == "/a/c.drv"
+    monkeypatch.delenv("NIX_STORE")
+    assert normalize_derivation_path("x.drv") == \
+        os.path.join(os.getcwd(), "x.drv")
+
+
+def test_parsed_derivations_counted_by_estimated_size():
+    path = os.path.join(DATA, MULTI)
+    with cache_scope() as cache:
+        Derivation.parse_derivation_file(path)
+        assert cache.size == estimate_size(os.path.getsize(path))
+        assert cache.size > os.path.getsize(path)
+        # Found again through a different spelling of the same path.
+        Derivation.parse_derivation_file(os.path.join(DATA, ".", MULTI))
+        assert cache.stats.hits == 1
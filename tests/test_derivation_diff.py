@@ -0,0 +1,58 @@
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.derivation_diff import (
+    diff_derivations, diff_recursive)
+
+STORE = "/nix/store/"
+LEFT_HASH = "a" * 32
+RIGHT_HASH = "b" * 32
+
+
+def make_derivation(drv_hash, env, builder="/bin/sh"):
+    out = STORE + drv_hash + "-foo"
+    env = dict(env, name="foo", out=out)
+    text = ('Derive([("out","{}","","")],[],[],"x86_64-linux","{}",[],[{}])'
+            .format(out, builder, ",".join(
+                '("{}","{}")'.format(k, v) for k, v in sorted(env.items()))))
+    return Derivation.parse_derivation(text, STORE + drv_hash + "-foo.drv")
+
+
+def test_diff_derivations_equal():
+    left = make_derivation(LEFT_HASH, {"a": "1"})
+    assert diff_derivations(left, left) == "equal"
+
+
+def test_diff_derivations_environment():
+    left = make_derivation(LEFT_HASH, {"a": "1", "b": "2", "c": "3"})
+    right = make_derivation(LEFT_HASH, {"a": "1", "b": "x", "d": "4"})
+    assert diff_derivations(left, right) == \
+        ("environment", {"b": "2", "c": "3"}, {"b": "x", "d": "4"})
+
+
+def test_diff_derivations_shape():
+    left = make_derivation(LEFT_HASH, {}, builder="/bin/sh")
+    right = make_derivation(LEFT_HASH, {}, builder="/bin/bash")
+    assert diff_derivations(left, right) == \
+        ("builder", "/bin/sh", "/bin/bash")
+
+
+def test_diff_recursive_added_and_removed_variables():
+    left = make_derivation(LEFT_HASH, {"kept": "1", "gone": "short"})
+    right = make_derivation(RIGHT_HASH, {"kept": "2", "new": "short"})
+    for mask_hashes in (False, True):
+        environment = diff_recursive(left, right, mask_hashes) \
+            .differences["environment"]
+        assert environment["removed"] == {"gone": "short"}
+        assert environment["added"] == {"new": "short"}
+        assert environment["changed"] == {
+            "kept": {"type": "value", "left": "1", "right": "2"}}
+
+
+def test_diff_recursive_renamed_keys():
+    # Keys containing the derivation's own hashes are renamed before
+    # comparing, so they can't be looked up as they are.
+    left = make_derivation(LEFT_HASH, {LEFT_HASH: "1", "only": "x"})
+    right = make_derivation(RIGHT_HASH, {RIGHT_HASH: "2"})
+    environment = diff_recursive(left, right).differences["environment"]
+    assert environment["changed"] == {
+        RIGHT_HASH: {"type": "value", "left": "1", "right": "2"}}
+    assert environment["removed"] == {"only": "x"}
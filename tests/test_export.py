@@ -0,0 +1,46 @@
+import os
+import sqlite3
+
+import pytest
+
+from conftest import DATA
+from nix_derivation_tools.export import export_closure
+
+BAR = os.path.join(DATA, "0hm2f1psjpcwg8fijsmr4wwxrx59s092-bar.drv")
+MULTI = os.path.join(DATA,
+                     "h32dahq0bx5rp1krcdx3a53asj21jvhk-has-multi-out.drv")
+
+
+def test_export_sqlite(tmp_path):
+    target = str(tmp_path / "closure.sqlite")
+    assert export_closure([BAR, MULTI], target) == 2
+    assert os.listdir(str(tmp_path)) == ["closure.sqlite"]
+    conn = sqlite3.connect(target)
+    outputs = conn.execute(
+        "SELECT d.value, n.value FROM outputs o"
+        " JOIN strings d ON d.id = o.path JOIN strings n ON n.id = o.name"
+        " ORDER BY 1").fetchall()
+    conn.close()
+    assert [name for _, name in outputs] == ["lib", "out", "out"]
+    with pytest.raises(ValueError, match="already exists"):
+        export_closure([BAR], target)
+
+
+def test_failed_export_leaves_nothing(tmp_path):
+    target = str(tmp_path / "closure.sqlite")
+    with pytest.raises(Exception):
+        export_closure([BAR, str(tmp_path / "missing.drv")], target)
+    assert os.listdir(str(tmp_path)) == []
+    # So it can just be run again.
+    assert export_closure([BAR], target) == 1
+
+
+def test_failed_parquet_export_leaves_nothing(tmp_path):
+    pytest.importorskip("pyarrow")
+    target = str(tmp_path / "closure")
+    with pytest.raises(Exception):
+        export_closure([BAR, str(tmp_path / "missing.drv")], target,
+                       format="parquet")
+    assert os.listdir(str(tmp_path)) == []
+    assert export_closure([BAR], target, format="parquet") == 1
+    assert sorted(os.listdir(target))[0] == "builder_args.parquet"
@@ -0,0 +1,82 @@
+import pytest
+
+from nix_derivation_tools.cache import cache_scope
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.fingerprint import equivalent, fingerprint
+
+SHA256 = "894517c9163c896ec31a2adbd33c0681fd5f45b2c0ef08a64c92a03fb97f390f"
+
+
+@pytest.fixture
+def add(tmp_path):
+    """Write a derivation with the given hash part into a temporary store.
+
+    Its outputs are ``(name, value)`` pairs; a value of ``None`` gives a
+    path with the same hash part as the derivation.
+    """
+    def add(drv_hash, name, outputs=(("out", None),), inputs=(), env=None,
+            builder="/bin/sh"):
+        store = str(tmp_path)
+        output_values = {}
+        for output, value in outputs:
+            if value is None:
+                suffix = "" if output == "out" else "-" + output
+                value = "{}/{}-{}{}".format(store, drv_hash, name, suffix)
+            output_values[output] = value
+        environment = dict(env or {}, name=name)
+        for output, value in output_values.items():
+            environment[output] = value if isinstance(value, str) \
+                else value[0]
+        deriv = Derivation(
+            path="{}/{}-{}.drv".format(store, drv_hash, name), raw=None,
+            outputs=output_values,
+            input_derivations={d.path: ["out"] for d in inputs},
+            input_files=set(), system="x86_64-linux", builder=builder,
+            builder_args=[], environment=environment)
+        with open(deriv.path, "w") as f:
+            f.write(deriv.unparse())
+        return Derivation.parse_derivation_file(deriv.path)
+    with cache_scope():
+        yield add
+
+
+def hash_(char):
+    return char * 32
+
+
+def test_renamed_outputs(add):
+    def app(drv_hash, lib_hash, version):
+        lib = add(lib_hash, "lib", outputs=(("out", None), ("dev", None)),
+                  env={"version": version})
+        return add(drv_hash, "app", inputs=[lib],
+                   env={"buildInputs": lib.output_mapping["out"]})
+    left, right = app(hash_("a"), hash_("b"), "1"), app(hash_("c"),
+                                                        hash_("d"), "1")
+    assert left.path != right.path
+    assert equivalent(left, right)
+    assert fingerprint(left) == fingerprint(right)
+    changed = app(hash_("f"), hash_("g"), "2")
+    assert not equivalent(left, changed)
+
+
+def test_fixed_outputs_collapse(add):
+    def source(drv_hash, output_hash, url):
+        # Nix would derive the path from the output hash.
+        out = "/nix/store/{}-src".format(hash_(output_hash[0]))
+        return add(drv_hash, "src",
+                   outputs=(("out", (out, "r:sha256", output_hash)),),
+                   env={"url": url})
+    left = source(hash_("a"), SHA256, "https://example.org/src.tar.gz")
+    right = source(hash_("b"), SHA256, "https://mirror.example.org/src.tgz")
+    assert equivalent(left, right)
+    other = source(hash_("c"), "0" * 64, "https://example.org/src.tar.gz")
+    assert not equivalent(left, other)
+
+
+def test_floating_content_addressed(add):
+    def floating(drv_hash, builder):
+        return add(drv_hash, "ca", outputs=(("out", ("", "r:sha256", "")),),
+                   builder=builder)
+    left = floating(hash_("a"), "/bin/sh")
+    assert equivalent(left, floating(hash_("b"), "/bin/sh"))
+    assert not equivalent(left, floating(hash_("c"), "/bin/bash"))
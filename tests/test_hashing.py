@@ -0,0 +1,88 @@
+"""The vectors here were produced by Nix itself: the fixed outputs are
+from Nix's own unit tests, ``myname`` is the first derivation built in
+the Nix Pills, and the other derivation files in ``data`` were written
+by Nix."""
+import os
+
+import pytest
+
+from conftest import DATA
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.hashing import (
+    DerivationHasher, make_fixed_output_path, make_text_path)
+
+STORE = "/nix/store"
+
+BAR = "/nix/store/0hm2f1psjpcwg8fijsmr4wwxrx59s092-bar.drv"
+FOO = "/nix/store/4wvvbi4jwn0prsdxb7vs673qa5h9gr7x-foo.drv"
+MULTI = "/nix/store/h32dahq0bx5rp1krcdx3a53asj21jvhk-has-multi-out.drv"
+
+# sha256-iUUXyRY8iW7DGirb0zwGgf1fRbLA7wimTJKgP7l/OQ8=
+FIXED_HASH = "894517c9163c896ec31a2adbd33c0681fd5f45b2c0ef08a64c92a03fb97f390f"
+
+
+def load(path, file_path=None):
+    """Parse one of the derivations in ``data``, as if it were at
+    ``path`` in the store (or ``file_path``)."""
+    with open(os.path.join(DATA, os.path.basename(path))) as f:
+        return Derivation.parse_derivation(f.read(), file_path or path)
+
+
+@pytest.mark.parametrize("hash_algo,expected", [
+    ("sha256",
+     "/nix/store/rhcg9h16sqvlbpsa6dqm57sbr2al6nzg-drv-name-output-name"),
+    ("r:sha256",
+     "/nix/store/c015dhfh5l0lp6wxyvdn7bmwhbbr6hr9-drv-name-output-name"),
+])
+def test_fixed_output_path(hash_algo, expected):
+    assert make_fixed_output_path(hash_algo, FIXED_HASH,
+                                  "drv-name-output-name", STORE) == expected
+
+
+def test_fixed_output_derivation():
+    deriv = load(BAR)
+    hasher = DerivationHasher()
+    assert hasher.output_paths(deriv) == {
+        "out": "/nix/store/4q0pg5zpfmznxscq3avycvf9xdvx50n3-bar"}
+    assert hasher.derivation_path(deriv) == BAR
+    assert hasher.verify(deriv) == []
+
+
+def test_input_addressed_derivation():
+    deriv = load("/nix/store/z3hhlxbckx4g3n9sw91nnvlkjvyw754p-myname.drv")
+    out = "/nix/store/40s0qmrfb45vlh6610rk29ym318dswdr-myname"
+    assert deriv.output_mapping == {"out": out}
+    assert DerivationHasher().verify(deriv) == []
+
+
+def test_multi_output_derivation():
+    deriv = load(MULTI)
+    hasher = DerivationHasher()
+    assert hasher.output_paths(deriv) == {
+        "lib": "/nix/store/2vixb94v0hy2xc6p7mbnxxcyc095yyia-has-multi-out-lib",
+        "out": "/nix/store/55lwldka5nyxa08wnvlizyqw02ihy8ic-has-multi-out"}
+    assert hasher.derivation_path(deriv) == MULTI
+    assert hasher.verify(deriv) == []
+
+
+def test_derivation_with_input():
+    bar, foo = load(BAR), load(FOO)
+    hasher = DerivationHasher()
+    hasher.hash_modulo(bar)
+    assert hasher.output_paths(foo) == {
+        "out": "/nix/store/5vyvcwah9l9kf07d52rcgdk70g2f4y13-foo"}
+    assert hasher.verify(foo) == []
+
+
+def test_text_path_with_references():
+    # A derivation file is stored as text referring to its inputs.
+    with open(os.path.join(DATA, os.path.basename(FOO))) as f:
+        contents = f.read()
+    assert make_text_path("foo.drv", contents, [BAR], STORE) == FOO
+    assert make_text_path("foo.drv", contents, [], STORE) != FOO
+
+
+def test_verify_reports_problems():
+    deriv = load(MULTI, MULTI.replace("h32d", "h32f"))
+    problems = DerivationHasher().verify(deriv)
+    assert problems == ["derivation path should be {}".format(MULTI)]
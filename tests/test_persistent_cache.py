@@ -0,0 +1,162 @@
+import os
+import sqlite3
+
+import pytest
+
+from nix_derivation_tools import persistent_cache
+from nix_derivation_tools.persistent_cache import (
+    PersistentCache, SubstituterResultCache)
+
+FIELDS = [[["out", "/nix/store/x-foo", "", ""]], [], [], "sys", "/bin/sh",
+          [], [["name", "foo"]]]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = PersistentCache(str(tmp_path / "cache" / "derivations.sqlite"))
+    yield cache
+    cache.close()
+
+
+def write_file(path, contents):
+    with open(path, "w") as f:
+        f.write(contents)
+    return os.stat(path)
+
+
+def test_round_trip(cache, tmp_path):
+    path = str(tmp_path / "foo.drv")
+    stat = write_file(path, "contents")
+    assert cache.get(path, stat) is None
+    cache.put(path, stat, FIELDS)
+    # Buffered until flushed.
+    assert cache.get(path, stat) is None
+    cache.flush()
+    assert cache.get(path, stat) == FIELDS
+    reopened = PersistentCache(cache.path)
+    assert reopened.get(path, stat) == FIELDS
+    reopened.close()
+
+
+def test_invalidated_by_mtime(cache, tmp_path):
+    path = str(tmp_path / "foo.drv")
+    stat = write_file(path, "contents")
+    cache.put(path, stat, FIELDS)
+    cache.flush()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert cache.get(path, os.stat(path)) is None
+
+
+def test_invalidated_by_size(cache, tmp_path):
+    path = str(tmp_path / "foo.drv")
+    stat = write_file(path, "contents")
+    cache.put(path, stat, FIELDS)
+    cache.flush()
+    write_file(path, "longer contents")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    changed = os.stat(path)
+    assert changed.st_mtime_ns == stat.st_mtime_ns
+    assert cache.get(path, changed) is None
+
+
+def test_outdated_schema_is_discarded(cache, tmp_path):
+    path = str(tmp_path / "foo.drv")
+    stat = write_file(path, "contents")
+    cache.put(path, stat, FIELDS)
+    cache.close()
+    conn = sqlite3.connect(cache.path)
+    conn.execute("PRAGMA user_version = {}"
+                 .format(persistent_cache.SCHEMA_VERSION + 1))
+    conn.close()
+    reopened = PersistentCache(cache.path)
+    assert reopened.get(path, stat) is None
+    assert reopened.info()["entries"] == 0
+    reopened.close()
+
+
+def test_gc_removes_missing_files(cache, tmp_path):
+    kept, removed = str(tmp_path / "kept.drv"), str(tmp_path / "gone.drv")
+    for path in (kept, removed):
+        cache.put(path, write_file(path, "contents"), FIELDS)
+    os.unlink(removed)
+    assert cache.gc() == 1
+    assert cache.info()["entries"] == 1
+    assert cache.get(kept, os.stat(kept)) == FIELDS
+
+
+def test_trim_removes_oldest(cache, tmp_path, monkeypatch):
+    paths = []
+    for i in range(200):
+        path = str(tmp_path / "{}.drv".format(i))
+        monkeypatch.setattr(persistent_cache.time, "time", lambda: i)
+        cache.put(path, write_file(path, "x"), FIELDS + ["x" * 1000])
+        paths.append(path)
+    cache.flush()
+    size = cache.info()["size"]
+    assert cache.trim(size * 2) == 0
+    removed = cache.trim(size // 2)
+    assert 0 < removed < 200
+    assert cache.info()["entries"] == 200 - removed
+    assert cache.get(paths[0], os.stat(paths[0])) is None
+    assert cache.get(paths[-1], os.stat(paths[-1])) is not None
+
+
+def test_clear(cache, tmp_path):
+    path = str(tmp_path / "foo.drv")
+    stat = write_file(path, "contents")
+    cache.put(path, stat, FIELDS)
+    cache.clear()
+    cache.flush()
+    assert cache.get(path, stat) is None
+
+
+@pytest.fixture
+def results(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(persistent_cache.time, "time", lambda: clock[0])
+    results = SubstituterResultCache(str(tmp_path / "substituters.sqlite"),
+                                     positive_ttl=100, negative_ttl=10)
+    results.clock = clock
+    yield results
+    results.close()
+
+
+def test_results_expire(results):
+    url = "https://cache.example.org"
+    results.record(url, {"/nix/store/a": True, "/nix/store/b": False})
+    paths = ["/nix/store/a", "/nix/store/b", "/nix/store/c"]
+    assert results.lookup(url, paths) == \
+        {"/nix/store/a": True, "/nix/store/b": False}
+    # Negative answers expire first...
+    results.clock[0] += 50
+    assert results.lookup(url, paths) == {"/nix/store/a": True}
+    # ...then positive ones.
+    results.clock[0] += 50
+    assert results.lookup(url, paths) == {}
+    # Recording again refreshes an answer.
+    results.record(url, {"/nix/store/b": True})
+    assert results.lookup(url, paths) == {"/nix/store/b": True}
+
+
+def test_results_per_url(results):
+    results.record("https://one.example.org", {"/nix/store/a": True})
+    results.record("https://two.example.org", {"/nix/store/a": False})
+    assert results.lookup("https://one.example.org", ["/nix/store/a"]) == \
+        {"/nix/store/a": True}
+    assert results.lookup("https://two.example.org", ["/nix/store/a"]) == \
+        {"/nix/store/a": False}
+    assert results.lookup("https://three.example.org", ["/nix/store/a"]) == {}
+
+
+def test_results_many_paths(results):
+    paths = ["/nix/store/{}".format(i) for i in range(1200)]
+    results.record("u", {p: i % 2 == 0 for i, p in enumerate(paths)})
+    found = results.lookup("u", paths)
+    assert len(found) == 1200
+    assert found["/nix/store/2"] and not found["/nix/store/3"]
+
+
+def test_results_clear(results):
+    results.record("u", {"/nix/store/a": True})
+    results.clear()
+    assert results.lookup("u", ["/nix/store/a"]) == {}
@@ -0,0 +1,278 @@
+import hashlib
+import os
+
+import pytest
+
+from nix_derivation_tools.cache import cache_scope
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.incremental import DerivationRef, PreviewState
+from nix_derivation_tools.preview import needed_to_build, preview_build
+
+
+class FakePresence(object):
+    """Stands in for a store, recording which paths were looked for."""
+
+    def __init__(self, paths=()):
+        self.paths = set(paths)
+        self.checked = []
+        self.added = []
+        # Whether it can tell what changed since a snapshot.
+        self.tracking = True
+
+    def present(self, paths):
+        self.checked.extend(paths)
+        return {path for path in paths if path in self.paths}
+
+    def __contains__(self, path):
+        return len(self.present([path])) > 0
+
+    def add(self, path):
+        self.paths.add(path)
+        self.added.append(path)
+
+    def snapshot(self):
+        return len(self.added)
+
+    def changes(self, snapshot):
+        if not self.tracking:
+            return None
+        return set(self.added[snapshot:])
+
+
+class FakeSubstituter(object):
+    def __init__(self, url):
+        self.url = url
+
+
+class FakeClient(object):
+    """Stands in for a binary cache client, recording which paths were
+    asked about."""
+
+    def __init__(self, paths=(), urls=("https://cache.example.org",)):
+        self.paths = set(paths)
+        self.substituters = [FakeSubstituter(url) for url in urls]
+        self.queried = []
+
+    def query_paths(self, paths):
+        self.queried.extend(paths)
+        return {path: path in self.paths for path in paths}
+
+
+class Store(object):
+    """Writes derivations into a temporary store."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name):
+        digest = hashlib.sha256(name.encode()).hexdigest()[:32]
+        return os.path.join(self.directory, "{}-{}".format(digest, name))
+
+    def add(self, name, outputs=("out",), inputs=None):
+        """Write a derivation.
+
+        :param inputs: Derivations it depends on, each with the outputs
+            it uses.
+        :type inputs: ``dict`` of ``Derivation`` to ``list`` of ``str``
+        """
+        output_paths = {
+            out: self.path(name if out == "out" else name + "-" + out)
+            for out in outputs}
+        input_derivations = {deriv.path: list(outs)
+                             for deriv, outs in (inputs or {}).items()}
+        environment = dict(output_paths, name=name)
+        deriv = Derivation(
+            path=self.path(name + ".drv"), raw=None, outputs=output_paths,
+            input_derivations=input_derivations, input_files=set(),
+            system="x86_64-linux", builder="/bin/sh", builder_args=[],
+            environment=environment)
+        with open(deriv.path, "w") as f:
+            f.write(deriv.unparse())
+        return deriv
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setenv("NIX_STORE", str(tmp_path))
+    with cache_scope():
+        yield Store(str(tmp_path))
+
+
+def by_path(result):
+    return {deriv.path: outs for deriv, outs in result.items()}
+
+
+def test_needed_to_build(store):
+    dep = store.add("dep")
+    lib = store.add("lib", outputs=("out", "dev"), inputs={dep: ["out"]})
+    tool = store.add("tool", inputs={dep: ["out"]})
+    app = store.add("app", inputs={lib: ["out", "dev"], tool: ["out"]})
+    presence = FakePresence([dep.output_mapping["out"],
+                             lib.output_mapping["dev"]])
+    existing = {}
+    needed, need_fetch = needed_to_build(
+        app, existing=existing, on_server={tool: {"out"}},
+        presence=presence)
+    assert by_path(needed) == {app.path: {"out"}, lib.path: {"out"}}
+    assert by_path(need_fetch) == {tool.path: {"out"}}
+    assert by_path(existing) == {lib.path: {"dev"}, dep.path: {"out"}}
+    # Each output is only looked for once.
+    assert sorted(presence.checked) == sorted(set(presence.checked))
+
+
+def test_needed_to_build_deep(store):
+    # Deeper than Python's recursion limit.
+    deriv = store.add("pkg0")
+    for i in range(1, 1500):
+        deriv = store.add("pkg{}".format(i), inputs={deriv: ["out"]})
+    needed, need_fetch = needed_to_build(deriv, presence=FakePresence())
+    assert len(needed) == 1500 and need_fetch == {}
+
+
+@pytest.fixture
+def graph(store):
+    """A small closure with something of each kind.
+
+    * ``app`` needs building;
+    * ``lib`` needs its ``out`` built, but its ``dev`` exists;
+    * ``tool`` can be fetched, and depends on ``hidden``, which is never
+      looked at (its derivation file is removed);
+    * ``dep`` exists.
+    """
+    dep = store.add("dep")
+    hidden = store.add("hidden")
+    lib = store.add("lib", outputs=("out", "dev"), inputs={dep: ["out"]})
+    tool = store.add("tool", outputs=("out", "man"),
+                     inputs={hidden: ["out"], dep: ["out"]})
+    app = store.add("app", inputs={lib: ["out", "dev"], tool: ["out"]})
+    os.unlink(hidden.path)
+    presence = FakePresence([dep.output_mapping["out"],
+                             lib.output_mapping["dev"]])
+    client = FakeClient([tool.output_mapping["out"],
+                         tool.output_mapping["man"]])
+    return dict(dep=dep, hidden=hidden, lib=lib, tool=tool, app=app,
+                presence=presence, client=client)
+
+
+def test_preview_build(graph):
+    app, lib, tool = graph["app"], graph["lib"], graph["tool"]
+    presence, client = graph["presence"], graph["client"]
+    needed, need_fetch = preview_build([app.path], client=client,
+                                       presence=presence)
+    assert by_path(needed) == {app.path: {"out"}, lib.path: {"out"}}
+    assert by_path(need_fetch) == {tool.path: {"out"}}
+    hidden = graph["hidden"].output_mapping["out"]
+    assert hidden not in presence.checked and hidden not in client.queried
+    # Only missing outputs are asked about, each once.
+    assert sorted(client.queried) == sorted(
+        [app.output_mapping["out"], lib.output_mapping["out"],
+         tool.output_mapping["out"]])
+    assert sorted(presence.checked) == sorted(set(presence.checked))
+
+
+def test_preview_build_outputs(graph):
+    lib, tool = graph["lib"], graph["tool"]
+    needed, need_fetch = preview_build(
+        [lib.path + "!dev", tool.path + "!out,man"], client=graph["client"],
+        presence=graph["presence"])
+    assert needed == {}
+    assert by_path(need_fetch) == {tool.path: {"out", "man"}}
+    needed, need_fetch = preview_build([lib.path],
+                                       presence=graph["presence"])
+    assert by_path(needed) == {lib.path: {"out"}} and need_fetch == {}
+
+
+def test_preview_build_without_cache(graph):
+    app, lib, tool = graph["app"], graph["lib"], graph["tool"]
+    # Now ``hidden`` must be looked at.
+    with open(graph["hidden"].path, "w") as f:
+        f.write(graph["hidden"].unparse())
+    needed, need_fetch = preview_build([app.path],
+                                       presence=graph["presence"])
+    assert by_path(needed) == {app.path: {"out"}, lib.path: {"out"},
+                               tool.path: {"out"},
+                               graph["hidden"].path: {"out"}}
+    assert need_fetch == {}
+
+
+def compare(paths, state, client, presence):
+    """Preview incrementally, checking the result against a full preview.
+
+    :return: The output paths checked for in the store and asked about,
+        by the incremental preview.
+    """
+    expected = preview_build(paths, client=client, presence=presence)
+    checked, queried = len(presence.checked), len(client.queried)
+    result = preview_build(paths, client=client, presence=presence,
+                           state=state)
+    assert [by_path(r) for r in result] == [by_path(r) for r in expected]
+    assert all(isinstance(deriv, DerivationRef)
+               for r in result for deriv in r)
+    return presence.checked[checked:], client.queried[queried:]
+
+
+def test_preview_incremental(graph, tmp_path):
+    app, lib, tool = graph["app"], graph["lib"], graph["tool"]
+    presence, client = graph["presence"], graph["client"]
+    paths = [app.path]
+    state = PreviewState()
+    checked, queried = compare(paths, state, client, presence)
+    assert len(checked) == 5
+    # Saved and loaded, as between runs.
+    state.save(str(tmp_path / "state.json"))
+    state = PreviewState.load(str(tmp_path / "state.json"))
+    checked, queried = compare(paths, state, client, presence)
+    # Nothing changed in the store, and what could be fetched still can.
+    assert checked == []
+    assert tool.output_mapping["out"] not in queried
+    # An output appears.
+    presence.add(lib.output_mapping["out"])
+    checked, queried = compare(paths, state, client, presence)
+    assert checked == [lib.output_mapping["out"]]
+    assert by_path(preview_build(paths, client=client, presence=presence,
+                                 state=state)[0]) == {app.path: {"out"}}
+    # Another one, in a later run.
+    presence.add(app.output_mapping["out"])
+    checked, queried = compare(paths, state, client, presence)
+    assert checked == [app.output_mapping["out"]]
+    assert queried == []
+
+
+def test_preview_incremental_outputs(graph):
+    lib, tool = graph["lib"], graph["tool"]
+    state = PreviewState()
+    for paths in ([lib.path + "!dev"], [tool.path + "!out,man", lib.path],
+                  [graph["app"].path, tool.path + "!man"]):
+        compare(paths, state, graph["client"], graph["presence"])
+        compare(paths, state, graph["client"], graph["presence"])
+
+
+def test_preview_incremental_untracked_store(graph):
+    presence = graph["presence"]
+    presence.tracking = False
+    state = PreviewState()
+    compare([graph["app"].path], state, graph["client"], presence)
+    checked, queried = compare([graph["app"].path], state, graph["client"],
+                               presence)
+    assert len(checked) == 5
+
+
+def test_preview_incremental_cache_change(graph):
+    app, tool, hidden = graph["app"], graph["tool"], graph["hidden"]
+    presence = graph["presence"]
+    state = PreviewState()
+    compare([app.path], state, graph["client"], presence)
+    # A different list of caches, which also have ``tool``.
+    client = FakeClient(graph["client"].paths,
+                        urls=("https://other.example.org",
+                              "https://cache.example.org"))
+    checked, queried = compare([app.path], state, client, presence)
+    assert tool.output_mapping["out"] in queried
+    # One which doesn't, so that ``tool`` and what it needs are walked.
+    with open(hidden.path, "w") as f:
+        f.write(hidden.unparse())
+    client = FakeClient(urls=("https://other.example.org",))
+    checked, queried = compare([app.path], state, client, presence)
+    assert tool.output_mapping["out"] in queried
+    assert hidden.output_mapping["out"] in checked
+    assert state.binary_caches == ["https://other.example.org"]
@@ -0,0 +1,112 @@
+import io
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+from nix_derivation_tools import server
+
+
+def test_input_is_read_as_needed():
+    messages = [{"stdin": "a\nb"}, {"stdin": "c\nd\n"}, {"stdin": "e"},
+                {"stdin": None}, {"stdin": "never read"}]
+    rfile = io.BytesIO(b"".join(json.dumps(m).encode("utf-8") + b"\n"
+                                for m in messages))
+    stdin = server._Input(rfile)
+    assert not stdin.isatty()
+    assert stdin.readline() == "a\n"
+    assert stdin.read(3) == "bc\n"
+    assert list(stdin) == ["d\n", "e"]
+    assert stdin.read() == ""
+
+
+def test_stdin_is_sent_as_it_arrives(monkeypatch):
+    read_fd, write_fd = os.pipe()
+    stdin = io.TextIOWrapper(os.fdopen(read_fd, "rb"), encoding="utf-8")
+    monkeypatch.setattr(server.sys, "stdin", stdin)
+    chunks = server._read_stdin()
+    received = []
+    # Ends with half of a two-byte character, and the pipe is left open.
+    os.write(write_fd, "a\n\u00e9".encode("utf-8")[:-1])
+    reader = threading.Thread(target=lambda: received.append(next(chunks)),
+                              daemon=True)
+    reader.start()
+    reader.join(5)
+    assert received == ["a\n"]
+    os.write(write_fd, "\u00e9\n".encode("utf-8")[1:])
+    os.close(write_fd)
+    assert list(chunks) == ["\u00e9\n"]
+    stdin.close()
+
+
+def test_terminal_input():
+    stdin = server._Input(None)
+    assert stdin.isatty()
+    assert stdin.read() == ""
+
+
+@pytest.fixture
+def tmpdir_env(tmp_path, monkeypatch):
+    monkeypatch.delenv("DERIVTOOL_SOCKET", raising=False)
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr(server.tempfile, "gettempdir", lambda: str(tmp_path))
+    return tmp_path
+
+
+def test_default_socket_path_is_private(tmpdir_env):
+    path = server.default_socket_path()
+    directory = os.path.dirname(path)
+    assert os.path.dirname(directory) == str(tmpdir_env)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+
+def test_default_socket_path_rejects_shared_directory(tmpdir_env):
+    directory = tmpdir_env / "derivtool-{}".format(os.getuid())
+    directory.mkdir(mode=0o777)
+    os.chmod(str(directory), 0o777)
+    with pytest.raises(ValueError):
+        server.default_socket_path()
+    assert server.run_remote(["show", "x"]) is None
+
+
+def test_only_own_sockets_are_used(tmp_path):
+    path = str(tmp_path / "sock")
+    with open(path, "w") as f:
+        f.write("not a socket")
+    assert server._connect(path) is None
+    assert server.run_remote(["show", "x"], path) is None
+    with pytest.raises(ValueError):
+        server.DerivtoolServer(path, lambda argv: 0)
+
+    os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    try:
+        sock = server._connect(path)
+        assert sock is not None
+        sock.close()
+    finally:
+        listener.close()
+
+
+def test_served_commands_use_the_parse_cache(tmp_path, capsys):
+    from conftest import DATA
+    from nix_derivation_tools import cli
+    from nix_derivation_tools.cache import cache_scope
+    from nix_derivation_tools.persistent_cache import (
+        PersistentCache, get_persistent_cache)
+    path = str(tmp_path / "derivations.sqlite")
+    drv = os.path.join(DATA, "0hm2f1psjpcwg8fijsmr4wwxrx59s092-bar.drv")
+    with cache_scope():
+        assert cli.serve_request(["--parse-cache", "--parse-cache-path",
+                                  path, "show", "--json", drv]) is None
+    assert json.loads(capsys.readouterr().out)["environment"]["name"] == \
+        "bar"
+    # Only for that command.
+    assert get_persistent_cache() is None
+    cache = PersistentCache(path)
+    assert cache.get(drv, os.stat(drv)) is not None
+    cache.close()
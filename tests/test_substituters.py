@@ -0,0 +1,64 @@
+import http.server
+import threading
+import time
+
+import pytest
+
+from nix_derivation_tools.substituters import Substituter, SubstituterClient
+
+DELAY = 0.1
+PRESENT = "/nix/store/0hm2f1psjpcwg8fijsmr4wwxrx59s092-bar"
+ABSENT = "/nix/store/4q0pg5zpfmznxscq3avycvf9xdvx50n3-bar"
+
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        time.sleep(DELAY)
+        found = self.path == "/0hm2f1psjpcwg8fijsmr4wwxrx59s092.narinfo"
+        self.send_response(200 if found else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def cache_url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_query_paths(cache_url):
+    client = SubstituterClient([cache_url], max_connections=1)
+    try:
+        paths = [PRESENT] + [ABSENT[:-3] + str(i) for i in range(3)]
+        assert client.query_paths(paths) == \
+            {path: path == PRESENT for path in paths}
+        stats = client.substituters[0].stats
+        assert (stats.queries, stats.hits, stats.errors) == (4, 1, 0)
+        # With one connection, queries wait for each other; that time
+        # isn't latency.
+        assert DELAY <= stats.mean_latency < DELAY * 1.8
+    finally:
+        client.close()
+
+
+@pytest.mark.parametrize("url", ["ftp://example.org", "http://",
+                                 "http://[::1", "http://example.org:port"])
+def test_bad_url(url):
+    with pytest.raises(ValueError):
+        SubstituterClient(["https://example.org", url])
+
+
+def test_host_header():
+    assert Substituter("http://example.org:80/x", 1, 1).host_header == \
+        "example.org"
+    assert Substituter("https://[::1]:8443", 1, 1).host_header == \
+        "[::1]:8443"
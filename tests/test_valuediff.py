@@ -0,0 +1,80 @@
+import hashlib
+import os
+
+from conftest import DATA
+from nix_derivation_tools.derivation import Derivation
+from nix_derivation_tools.valuediff import (
+    HASH_MASK, diff_values, format_difference, mask_store_hashes)
+
+HASH = "0hm2f1psjpcwg8fijsmr4wwxrx59s092"
+OTHER_HASH = "4q0pg5zpfmznxscq3avycvf9xdvx50n3"
+
+
+def test_mask_store_hashes():
+    assert mask_store_hashes("/nix/store/{}-bar /nix/store/{}-foo"
+                             .format(HASH, OTHER_HASH)) == \
+        "/nix/store/{0}-bar /nix/store/{0}-foo".format(HASH_MASK)
+    assert mask_store_hashes(HASH) == HASH_MASK
+    # Not part of longer words, such as digests.
+    digest = hashlib.sha256(b"").hexdigest()
+    for text in (digest, "x" + HASH, HASH + "0", "sha1-" + "a" * 40):
+        assert mask_store_hashes(text) == text
+
+
+def test_strings():
+    assert diff_values("a", "a") is None
+    assert diff_values("a", "b") == {"type": "value", "left": "a",
+                                     "right": "b"}
+    long = "x" * 5000
+    assert diff_values(long, "x" * 5000) is None
+    assert diff_values(long + "\n1", long + "\n2") == {
+        "type": "text",
+        "diff": ["--- left", "+++ right", "@@ -1,2 +1,2 @@", " " + long,
+                 "-1", "+2"]}
+
+
+def test_mask_hashes():
+    left = "/nix/store/{}-bar".format(HASH)
+    right = "/nix/store/{}-bar".format(OTHER_HASH)
+    assert diff_values(left, right) is not None
+    assert diff_values(left, right, mask_hashes=True) is None
+    assert diff_values({left}, {right}, mask_hashes=True) is None
+    assert diff_values({left: ["out"]}, {right: ["out"]},
+                       mask_hashes=True) is None
+    assert diff_values({left: ["out"]}, {right: ["dev"]},
+                       mask_hashes=True)["type"] == "dict"
+
+
+def test_collections():
+    assert diff_values({"a": "1", "b": "2"}, {"b": "3", "c": "4"}) == {
+        "type": "dict", "added": {"c": "4"}, "removed": {"a": "1"},
+        "changed": {"b": {"type": "value", "left": "2", "right": "3"}}}
+    assert diff_values({"a", "b"}, {"b", "c"}) == {
+        "type": "set", "added": ["c"], "removed": ["a"]}
+    assert diff_values(["a", "b"], ("a", "b")) is None
+    assert diff_values(["a", "b"], ["a", "c"])["type"] == "text"
+    assert diff_values([1], [2]) == {"type": "value", "left": [1],
+                                     "right": [2]}
+
+
+def test_format_difference():
+    difference = diff_values({"a": "1", "b": "2", "s": "x\ny"},
+                             {"b": "3", "c": "4", "s": "x\nz"})
+    assert format_difference(difference) == [
+        "- a: '1'", "+ c: '4'", "~ b: '2' -> '3'", "~ s:",
+        "    --- left", "    +++ right", "    @@ -1,2 +1,2 @@", "     x",
+        "    -y", "    +z"]
+
+
+def test_derivation_diff():
+    def parse(name):
+        return Derivation.parse_derivation_file(os.path.join(DATA, name))
+    foo = parse("4wvvbi4jwn0prsdxb7vs673qa5h9gr7x-foo.drv")
+    bar = parse("0hm2f1psjpcwg8fijsmr4wwxrx59s092-bar.drv")
+    assert foo.diff(foo) == "equal"
+    lines = foo.diff(bar).splitlines()
+    assert "input_derivations:" in lines and "environment:" in lines
+    # Output paths aren't compared, only output names.
+    assert "outputs:" not in lines
+    environment = lines[lines.index("environment:") + 1:]
+    assert "  ~ name: 'foo' -> 'bar'" in environment